@@ -13,13 +13,258 @@ import botocore
 import datetime 
 import re
 import base64
-from io import BytesIO
+from io import BytesIO, StringIO
 import matplotlib.pyplot as plt
 import html_tools
 import time
+import sqlite3
+import asyncio
+import concurrent.futures
+import functools
+import threading
+import hashlib
+import heapq
+import collections
+import copy
+import numbers
+import operator
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+#Settings used for all boto3 clients (see create_boto3_client). Clients
+#are shared across the process so that connection pools are reused.
+BOTO3_CLIENT_CONFIG = Config(max_pool_connections = 50,
+                             tcp_keepalive = True,
+                             retries = {'max_attempts' : 10, 'mode' : 'adaptive'})
+_boto3_clients = {}
+_boto3_clients_lock = threading.Lock()
+
+#Location of the CBRAIN portal used when no other base url is given
+CBRAIN_BASE_URL = os.environ.get('CBRAIN_BASE_URL', 'https://portal.cbrain.mcgill.ca')
+
+#Request parameters used to ask CBRAIN for the most recently updated
+#entities first (see sync_cbrain_snapshot)
+CBRAIN_INCREMENTAL_SORT_PARAMS = {'sort_by' : 'updated_at', 'sort_dir' : 'desc'}
+
+#How far before the start of a snapshot sync the next incremental
+#sync starts looking for updated entities. Covers entities updated
+#while the sync is running and small clock differences with CBRAIN.
+CBRAIN_SNAPSHOT_WATERMARK_MARGIN_MINUTES = 5
+
+#Status codes that mean CBRAIN rejected the filters of a
+#request (see find_cbrain_entities)
+CBRAIN_FILTER_REJECTION_CODES = (400, 422)
+_default_cbrain_client = None
+
+#Parsed scans.tsv files, keyed by (bucket, key, ETag) so that
+#a file is only parsed again if it changes in S3. Once more than
+#SCANS_TSV_CACHE_MAX_FILES are cached, the least recently used
+#files are dropped (see fetch_scans_tsv_file).
+SCANS_TSV_CACHE_MAX_FILES = 4096
+_scans_tsv_cache = collections.OrderedDict()
+_scans_tsv_cache_lock = threading.Lock()
+
+#Error codes that S3 uses for objects that don't exist, and for
+#conditional writes (IfMatch/IfNoneMatch) that lost to another writer
+S3_MISSING_OBJECT_CODES = ('NoSuchKey', '404', 'NotFound')
+S3_WRITE_CONFLICT_CODES = ('PreconditionFailed', '412', 'ConditionalRequestConflict', '409')
+
+
+
+class CbrainClient:
+    '''Client for making requests to the CBRAIN API
+
+    Holds a requests.Session so that connections to the CBRAIN
+    portal are kept open and reused between requests. Requests
+    that fail to connect, or that receive a 429/5xx response,
+    are retried with exponential backoff. Only idempotent
+    requests (i.e. GET) are retried after reaching the server,
+    so tasks will never be submitted twice by a retry.
+
+    Parameters
+    ----------
+
+    base_url : str or None, default None
+        The CBRAIN portal to send requests to. If None,
+        CBRAIN_BASE_URL will be used (which can be set with
+        the CBRAIN_BASE_URL environment variable).
+    pool_maxsize : int, default 32
+        Maximum number of connections to keep open
+    max_retries : int, default 5
+        Maximum number of retries for a single request
+    backoff_factor : float, default 0.5
+        Used to determine the wait between retries
+        (0.5, 1, 2, 4, ... seconds)
+    timeout : tuple of float, default (10, 300)
+        The (connect, read) timeouts in seconds for requests
+    max_concurrent_pages : int, default 8
+        Maximum number of pages requested at the same time
+        when walking through paginated listings (see get_all_pages)
+
+    '''
+
+    def __init__(self, base_url = None, pool_maxsize = 32, max_retries = 5,
+                 backoff_factor = 0.5, timeout = (10, 300), max_concurrent_pages = 8):
+
+        if type(base_url) == type(None):
+            base_url = CBRAIN_BASE_URL
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_concurrent_pages = max_concurrent_pages
+
+        #(entity_type, attribute) filters that the portal was found to
+        #ignore or reject. These are only applied client-side.
+        self.unsupported_filters = set()
+
+        retry = Retry(total = max_retries,
+                      backoff_factor = backoff_factor,
+                      status_forcelist = [429, 500, 502, 503, 504],
+                      allowed_methods = Retry.DEFAULT_ALLOWED_METHODS,
+                      raise_on_status = False)
+        adapter = HTTPAdapter(pool_connections = pool_maxsize, pool_maxsize = pool_maxsize, max_retries = retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def with_max_concurrent_pages(self, max_concurrent_pages):
+        '''Return a client that requests at most max_concurrent_pages pages at the same time
+
+        The returned client shares this client's connections and
+        the filters found to be unsupported (see find_cbrain_entities).
+
+        '''
+
+        limited_client = copy.copy(self)
+        limited_client.max_concurrent_pages = max_concurrent_pages
+        return limited_client
+
+    def url(self, *path):
+        '''Build the full url for a CBRAIN API path (i.e. url('userfiles', 'sync_multiple'))'''
+        return '/'.join([self.base_url] + [str(temp_part) for temp_part in path])
+
+    def get(self, *path, **kwargs):
+        '''Send a GET request to the given CBRAIN API path'''
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(self.url(*path), **kwargs)
+
+    def post(self, *path, **kwargs):
+        '''Send a POST request to the given CBRAIN API path'''
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(self.url(*path), **kwargs)
+
+    def get_all_pages(self, path, request_data, per_page = 1000, page_callback = None,
+                      failure_message = 'CBRAIN request failed.', raise_on_failure = False):
+        '''Collect every page of a paginated CBRAIN listing
+
+        The first page is requested on its own, so listings that fit
+        on one page only need one request. If it is full, up to
+        max_concurrent_pages of the following pages are requested at
+        the same time. Pages are still processed in order, and no new
+        pages are requested once a page with fewer than per_page entries
+        (i.e. the last page) or a failed request is seen.
+
+        Parameters
+        ----------
+
+        path : str
+            The CBRAIN API path to list (i.e. 'userfiles')
+        request_data : dict
+            Data sent with each request (i.e. the api token).
+            'page' and 'per_page' will be added for each request.
+        per_page : int, default 1000
+            Number of entries to request per page
+        page_callback : None or function, default None
+            If provided, this will be called with the list of entries
+            from each page (in page order) as soon as the page is
+            available, so callers can start working on the entries
+            before the full listing has been received.
+        failure_message : str
+            Message printed if a request fails
+        raise_on_failure : bool, default False
+            If True, a failed request raises requests.HTTPError
+            instead of printing failure_message and returning the
+            entries collected so far
+
+        Returns
+        -------
+
+        list of dicts, with the entries from all pages in order
+
+        '''
+
+        def get_page(page):
+            page_data = dict(request_data)
+            page_data['page'] = page
+            page_data['per_page'] = per_page
+            return self.get(path, data = page_data, headers = {'Accept': 'application/json'})
+
+        entries = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.max_concurrent_pages) as executor:
+            pending_pages = [executor.submit(get_page, 1)]
+            next_page = 2
+            while len(pending_pages):
+                response = pending_pages.pop(0).result()
+                if response.status_code != requests.codes.ok:
+                    if raise_on_failure:
+                        for temp_future in pending_pages:
+                            temp_future.cancel()
+                        raise requests.HTTPError('{} ({})'.format(failure_message, response.status_code), response = response)
+                    print(failure_message)
+                    print(response)
+                    break
+
+                # Collect the responses on this page
+                page_entries = response.json()
+                entries += page_entries
+                if type(page_callback) != type(None):
+                    page_callback(page_entries)
+
+                # Stop requesting responses when we're at the last page
+                if len(page_entries) < per_page:
+                    break
+                while len(pending_pages) < self.max_concurrent_pages:
+                    pending_pages.append(executor.submit(get_page, next_page))
+                    next_page += 1
+
+            #Don't start any requests past the last page
+            for temp_future in pending_pages:
+                temp_future.cancel()
+
+        return entries
+
+
+def get_cbrain_client(cbrain_client = None):
+    '''Grab the CbrainClient to use for a request
+
+    Returns cbrain_client if one is provided, otherwise returns
+    the process-wide default client (created on first use).
+
+    '''
+
+    global _default_cbrain_client
+    if type(cbrain_client) != type(None):
+        return cbrain_client
+    if type(_default_cbrain_client) == type(None):
+        _default_cbrain_client = CbrainClient()
+    return _default_cbrain_client
+
+
+def set_cbrain_client(cbrain_client):
+    '''Set the process-wide default CbrainClient
+
+    For example, set_cbrain_client(CbrainClient(base_url = 'http://localhost:3000'))
+    will send all CBRAIN requests to a local portal.
+
+    '''
+
+    global _default_cbrain_client
+    _default_cbrain_client = cbrain_client
+    return
 
 
-def find_cbrain_subjects(cbrain_api_token, data_provider_id = 710): #For the real study this should be 710
+def find_cbrain_subjects(cbrain_api_token, data_provider_id = 710, cbrain_client = None, page_callback = None): #For the real study this should be 710
     '''Find a list of subjects registered in CBRAIN
 
     Parameters
@@ -29,6 +274,12 @@ def find_cbrain_subjects(cbrain_api_token, data_provider_id = 710): #For the rea
     data_provider_id : int, default 710
         The CBRAIN data provider ID for the location where
         where all your BIDS data is stored
+    cbrain_client : CbrainClient or None, default None
+        Client used to talk to CBRAIN. If None, the
+        default client from get_cbrain_client is used.
+    page_callback : None or function, default None
+        Called with the userfiles from each page as they
+        arrive (see CbrainClient.get_all_pages)
     
     Returns
     -------
@@ -46,42 +297,18 @@ def find_cbrain_subjects(cbrain_api_token, data_provider_id = 710): #For the rea
     
     '''
 
-    files = []
-    files_request = {
-        'cbrain_api_token': cbrain_api_token,
-        'page': 1,
-        'per_page': 1000
-    }
-
-    while True:
-
-        base_url = 'https://portal.cbrain.mcgill.ca'
-        files_response = requests.get(
-            url = '/'.join([base_url, 'userfiles']),
-            data = files_request,
-            headers = {'Accept': 'application/json'}
-        )
-
-        if files_response.status_code != requests.codes.ok:
-            print('User files request failed.')
-            print(files_response)
-            break
-
-        # Collect the responses on this page then increment
-        files += files_response.json()
-        files_request['page'] += 1
-
-        # Stop requesting responses when we're at the last page
-        if len(files_response.json()) < files_request['per_page']:
-            break 
+    files = find_cbrain_entities(cbrain_api_token, 'userfiles', cbrain_client = cbrain_client, page_callback = page_callback,
+                                 filters = {'data_provider_id' : data_provider_id, 'type' : 'BidsSubject'})
 
     file_names = []
     ids = []
     sizes = []
+    names_found = set()
     data_provider_id = int(data_provider_id)
     for temp in files:
         if (temp['data_provider_id'] == data_provider_id) and (temp['type'] == 'BidsSubject'):
-            if temp['name'] not in file_names:
+            if temp['name'] not in names_found:
+                names_found.add(temp['name'])
                 file_names.append(temp['name'])
                 ids.append(temp['id'])
                 sizes.append(temp['size'])
@@ -90,7 +317,7 @@ def find_cbrain_subjects(cbrain_api_token, data_provider_id = 710): #For the rea
 
 
 def find_potential_subjects_for_processing_v2(bids_data_provider_files, bids_bucket_config, bids_bucket = 'hbcd-pilot',
-                                           bids_prefix = 'assembly_bids'):
+                                           bids_prefix = 'assembly_bids', s3_inventory = None):
     """Find subjects that may be ready for processing
     
     Looks for subjects that are already registered in CBRAIN
@@ -109,6 +336,9 @@ def find_potential_subjects_for_processing_v2(bids_data_provider_files, bids_buc
         Name of the S3 bucket to look for subjects in
     bids_prefix : str
         Prefix to look for subjects in (i.e. assembly_bids)
+    s3_inventory : None or dict, default None
+        Inventory generated by build_s3_inventory, used
+        to find S3 subjects without listing the bucket again
     
     Returns
     -------
@@ -120,26 +350,32 @@ def find_potential_subjects_for_processing_v2(bids_data_provider_files, bids_buc
 
     """
 
-    #Find S3 Subjects
-    s3_subjects = find_s3_subjects(bids_bucket_config, bucket = bids_bucket, prefix = bids_prefix)
+    #Find S3 Subjects. Only BIDS subject folders are of interest
+    #here, so a delimiter listing is enough without an inventory.
+    s3_subjects = find_s3_subjects(bids_bucket_config, bucket = bids_bucket, prefix = bids_prefix,
+                                   s3_inventory = s3_inventory, discovery_mode = 'delimiter')
     s3_subjects.sort()
 
-    #Narrow down BIDS DP Files to BidsSubject instances
-    cbrain_bids_subject_files = list(filter(lambda f: 'BidsSubject' == f['type'], bids_data_provider_files))
+    #Narrow down BIDS DP Files to BidsSubject instances, keeping
+    #the first CBRAIN ID found for each subject name
+    cbrain_bids_subject_ids = {}
+    for temp_cbrain in bids_data_provider_files:
+        if temp_cbrain['type'] == 'BidsSubject':
+            cbrain_bids_subject_ids.setdefault(temp_cbrain['name'], temp_cbrain['id'])
 
     #Find S3 subjects that are also registered in CBRAIN
     registered_and_s3_ids = []
     registered_and_s3_names = []
     for temp_subject in s3_subjects:
-        for i, temp_cbrain in enumerate(cbrain_bids_subject_files):
-            if temp_cbrain['name'] == temp_subject:
-                registered_and_s3_ids.append(temp_cbrain['id'])
-                registered_and_s3_names.append(temp_cbrain['name'])
-                break
+        if temp_subject in cbrain_bids_subject_ids:
+            registered_and_s3_ids.append(cbrain_bids_subject_ids[temp_subject])
+            registered_and_s3_names.append(temp_subject)
 
     return registered_and_s3_names, registered_and_s3_ids
 
-def find_s3_subjects(bids_bucket_config, bucket = 'hbcd-pilot', prefix = 'assembly_bids'):
+def find_s3_subjects(bids_bucket_config, bucket = 'hbcd-pilot', prefix = 'assembly_bids',
+                     s3_inventory = None, listing_cache_path = None, max_subject_age_hours = 2,
+                     discovery_mode = 'objects'):
     '''Utility to find BIDS subjects in S3 bucket
     
     Parameters
@@ -155,6 +391,29 @@ def find_s3_subjects(bids_bucket_config, bucket = 'hbcd-pilot', prefix = 'assemb
         the search query (i.e. if data is at
         s3://hbcd-pilot/assembly_bids/sub-1, then
         prefix = 'assembly_bids')
+    s3_inventory : None or dict, default None
+        Inventory generated by build_s3_inventory. If
+        provided (and it covers the same bucket/prefix),
+        subjects will be taken from the inventory instead
+        of listing the bucket again.
+    listing_cache_path : None or str, default None
+        If provided, subjects will be taken from a persistent
+        SQLite listing cache stored at this path after it is
+        refreshed (see refresh_s3_listing_cache).
+    max_subject_age_hours : float, default 2
+        Only used with listing_cache_path. Subjects whose
+        cached listing is older than this will be listed again
+        (see refresh_s3_listing_cache for what can be missed
+        before then).
+    discovery_mode : 'objects' or 'delimiter', default 'objects'
+        If 'objects', the key of every object underneath the prefix
+        is inspected. If 'delimiter', subjects are found from the
+        folders directly underneath the prefix using a delimiter
+        listing, so the number of requests scales with the number
+        of subjects instead of the number of files. The delimiter
+        listing only finds 'sub-*' folders, so unlike 'objects'
+        it doesn't report files directly under the prefix whose
+        name has 'sub-' in it (i.e. 'assembly_bids/sub-1_notes.txt').
         
     Returns
     -------
@@ -169,6 +428,24 @@ def find_s3_subjects(bids_bucket_config, bucket = 'hbcd-pilot', prefix = 'assemb
         
     '''
 
+    #Reuse the listing from the inventory if one was already built
+    if type(s3_inventory) != type(None):
+        if (s3_inventory['bucket'] == bucket) and (s3_inventory['prefix'] == prefix):
+            return list(s3_inventory['subjects'].keys())
+
+    #Use the persistent listing cache if one was requested
+    if type(listing_cache_path) != type(None):
+        refresh_s3_listing_cache(listing_cache_path, bids_bucket_config, bucket = bucket, prefix = prefix,
+                                 max_subject_age_hours = max_subject_age_hours)
+        return list(describe_s3_listing_cache(listing_cache_path).query('bucket == @bucket and prefix == @prefix')['subject'])
+
+    #Only look at the "sub-*" folders directly under the prefix
+    if discovery_mode == 'delimiter':
+        client = create_boto3_client(s3_config = bids_bucket_config)
+        return [temp_folder for temp_folder in list_s3_common_prefixes(client, bucket, prefix) if 'sub-' in temp_folder]
+    elif discovery_mode != 'objects':
+        raise ValueError('Error: discovery_mode must be either delimiter or objects, not {}'.format(discovery_mode))
+
     # Create a PageIterator    
     page_iterator = create_page_iterator(bucket = bucket, prefix = prefix, bucket_config = bids_bucket_config)
 
@@ -193,9 +470,57 @@ def find_s3_subjects(bids_bucket_config, bucket = 'hbcd-pilot', prefix = 'assemb
     return s3_subjects
 
 
-def grab_cbrain_initialization_details(cbrain_api_token, group_name, bids_data_provider_name, session_data_providers):
+def find_s3_subject_sessions(bids_bucket_config, subjects = None, bucket = 'hbcd-pilot',
+                             prefix = 'assembly_bids', max_workers = 16):
+    '''Find the session folders that exist for each subject in S3
+
+    Each subject folder is queried with a delimiter listing
+    so only the session folder names are returned. The subject
+    folders are queried in parallel.
+
+    Parameters
+    ----------
+
+    bids_bucket_config : str
+        This will be used as a config file to identify
+        the s3 credentials
+    subjects : None or list of str, default None
+        Subjects to find sessions for. If None, all subjects
+        found by find_s3_subjects will be used.
+    bucket : str, default 'hbcd-pilot'
+        The name of the bucket to query
+    prefix : str, default 'assembly_bids'
+        The study folder within the bucket
+    max_workers : int, default 16
+        The number of subject folders to query at the same time
+
+    Returns
+    -------
+
+    dict
+        Dictionary whose keys are subjects and whose values are
+        the list of 'ses-*' folders found for each subject
+
+    '''
+
+    if type(subjects) == type(None):
+        subjects = find_s3_subjects(bids_bucket_config, bucket = bucket, prefix = prefix, discovery_mode = 'delimiter')
+
+    client = create_boto3_client(s3_config = bids_bucket_config)
+    def find_sessions(subject):
+        subject_folders = list_s3_common_prefixes(client, bucket, os.path.join(prefix, subject))
+        return [temp_folder for temp_folder in subject_folders if 'ses-' in temp_folder]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers) as executor:
+        subject_sessions = dict(zip(subjects, executor.map(find_sessions, subjects)))
+
+    return subject_sessions
+
+
+def grab_cbrain_initialization_details(cbrain_api_token, group_name, bids_data_provider_name, session_data_providers,
+                                       cbrain_client = None):
     
-    cbrain_groups = find_cbrain_entities(cbrain_api_token, 'groups')
+    cbrain_groups = find_cbrain_entities(cbrain_api_token, 'groups', cbrain_client = cbrain_client)
     group_id = list(filter(lambda f: group_name == f['name'], cbrain_groups))
     if len(group_id) != 1:
         raise NameError('Error: Expected to find one CBRAIN Group ID corresponding with {} but found {}'.format(group_name, len(group_id)))
@@ -203,7 +528,7 @@ def grab_cbrain_initialization_details(cbrain_api_token, group_name, bids_data_p
         group_id = group_id[0]['id']
 
 
-    cbrain_dps = find_cbrain_entities(cbrain_api_token, 'data_providers')
+    cbrain_dps = find_cbrain_entities(cbrain_api_token, 'data_providers', cbrain_client = cbrain_client)
     bids_data_provider_id = list(filter(lambda f: bids_data_provider_name == f['name'], cbrain_dps))
     if len(bids_data_provider_id) != 1:
         raise NameError('Error: Expected to find one CBRAIN Data Provider ID corresponding with {} but found {}'.format(bids_data_provider_name, len(bids_data_provider_id)))
@@ -225,32 +550,449 @@ def grab_cbrain_initialization_details(cbrain_api_token, group_name, bids_data_p
     return group_id, bids_bucket, bids_dp_id, session_dps_dict
 
 
-def find_cbrain_entities(cbrain_api_token, entity_type):
+def find_cbrain_entities(cbrain_api_token, entity_type, cbrain_client = None, page_callback = None,
+                         filters = None, snapshot_path = None, snapshot_max_age_minutes = 0,
+                         snapshot_full_reconcile_hours = 24):
+    '''Grab all entities of a given type (i.e. 'userfiles', 'groups') from CBRAIN
+
+    Pages are fetched concurrently (see CbrainClient.get_all_pages),
+    and page_callback (if provided) is called with the entities from
+    each page as they arrive.
+
+    Parameters
+    ----------
+
+    cbrain_api_token : str
+        The api token generated when you logged into cbrain
+    entity_type : str
+        The type of entity to grab (i.e. 'userfiles', 'tasks')
+    cbrain_client : CbrainClient or None, default None
+        Client used to talk to CBRAIN. If None, the
+        default client from get_cbrain_client is used.
+    page_callback : None or function, default None
+        Called with the (filtered) entities from each page
+        as they arrive
+    filters : None or dict, default None
+        Attribute values that returned entities must have, such
+        as {'data_provider_id' : 710, 'type' : 'BidsSubject'}.
+        The filters are sent to CBRAIN as request parameters so
+        that only matching entities are returned. Filters are
+        always also applied client-side, so the result is the
+        same if CBRAIN ignores or rejects a filter (in which case
+        the filter will only be applied client-side from then on). A
+        filter is considered rejected if CBRAIN responds with one of
+        CBRAIN_FILTER_REJECTION_CODES. Other failed requests made
+        with filters raise requests.HTTPError.
+    snapshot_path : None or str, default None
+        If provided, entities will be grabbed through the local
+        snapshot store at this path (see sync_cbrain_snapshot).
+        page_callback is not used in this case.
+    snapshot_max_age_minutes : float, default 0
+        Passed to sync_cbrain_snapshot as max_snapshot_age_minutes
+    snapshot_full_reconcile_hours : float, default 24
+        Passed to sync_cbrain_snapshot as full_reconcile_hours
+
+    Returns
+    -------
+
+    list of dicts, one per entity
+
+    '''
+
+    if type(snapshot_path) != type(None):
+        return sync_cbrain_snapshot(cbrain_api_token, entity_type, snapshot_path, filters = filters,
+                                    max_snapshot_age_minutes = snapshot_max_age_minutes,
+                                    full_reconcile_hours = snapshot_full_reconcile_hours,
+                                    cbrain_client = cbrain_client)
+
+    cbrain_client = get_cbrain_client(cbrain_client)
+    if type(filters) == type(None):
+        filters = {}
+
+    if type(page_callback) != type(None):
+        filtered_page_callback = lambda page_entities: page_callback(filter_cbrain_entities(page_entities, filters))
+    else:
+        filtered_page_callback = None
+
+    #Push the filters that the portal is known to support into the request
+    entity_request = {'cbrain_api_token': cbrain_api_token}
+    server_filters = {}
+    for temp_key in filters.keys():
+        if (entity_type, temp_key) not in cbrain_client.unsupported_filters:
+            server_filters[temp_key] = filters[temp_key]
+    entity_request.update(server_filters)
+
+    try:
+        entities = cbrain_client.get_all_pages(entity_type, entity_request, page_callback = filtered_page_callback,
+                                               failure_message = 'User {} request failed.'.format(entity_type),
+                                               raise_on_failure = len(server_filters) > 0)
+    except requests.HTTPError as error:
+        #Fall back to an unfiltered request if the filters were rejected. Any
+        #other failure (i.e. authentication or server errors) is raised.
+        if (type(error.response) == type(None)) or (error.response.status_code not in CBRAIN_FILTER_REJECTION_CODES):
+            raise
+        print('    CBRAIN rejected the filters {} for {} ({}). Filtering client-side instead.'.format(list(server_filters.keys()), entity_type, error))
+        for temp_key in server_filters.keys():
+            cbrain_client.unsupported_filters.add((entity_type, temp_key))
+        return find_cbrain_entities(cbrain_api_token, entity_type, cbrain_client = cbrain_client,
+                                    page_callback = page_callback, filters = filters)
+
+    #Remember any filters that the portal ignored
+    for temp_key in server_filters.keys():
+        if len(filter_cbrain_entities(entities, {temp_key : server_filters[temp_key]})) != len(entities):
+            cbrain_client.unsupported_filters.add((entity_type, temp_key))
+
+    return filter_cbrain_entities(entities, filters)
+
+
+def filter_cbrain_entities(cbrain_entities, filters):
+    '''Reduce a list of CBRAIN entities to those matching all filters
+
+    Values are compared as strings, so 710 and '710' are
+    treated the same. A filter value that is a list, tuple
+    or set will accept any of the listed values.
+
+    '''
+
+    if len(filters) == 0:
+        return cbrain_entities
+
+    accepted_values = {}
+    for temp_key in filters.keys():
+        if type(filters[temp_key]) in [list, tuple, set]:
+            accepted_values[temp_key] = set([str(temp_val) for temp_val in filters[temp_key]])
+        else:
+            accepted_values[temp_key] = set([str(filters[temp_key])])
+
+    filtered_entities = []
+    for temp_entity in cbrain_entities:
+        for temp_key in accepted_values.keys():
+            if str(temp_entity.get(temp_key, None)) not in accepted_values[temp_key]:
+                break
+        else:
+            filtered_entities.append(temp_entity)
+
+    return filtered_entities
+
+def open_cbrain_snapshot(snapshot_path):
+    '''Open (and create if needed) the SQLite CBRAIN snapshot store
+
+    The store has two tables. cbrain_records has one row per
+    CBRAIN entity (i.e. userfile or task) saved as json. The
+    entities are grouped into "scopes", one for each combination
+    of portal and filters used to query CBRAIN. cbrain_syncs keeps
+    track of when each scope was last synced with CBRAIN.
+
+    Returns
+    -------
+
+    sqlite3 connection to the snapshot store
+
+    '''
+
+    connection = sqlite3.connect(snapshot_path)
+    connection.execute('''CREATE TABLE IF NOT EXISTS cbrain_records (
+                              entity_type TEXT, scope TEXT, id INTEGER,
+                              updated_at TEXT, record TEXT,
+                              PRIMARY KEY (entity_type, scope, id))''')
+    connection.execute('''CREATE TABLE IF NOT EXISTS cbrain_syncs (
+                              entity_type TEXT, scope TEXT, base_url TEXT, filters TEXT,
+                              last_sync TEXT, last_full_sync TEXT, watermark TEXT,
+                              PRIMARY KEY (entity_type, scope))''')
+    connection.commit()
+
+    return connection
+
+
+def sync_cbrain_snapshot(cbrain_api_token, entity_type, snapshot_path, filters = None,
+                         max_snapshot_age_minutes = 0, full_reconcile_hours = 24,
+                         cbrain_client = None):
+    '''Grab CBRAIN entities through a local snapshot that is updated incrementally
+
+    The snapshot is stored in a SQLite file so it can be shared
+    by several pipelines run one after another and across runs.
+    Depending on how old the snapshot is, one of three things happens:
+
+    (1) If the snapshot was synced less than max_snapshot_age_minutes
+    ago, the entities are returned from the snapshot without contacting
+    CBRAIN.
+    (2) Otherwise, if the last full sync was less than full_reconcile_hours
+    ago, only entities updated since the last sync started are requested
+    (minus CBRAIN_SNAPSHOT_WATERMARK_MARGIN_MINUTES, so that entities
+    updated during the last sync aren't missed). This asks CBRAIN for
+    entities sorted by most recent update (see CBRAIN_INCREMENTAL_SORT_PARAMS)
+    and stops at the first entity updated before then. If CBRAIN doesn't
+    return entities in that order,
+    or entities don't have an 'updated_at' field, a full sync is done
+    instead.
+    (3) Otherwise, all entities are requested (see find_cbrain_entities)
+    and the snapshot is replaced. This is the only way that entities
+    deleted in CBRAIN are removed from the snapshot.
+
+    Parameters
+    ----------
+
+    cbrain_api_token : str
+        The api token generated when you logged into cbrain
+    entity_type : str
+        The type of entity to grab (i.e. 'userfiles', 'tasks')
+    snapshot_path : str
+        Path to the SQLite snapshot file. Will be created
+        if it doesn't already exist.
+    filters : None or dict, default None
+        See find_cbrain_entities
+    max_snapshot_age_minutes : float, default 0
+        How long the snapshot can be used without checking CBRAIN.
+        The snapshot is used to decide which tasks need to be rerun,
+        so this should be kept small.
+    full_reconcile_hours : float, default 24
+        How often the snapshot is fully replaced
+    cbrain_client : CbrainClient or None, default None
+        Client used to talk to CBRAIN. If None, the
+        default client from get_cbrain_client is used.
+
+    Returns
+    -------
+
+    list of dicts, one per entity, sorted by CBRAIN ID
+
+    '''
+
+    cbrain_client = get_cbrain_client(cbrain_client)
+    if type(filters) == type(None):
+        filters = {}
+    filters_json = json.dumps(filters, sort_keys = True, default = str)
+    scope = '{} {}'.format(cbrain_client.base_url, filters_json)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    next_watermark = (now - datetime.timedelta(minutes = CBRAIN_SNAPSHOT_WATERMARK_MARGIN_MINUTES)).isoformat()
+
+    connection = open_cbrain_snapshot(snapshot_path)
+    try:
+        sync_row = connection.execute('SELECT last_sync, last_full_sync, watermark FROM cbrain_syncs WHERE entity_type = ? AND scope = ?',
+                                      (entity_type, scope)).fetchone()
+
+        sync_type = 'full'
+        if type(sync_row) != type(None):
+            snapshot_age = now - datetime.datetime.fromisoformat(sync_row[0])
+            full_sync_age = now - datetime.datetime.fromisoformat(sync_row[1])
+            if snapshot_age.total_seconds() < max_snapshot_age_minutes*60:
+                sync_type = 'none'
+            elif (full_sync_age.total_seconds() < full_reconcile_hours*3600) and (type(sync_row[2]) != type(None)):
+                sync_type = 'incremental'
+
+        if sync_type == 'incremental':
+            updated_entities = grab_recently_updated_cbrain_entities(cbrain_api_token, entity_type, sync_row[2],
+                                                                     filters = filters, cbrain_client = cbrain_client)
+            if type(updated_entities) == type(None):
+                print('    CBRAIN did not return {} sorted by update time, running a full sync of the snapshot instead.'.format(entity_type))
+                sync_type = 'full'
+            else:
+                with connection:
+                    write_cbrain_snapshot_records(connection, entity_type, scope, updated_entities)
+                    connection.execute('UPDATE cbrain_syncs SET last_sync = ?, watermark = ? WHERE entity_type = ? AND scope = ?',
+                                       (now.isoformat(), next_watermark, entity_type, scope))
+
+        if sync_type == 'full':
+            entities = find_cbrain_entities(cbrain_api_token, entity_type, cbrain_client = cbrain_client, filters = filters)
+            watermark = None
+            if len(entities) and all(['updated_at' in temp_entity for temp_entity in entities]):
+                watermark = next_watermark
+            with connection:
+                connection.execute('DELETE FROM cbrain_records WHERE entity_type = ? AND scope = ?', (entity_type, scope))
+                write_cbrain_snapshot_records(connection, entity_type, scope, entities)
+                connection.execute('INSERT OR REPLACE INTO cbrain_syncs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   (entity_type, scope, cbrain_client.base_url, filters_json, now.isoformat(), now.isoformat(), watermark))
+
+        entities = []
+        for temp_row in connection.execute('SELECT record FROM cbrain_records WHERE entity_type = ? AND scope = ? ORDER BY id',
+                                           (entity_type, scope)):
+            entities.append(json.loads(temp_row[0]))
+    finally:
+        connection.close()
+
+    return entities
+
+
+def parse_cbrain_timestamp(timestamp):
+    '''Convert a CBRAIN time (i.e. '2024-01-01T00:00:00.000Z') to a timezone aware datetime
+
+    Times without a timezone are taken to be UTC. Returns
+    None if the time can't be read.
+
+    '''
+
+    try:
+        parsed = datetime.datetime.fromisoformat(str(timestamp).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if type(parsed.tzinfo) == type(None):
+        parsed = parsed.replace(tzinfo = datetime.timezone.utc)
+    return parsed
+
+
+def grab_recently_updated_cbrain_entities(cbrain_api_token, entity_type, watermark, filters = None,
+                                          cbrain_client = None):
+    '''Grab CBRAIN entities updated at or after watermark
+
+    Used by sync_cbrain_snapshot. Pages of entities sorted by
+    most recent update are requested one at a time until an
+    entity older than watermark is found.
+
+    CBRAIN may ignore the sort parameters, so the order is checked
+    before it is relied on. Every page must be sorted by update time
+    (newest first), and a full first page must have entities with
+    different update times, otherwise the sort can't be confirmed. If
+    the whole listing fits on the first page, the sort isn't needed
+    and the entities are compared to watermark one by one. Update
+    times are compared as dates (see parse_cbrain_timestamp).
+
+    Returns
+    -------
+
+    list of dicts with the updated entities (after filtering),
+    or None if CBRAIN didn't return the entities sorted by
+    update time or the sort couldn't be confirmed (in which
+    case a full sync is needed)
+
+    '''
+
+    cbrain_client = get_cbrain_client(cbrain_client)
+    if type(filters) == type(None):
+        filters = {}
+    watermark = parse_cbrain_timestamp(watermark)
+    if type(watermark) == type(None):
+        return None
 
-    base_url = 'https://portal.cbrain.mcgill.ca'
-    tasks = []
-    tasks_request = {'cbrain_api_token': cbrain_api_token, 'page': 1, 'per_page': 1000}
+    request_data = {'cbrain_api_token' : cbrain_api_token, 'per_page' : 1000}
+    request_data.update(CBRAIN_INCREMENTAL_SORT_PARAMS)
+    for temp_key in filters.keys():
+        if (entity_type, temp_key) not in cbrain_client.unsupported_filters:
+            request_data[temp_key] = filters[temp_key]
 
+    updated_entities = []
+    previous_update = None
+    page = 1
     while True:
-        tasks_response = requests.get(
-            url = '/'.join([base_url, entity_type]),
-            data = tasks_request,
-            headers = {'Accept': 'application/json'}
-        )
-        if tasks_response.status_code != requests.codes.ok:
-            print('User tasks request failed.')
-            print(tasks_response)
-            break
-        # Collect the responses on this page then increment
-        tasks += tasks_response.json()
-        tasks_request['page'] += 1
-        # Stop requesting responses when we're at the last page
-        if len(tasks_response.json()) < tasks_request['per_page']:
-            break 
-            
-    return tasks
+        request_data['page'] = page
+        response = cbrain_client.get(entity_type, data = request_data, headers = {'Accept': 'application/json'})
+        if response.status_code != requests.codes.ok:
+            return None
+        page_entities = response.json()
+        if any('updated_at' not in temp_entity for temp_entity in page_entities):
+            return None
+        page_updates = [parse_cbrain_timestamp(temp_entity['updated_at']) for temp_entity in page_entities]
+        if any(type(temp_update) == type(None) for temp_update in page_updates):
+            return None
+        last_page = len(page_entities) < request_data['per_page']
+
+        #The entire listing was received, so the order doesn't matter
+        if (page == 1) and last_page:
+            return filter_cbrain_entities([temp_entity for temp_entity, temp_update in zip(page_entities, page_updates)
+                                           if temp_update >= watermark], filters)
+
+        #Otherwise make sure the entities really are sorted before stopping early
+        if (page == 1) and (len(set(page_updates)) < 2):
+            return None
+        for temp_update in page_updates:
+            if (type(previous_update) != type(None)) and (temp_update > previous_update):
+                return None
+            previous_update = temp_update
+
+        for temp_entity, temp_update in zip(page_entities, page_updates):
+            if temp_update < watermark:
+                return filter_cbrain_entities(updated_entities, filters)
+            updated_entities.append(temp_entity)
+        if last_page:
+            return filter_cbrain_entities(updated_entities, filters)
+        page += 1
+
+
+def write_cbrain_snapshot_records(connection, entity_type, scope, entities):
+    '''Insert or replace entities in the snapshot store (no commit is made)'''
+
+    rows = []
+    for temp_entity in entities:
+        rows.append((entity_type, scope, temp_entity['id'], str(temp_entity.get('updated_at', '')), json.dumps(temp_entity, default = str)))
+    connection.executemany('INSERT OR REPLACE INTO cbrain_records VALUES (?, ?, ?, ?, ?)', rows)
+
+    return
+
+
+def record_cbrain_snapshot_entities(snapshot_path, entity_type, entities):
+    '''Add newly created entities (i.e. submitted tasks) to the snapshot store
+
+    Each entity is added to every scope for entity_type whose
+    filters it matches, so that it will be seen before the next
+    time the snapshot is synced with CBRAIN.
+
+    '''
+
+    connection = open_cbrain_snapshot(snapshot_path)
+    try:
+        with connection:
+            sync_rows = connection.execute('SELECT scope, filters FROM cbrain_syncs WHERE entity_type = ?', (entity_type,)).fetchall()
+            for temp_scope, temp_filters in sync_rows:
+                write_cbrain_snapshot_records(connection, entity_type, temp_scope,
+                                              filter_cbrain_entities(entities, json.loads(temp_filters)))
+    finally:
+        connection.close()
+
+    return
+
+
+def describe_cbrain_snapshot(snapshot_path):
+    '''Summarize the contents of the CBRAIN snapshot store
+
+    Returns
+    -------
+
+    pandas dataframe with one row per entity type and scope,
+    with the portal, filters, sync times and number of entities
+
+    '''
+
+    connection = open_cbrain_snapshot(snapshot_path)
+    try:
+        snapshot_df = pd.read_sql_query('''SELECT s.entity_type, s.base_url, s.filters, s.last_sync, s.last_full_sync,
+                                                (SELECT COUNT(*) FROM cbrain_records r WHERE r.entity_type = s.entity_type AND r.scope = s.scope) AS num_entities
+                                         FROM cbrain_syncs s ORDER BY s.entity_type, s.scope''', connection)
+    finally:
+        connection.close()
+
+    return snapshot_df
+
 
-def grab_subject_file_info(subject_id, bids_bucket_config, bucket = 'hbcd-pilot', prefix = 'assembly_bids'):
+def invalidate_cbrain_snapshot(snapshot_path, entity_type = None):
+    '''Remove entities from the snapshot store
+
+    Parameters
+    ----------
+
+    snapshot_path : str
+        Path to the SQLite snapshot file
+    entity_type : None or str, default None
+        Only remove this type of entity (i.e. 'tasks').
+        If None, the whole snapshot is cleared.
+
+    '''
+
+    connection = open_cbrain_snapshot(snapshot_path)
+    try:
+        with connection:
+            if type(entity_type) == type(None):
+                connection.execute('DELETE FROM cbrain_records')
+                connection.execute('DELETE FROM cbrain_syncs')
+            else:
+                connection.execute('DELETE FROM cbrain_records WHERE entity_type = ?', (entity_type,))
+                connection.execute('DELETE FROM cbrain_syncs WHERE entity_type = ?', (entity_type,))
+    finally:
+        connection.close()
+
+    return
+
+
+def grab_subject_file_info(subject_id, bids_bucket_config, bucket = 'hbcd-pilot', prefix = 'assembly_bids',
+                           s3_inventory = None):
     '''Utility that grabs BIDS data for a given subject
         
     Parameters
@@ -266,6 +1008,11 @@ def grab_subject_file_info(subject_id, bids_bucket_config, bucket = 'hbcd-pilot'
     prefix: str, default 'assembly_bids'
         Where to start search (i.e. subfolder)
         within the bucket
+    s3_inventory: None or dict, default None
+        Inventory generated by build_s3_inventory. If
+        provided (and it covers the same bucket/prefix),
+        the subject's files will be taken from the
+        inventory instead of listing the bucket again.
         
     Returns
     -------
@@ -275,7 +1022,10 @@ def grab_subject_file_info(subject_id, bids_bucket_config, bucket = 'hbcd-pilot'
         
     '''
 
-
+    #Serve the request from the inventory if one was already built
+    if type(s3_inventory) != type(None):
+        if (s3_inventory['bucket'] == bucket) and (s3_inventory['prefix'] == prefix):
+            return list(s3_inventory['subjects'].get(subject_id, []))
     
     # Do some cosmetics we look for the subject ID at the
     # right level
@@ -296,116 +1046,560 @@ def grab_subject_file_info(subject_id, bids_bucket_config, bucket = 'hbcd-pilot'
     return subject_files
 
 
-def create_page_iterator(bucket = 'hbcd-pilot', prefix = 'derivatives', bucket_config = False, return_client_instead = False):
-    '''Utility to create a page iterator for s3 bucket'''
-    
-    #Grab config path
-    if bucket_config == False:
-        config_path = ''
-    else:
-        if type(bucket_config) != str:
-            raise NameError('Error: different config path should eithe be string or boolean')
-        else:
-            config_path = bucket_config
-            
-    #Find info from config file    
-    with open(config_path, 'r') as f:
-        lines = f.read().splitlines()
-        for temp_line in lines:
-            if 'access_key' == temp_line[:10]:
-                access_key = temp_line.split('=')[-1].strip()
-            if 'secret_key' == temp_line[:10]:
-                secret_key = temp_line.split('=')[-1].strip()
-            if 'host_base' == temp_line[:9]:
-                host_base = temp_line.split('=')[-1].strip()
-                if 'https' != host_base[:5]:
-                    host_base = 'https://' + host_base
-        
-    #Create s3 client
-    client = boto3.client(
-        's3',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        endpoint_url =host_base
-    )
-
-    del access_key, secret_key, host_base
-    
-    if return_client_instead:
-        return client
-        
-    # Create a reusable Paginator
-    paginator = client.get_paginator('list_objects')
-        
-    # Create a PageIterator from the Paginator
-    page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix)
-    
-    return page_iterator
-
-
-def upload_processing_config_log(file_name, bucket = 'hbcd-cbrain-test', prefix = 'cbrain_misc/cbrain_processing_configuration_logs', bucket_config = False):
-    """Upload a CBRAIN CSV File to S3 Bucket
+def build_s3_inventory(bids_bucket_config, bucket = 'hbcd-pilot', prefix = 'assembly_bids',
+                       listing_cache_path = None, max_subject_age_hours = 2):
+    '''Build an in-memory index of every BIDS object under a prefix
 
-    This function will upload an already generated
-    CBRAIN CSV File (i.e. extended file list) to
-    the desired bucket. Then it can later be registered
-    in CBRAIN and used to run processing.
+    Lists the BIDS prefix once and groups all objects by subject
+    and by session so that the per-subject/per-session lookups
+    done during processing don't need to go back to S3.
 
     Parameters
     ----------
-    file_name : str
-        The name of the file to upload
-    bucket : str, default 'hbcd-cbrain-test'
-        The name of the bucket to upload to
-    prefix : str, default 'cbrain_misc/cbrain_csvs'
-        The prefix to use for the file in the bucket
-    bids_bucket_config : str, default False
-        The path to the config file for the s3 bucket
-        If False, then the default config file will be used.
-        If a string, then that string will be used as the
-        path to the config file.
+
+    bids_bucket_config : str
+        This will be used as a config file to identify
+        the s3 credentials
+    bucket : str, default 'hbcd-pilot'
+        Name of bucket to query
+    prefix : str, default 'assembly_bids'
+        Where to start search (i.e. subfolder)
+        within the bucket
+    listing_cache_path : None or str, default None
+        If provided, the inventory will be built from a
+        persistent SQLite listing cache stored at this path.
+        The cache is refreshed first (see refresh_s3_listing_cache)
+        so that only new or stale subjects are listed in S3.
+    max_subject_age_hours : float, default 2
+        Only used with listing_cache_path. Subjects whose
+        cached listing is older than this will be listed again
+        (see refresh_s3_listing_cache for what can be missed
+        before then).
 
     Returns
     -------
-    bool
-        True if file was uploaded successfully,
-        False if not.
-    """
 
-    
-    #Grab config path
-    if bucket_config == False:
-        config_path = ''
-    else:
-        if type(bucket_config) != str:
-            raise NameError('Error: different config path should eithe be string or boolean')
-        else:
-            config_path = bucket_config
-            
-    #Find info from config file    
-    with open(config_path, 'r') as f:
-        lines = f.read().splitlines()
-        for temp_line in lines:
-            if 'access_key' == temp_line[:10]:
-                access_key = temp_line.split('=')[-1].strip()
-            if 'secret_key' == temp_line[:10]:
-                secret_key = temp_line.split('=')[-1].strip()
-            if 'host_base' == temp_line[:9]:
-                host_base = temp_line.split('=')[-1].strip()
-                if 'https' != host_base[:5]:
-                    host_base = 'https://' + host_base
-        
-    #Create s3 client
-    client = boto3.client(
-        's3',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        endpoint_url =host_base
-    )
+    s3_inventory : dict
+        Dictionary with the following keys:
+        'bucket' and 'prefix' - the location that was listed,
+        'prefix_parts' - the folders of prefix (see s3_prefix_parts),
+        'session_level' - the index of the session folder
+        within a '/' split object key,
+        'subjects' - dictionary mapping each subject (i.e. 'sub-1234')
+        to the list of object dictionaries (Key, Size, LastModified,
+        ETag) found for that subject, in key order,
+        'sessions' - dictionary mapping each subject to a dictionary
+        that maps session folders (i.e. 'ses-V02') to the object
+        dictionaries found under that session.
 
-    del access_key, secret_key, host_base
+    '''
 
-    object_name = os.path.join(prefix, os.path.basename(file_name))
+    if type(listing_cache_path) != type(None):
+        refresh_summary = refresh_s3_listing_cache(listing_cache_path, bids_bucket_config, bucket = bucket, prefix = prefix,
+                                                   max_subject_age_hours = max_subject_age_hours)
+        print('S3 listing cache refreshed ({} new, {} relisted ({} changed), {} removed, {} unchanged subjects)'.format(refresh_summary['new'],
+              refresh_summary['refreshed'], refresh_summary['changed'], refresh_summary['removed'], refresh_summary['unchanged']))
+        return load_s3_inventory_from_cache(listing_cache_path, bucket = bucket, prefix = prefix)
+
+    #Figure out where the subject and session live in
+    #the object keys
+    prefix_parts = s3_prefix_parts(prefix)
+    session_level = len(prefix_parts) + 1
+
+    s3_inventory = {'bucket' : bucket,
+                    'prefix' : prefix,
+                    'prefix_parts' : prefix_parts,
+                    'session_level' : session_level,
+                    'subjects' : {},
+                    'sessions' : {}}
+
+    # Create a PageIterator, limiting the listing to the study folder. The
+    # trailing '/' keeps folders like 'assembly_bids_old' out of the listing.
+    list_prefix = '/'.join(prefix_parts) + '/' if len(prefix_parts) else ''
+    page_iterator = create_page_iterator(bucket = bucket, prefix = list_prefix, bucket_config = bids_bucket_config)
+    for page in page_iterator:
+        if page.get('Contents', None):
+            for temp_dict in page['Contents']:
+                add_object_to_s3_inventory(s3_inventory, temp_dict)
+
+    return s3_inventory
+
+
+def s3_prefix_parts(prefix):
+    '''Split a prefix (i.e. 'assembly_bids' or 'study/assembly_bids/') into its folders'''
+
+    prefix = prefix.strip('/')
+    if len(prefix) == 0:
+        return []
+    return prefix.split('/')
+
+
+def add_object_to_s3_inventory(s3_inventory, object_dict):
+    '''Add a single S3 object dictionary to an inventory from build_s3_inventory
+
+    Only the Key, Size, LastModified, and ETag fields are kept.
+    Objects that don't live under a 'sub-*' folder of the
+    inventory's prefix are ignored.
+
+    '''
+
+    key_split = object_dict['Key'].split('/')
+    subject_level = s3_inventory['session_level'] - 1
+    if len(key_split) <= subject_level + 1:
+        return
+    if key_split[:subject_level] != s3_inventory['prefix_parts']:
+        return
+    subject = key_split[subject_level]
+    if 'sub-' not in subject:
+        return
+
+    file_info = {'Key' : object_dict['Key'],
+                 'Size' : object_dict.get('Size', None),
+                 'LastModified' : object_dict.get('LastModified', None),
+                 'ETag' : object_dict.get('ETag', None)}
+
+    s3_inventory['subjects'].setdefault(subject, []).append(file_info)
+    subject_sessions = s3_inventory['sessions'].setdefault(subject, {})
+    if len(key_split) > s3_inventory['session_level'] + 1:
+        subject_sessions.setdefault(key_split[s3_inventory['session_level']], []).append(file_info)
+
+    return
+
+
+def list_s3_common_prefixes(client, bucket, prefix):
+    '''Find the "folders" directly underneath a prefix in S3
+
+    Uses a delimiter listing so that only one entry is returned
+    per folder, regardless of how many objects live in the folder.
+
+    Parameters
+    ----------
+
+    client : boto3 client
+        Client used to query the bucket
+    bucket : str
+        Name of bucket to query
+    prefix : str
+        The folder to look underneath (i.e. 'assembly_bids')
+
+    Returns
+    -------
+
+    List of folder names (i.e. ['sub-1', 'sub-2']) found
+    directly underneath the prefix
+
+    '''
+
+    if len(prefix) and (prefix[-1] != '/'):
+        prefix = prefix + '/'
+
+    paginator = client.get_paginator('list_objects_v2')
+    page_iterator = paginator.paginate(Bucket = bucket, Prefix = prefix, Delimiter = '/')
+
+    folders = []
+    for page in page_iterator:
+        for temp_prefix in page.get('CommonPrefixes', []):
+            folders.append(temp_prefix['Prefix'][len(prefix):].rstrip('/'))
+
+    return folders
+
+
+def open_s3_listing_cache(listing_cache_path):
+    '''Open (and create if needed) the SQLite S3 listing cache
+
+    The cache has two tables. s3_subjects has one row per
+    subject that has been listed, along with when it was
+    listed. s3_objects has one row per object found for
+    those subjects.
+
+    Returns
+    -------
+
+    sqlite3 connection to the cache
+
+    '''
+
+    connection = sqlite3.connect(listing_cache_path)
+    connection.execute('''CREATE TABLE IF NOT EXISTS s3_subjects (
+                              bucket TEXT, prefix TEXT, subject TEXT,
+                              listed_at TEXT, num_objects INTEGER,
+                              PRIMARY KEY (bucket, prefix, subject))''')
+    connection.execute('''CREATE TABLE IF NOT EXISTS s3_objects (
+                              bucket TEXT, prefix TEXT, subject TEXT, key TEXT,
+                              size INTEGER, last_modified TEXT, etag TEXT,
+                              PRIMARY KEY (bucket, prefix, key))''')
+    connection.execute('''CREATE INDEX IF NOT EXISTS s3_objects_subject
+                              ON s3_objects (bucket, prefix, subject)''')
+    connection.commit()
+
+    return connection
+
+
+def session_scans_tsv_key(subject_prefix, session):
+    '''Key of the scans.tsv file of a session (i.e. 'assembly_bids/sub-1/ses-V02/sub-1_ses-V02_scans.tsv')'''
+
+    subject = subject_prefix.rstrip('/').split('/')[-1]
+    return '{}{}/{}_{}_scans.tsv'.format(subject_prefix, session, subject, session)
+
+
+def add_to_s3_subject_summary(subject_summary, subject_prefix, key, size, etag):
+    '''Add an object to a summary made by summarize_s3_subject_folder'''
+
+    relative_key = key[len(subject_prefix):]
+    if '/' in relative_key:
+        session = relative_key.split('/')[0]
+        subject_summary[0].add(session)
+        if key == session_scans_tsv_key(subject_prefix, session):
+            subject_summary[2][key] = etag
+    else:
+        subject_summary[1][key] = (size, etag)
+
+
+def summarize_s3_subject_folder(client, bucket, subject_prefix):
+    '''Summarize a subject folder with a delimiter listing
+
+    Used by refresh_s3_listing_cache to check if a subject changed.
+    After the delimiter listing, the ETag of the scans.tsv file of
+    each session is looked up (see session_scans_tsv_key).
+
+    Returns
+    -------
+
+    tuple of (set of the folders directly under subject_prefix (i.e. sessions),
+    dictionary mapping the keys of the files directly under subject_prefix
+    to their (Size, ETag), dictionary mapping the key of each session's
+    scans.tsv file to its ETag (sessions without one are left out))
+
+    '''
+
+    subject_summary = (set(), {}, {})
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket = bucket, Prefix = subject_prefix, Delimiter = '/'):
+        for temp_prefix in page.get('CommonPrefixes', []):
+            subject_summary[0].add(temp_prefix['Prefix'][len(subject_prefix):].rstrip('/'))
+        for temp_object in page.get('Contents', []):
+            add_to_s3_subject_summary(subject_summary, subject_prefix, temp_object['Key'], temp_object['Size'], temp_object['ETag'])
+
+    for temp_session in sorted(subject_summary[0]):
+        scans_tsv_key = session_scans_tsv_key(subject_prefix, temp_session)
+        try:
+            subject_summary[2][scans_tsv_key] = client.head_object(Bucket = bucket, Key = scans_tsv_key)['ETag']
+        except ClientError:
+            continue
+
+    return subject_summary
+
+
+def refresh_s3_listing_cache(listing_cache_path, bids_bucket_config, bucket = 'hbcd-pilot',
+                             prefix = 'assembly_bids', max_subject_age_hours = 2,
+                             full_refresh = False, max_workers = 8, detect_changes = True):
+    '''Bring the SQLite S3 listing cache up to date
+
+    The subjects currently in the bucket are found with a
+    single delimiter listing. Subjects that are new, or that
+    were last listed more than max_subject_age_hours ago, are
+    listed again, and their cached objects are replaced with
+    what is now in S3. Subjects that no longer exist in S3 are
+    removed from the cache.
+
+    If detect_changes is True, every other subject is checked with a
+    delimiter listing of its folder plus a head request for the scans.tsv
+    file of each session (see summarize_s3_subject_folder), and is listed
+    again if its session folders, the files directly under the subject
+    folder (i.e. sessions.tsv) or the ETag of any scans.tsv file differ
+    from the cache. This catches new or deleted sessions, and files that
+    are added or replaced inside of a session as long as the session's
+    scans.tsv is rewritten along with them (which is how BIDS data is
+    normally updated). Files that change without scans.tsv changing are
+    only seen once the subject's listing is older than max_subject_age_hours,
+    so keep max_subject_age_hours short (i.e. a few hours, enough to share
+    the listing between the pipelines launched in one sitting), or set it
+    to 0 to always relist, unless that staleness is acceptable.
+
+    Parameters
+    ----------
+
+    listing_cache_path : str
+        Path to the SQLite file used to store the cache. Will
+        be created if it doesn't already exist.
+    bids_bucket_config : str
+        This will be used as a config file to identify
+        the s3 credentials
+    bucket : str, default 'hbcd-pilot'
+        Name of bucket to query
+    prefix : str, default 'assembly_bids'
+        The study folder within the bucket
+    max_subject_age_hours : float, default 2
+        Subjects whose cached listing is older than this
+        will be listed again. Set to 0 to relist every
+        subject (equivalent to full_refresh = True).
+    full_refresh : bool, default False
+        If True, relist every subject
+    max_workers : int, default 8
+        Number of subjects to list (or check) at the same time
+    detect_changes : bool, default True
+        If True, check subjects whose cached listing is not too
+        old for new/removed sessions and scans.tsv changes (see above)
+
+    Returns
+    -------
+
+    dict
+        Counts of subjects that were 'new', 'refreshed' (listed
+        again, including the subjects in 'changed'), 'changed'
+        (listed again because detect_changes found a difference),
+        'removed', or served from the cache ('unchanged'), along
+        with the number of objects whose size, date, or ETag
+        changed ('changed_objects').
+
+    '''
+
+    client = create_boto3_client(s3_config = bids_bucket_config)
+    s3_subjects = [temp_subject for temp_subject in list_s3_common_prefixes(client, bucket, prefix) if 'sub-' in temp_subject]
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    connection = open_s3_listing_cache(listing_cache_path)
+    try:
+        cached_subjects = dict(connection.execute('SELECT subject, listed_at FROM s3_subjects WHERE bucket = ? AND prefix = ?',
+                                                  (bucket, prefix)).fetchall())
+
+        #Figure out who needs to be (re)listed
+        refresh_summary = {'new' : 0, 'refreshed' : 0, 'changed' : 0, 'removed' : 0, 'unchanged' : 0, 'changed_objects' : 0}
+        subjects_to_list = []
+        subjects_to_check = []
+        for temp_subject in s3_subjects:
+            if temp_subject not in cached_subjects:
+                refresh_summary['new'] += 1
+                subjects_to_list.append(temp_subject)
+                continue
+            subject_age = now - datetime.datetime.fromisoformat(cached_subjects[temp_subject])
+            if full_refresh or (subject_age.total_seconds() >= max_subject_age_hours*3600):
+                refresh_summary['refreshed'] += 1
+                subjects_to_list.append(temp_subject)
+            elif detect_changes:
+                subjects_to_check.append(temp_subject)
+            else:
+                refresh_summary['unchanged'] += 1
+
+        #Relist the subjects whose session folders, subject level
+        #files or scans.tsv files don't match what is in the cache
+        if len(subjects_to_check):
+            cached_summaries = {temp_subject : (set(), {}, {}) for temp_subject in subjects_to_check}
+            for temp_row in connection.execute('SELECT subject, key, size, etag FROM s3_objects WHERE bucket = ? AND prefix = ?',
+                                               (bucket, prefix)):
+                if temp_row[0] in cached_summaries:
+                    add_to_s3_subject_summary(cached_summaries[temp_row[0]], os.path.join(prefix, temp_row[0]) + '/',
+                                              temp_row[1], temp_row[2], temp_row[3])
+
+            def check_subject(subject):
+                return subject, summarize_s3_subject_folder(client, bucket, os.path.join(prefix, subject) + '/')
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers) as executor:
+                for temp_subject, subject_summary in executor.map(check_subject, subjects_to_check):
+                    if subject_summary != cached_summaries[temp_subject]:
+                        refresh_summary['refreshed'] += 1
+                        refresh_summary['changed'] += 1
+                        subjects_to_list.append(temp_subject)
+                    else:
+                        refresh_summary['unchanged'] += 1
+
+        removed_subjects = set(cached_subjects.keys()) - set(s3_subjects)
+        refresh_summary['removed'] = len(removed_subjects)
+        with connection:
+            for temp_subject in removed_subjects:
+                connection.execute('DELETE FROM s3_objects WHERE bucket = ? AND prefix = ? AND subject = ?', (bucket, prefix, temp_subject))
+                connection.execute('DELETE FROM s3_subjects WHERE bucket = ? AND prefix = ? AND subject = ?', (bucket, prefix, temp_subject))
+
+        def list_subject(subject):
+            subject_prefix = os.path.join(prefix, subject) + '/'
+            paginator = client.get_paginator('list_objects_v2')
+            subject_objects = []
+            for page in paginator.paginate(Bucket = bucket, Prefix = subject_prefix):
+                subject_objects.extend(page.get('Contents', []))
+            return subject, subject_objects
+
+        #List subjects in parallel, but keep all database writes in this thread
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers) as executor:
+            for temp_subject, subject_objects in executor.map(list_subject, subjects_to_list):
+                previous_objects = {}
+                for temp_row in connection.execute('SELECT key, size, last_modified, etag FROM s3_objects WHERE bucket = ? AND prefix = ? AND subject = ?',
+                                                   (bucket, prefix, temp_subject)):
+                    previous_objects[temp_row[0]] = temp_row[1:]
+                new_rows = []
+                for temp_dict in subject_objects:
+                    last_modified = temp_dict['LastModified'].isoformat()
+                    new_rows.append((bucket, prefix, temp_subject, temp_dict['Key'], temp_dict['Size'], last_modified, temp_dict['ETag']))
+                    if previous_objects.pop(temp_dict['Key'], None) != (temp_dict['Size'], last_modified, temp_dict['ETag']):
+                        refresh_summary['changed_objects'] += 1
+                refresh_summary['changed_objects'] += len(previous_objects)
+                with connection:
+                    connection.execute('DELETE FROM s3_objects WHERE bucket = ? AND prefix = ? AND subject = ?', (bucket, prefix, temp_subject))
+                    connection.executemany('INSERT INTO s3_objects VALUES (?, ?, ?, ?, ?, ?, ?)', new_rows)
+                    connection.execute('INSERT OR REPLACE INTO s3_subjects VALUES (?, ?, ?, ?, ?)',
+                                       (bucket, prefix, temp_subject, now.isoformat(), len(new_rows)))
+    finally:
+        connection.close()
+
+    return refresh_summary
+
+
+def load_s3_inventory_from_cache(listing_cache_path, bucket = 'hbcd-pilot', prefix = 'assembly_bids'):
+    '''Build an S3 inventory (see build_s3_inventory) from the listing cache
+
+    No S3 requests are made. Use refresh_s3_listing_cache
+    first to make sure the cache is up to date.
+
+    '''
+
+    prefix_parts = s3_prefix_parts(prefix)
+    s3_inventory = {'bucket' : bucket,
+                    'prefix' : prefix,
+                    'prefix_parts' : prefix_parts,
+                    'session_level' : len(prefix_parts) + 1,
+                    'subjects' : {},
+                    'sessions' : {}}
+
+    connection = open_s3_listing_cache(listing_cache_path)
+    try:
+        rows = connection.execute('SELECT key, size, last_modified, etag FROM s3_objects WHERE bucket = ? AND prefix = ? ORDER BY key',
+                                  (bucket, prefix))
+        for temp_row in rows:
+            add_object_to_s3_inventory(s3_inventory, {'Key' : temp_row[0], 'Size' : temp_row[1],
+                                                      'LastModified' : datetime.datetime.fromisoformat(temp_row[2]),
+                                                      'ETag' : temp_row[3]})
+    finally:
+        connection.close()
+
+    return s3_inventory
+
+
+def describe_s3_listing_cache(listing_cache_path):
+    '''Summarize the contents of the S3 listing cache
+
+    Returns
+    -------
+
+    pandas dataframe with one row per cached subject, with
+    the bucket, prefix, subject, when the subject was last
+    listed, and the number of objects cached for the subject
+
+    '''
+
+    connection = open_s3_listing_cache(listing_cache_path)
+    try:
+        cache_df = pd.read_sql_query('SELECT bucket, prefix, subject, listed_at, num_objects FROM s3_subjects ORDER BY bucket, prefix, subject', connection)
+    finally:
+        connection.close()
+
+    return cache_df
+
+
+def invalidate_s3_listing_cache(listing_cache_path, bucket = None, prefix = None, subjects = None):
+    '''Remove entries from the S3 listing cache
+
+    Any entries that match all of the provided arguments are
+    removed, and will be listed again the next time
+    refresh_s3_listing_cache is called. With no arguments, the
+    whole cache is cleared.
+
+    Parameters
+    ----------
+
+    listing_cache_path : str
+        Path to the SQLite cache file
+    bucket : None or str, default None
+        Only invalidate entries from this bucket
+    prefix : None or str, default None
+        Only invalidate entries from this prefix
+    subjects : None or list of str, default None
+        Only invalidate these subjects (i.e. ['sub-1'])
+
+    Returns
+    -------
+
+    int
+        The number of subjects that were invalidated
+
+    '''
+
+    conditions = []
+    values = []
+    if type(bucket) != type(None):
+        conditions.append('bucket = ?')
+        values.append(bucket)
+    if type(prefix) != type(None):
+        conditions.append('prefix = ?')
+        values.append(prefix)
+    if type(subjects) != type(None):
+        conditions.append('subject IN ({})'.format(', '.join(['?']*len(subjects))))
+        values.extend(subjects)
+    where_clause = ''
+    if len(conditions):
+        where_clause = ' WHERE ' + ' AND '.join(conditions)
+
+    connection = open_s3_listing_cache(listing_cache_path)
+    try:
+        with connection:
+            connection.execute('DELETE FROM s3_objects' + where_clause, values)
+            num_invalidated = connection.execute('DELETE FROM s3_subjects' + where_clause, values).rowcount
+    finally:
+        connection.close()
+
+    return num_invalidated
+
+
+def create_page_iterator(bucket = 'hbcd-pilot', prefix = 'derivatives', bucket_config = False, return_client_instead = False):
+    '''Utility to create a page iterator for s3 bucket'''
+    
+    #Grab the shared client for this config file
+    client = create_boto3_client(s3_config = bucket_config)
+    
+    if return_client_instead:
+        return client
+        
+    # Create a reusable Paginator
+    paginator = client.get_paginator('list_objects')
+        
+    # Create a PageIterator from the Paginator
+    page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix)
+    
+    return page_iterator
+
+
+def upload_processing_config_log(file_name, bucket = 'hbcd-cbrain-test', prefix = 'cbrain_misc/cbrain_processing_configuration_logs', bucket_config = False):
+    """Upload a CBRAIN CSV File to S3 Bucket
+
+    This function will upload an already generated
+    CBRAIN CSV File (i.e. extended file list) to
+    the desired bucket. Then it can later be registered
+    in CBRAIN and used to run processing.
+
+    Parameters
+    ----------
+    file_name : str
+        The name of the file to upload
+    bucket : str, default 'hbcd-cbrain-test'
+        The name of the bucket to upload to
+    prefix : str, default 'cbrain_misc/cbrain_csvs'
+        The prefix to use for the file in the bucket
+    bids_bucket_config : str, default False
+        The path to the config file for the s3 bucket
+        If False, then the default config file will be used.
+        If a string, then that string will be used as the
+        path to the config file.
+
+    Returns
+    -------
+    bool
+        True if file was uploaded successfully,
+        False if not.
+    """
+
+    
+    #Grab the shared client for this config file
+    client = create_boto3_client(s3_config = bucket_config)
+
+    object_name = os.path.join(prefix, os.path.basename(file_name))
 
     # Upload the file
     try:
@@ -418,7 +1612,8 @@ def upload_processing_config_log(file_name, bucket = 'hbcd-cbrain-test', prefix
 
 def grab_session_specific_file_info(all_subject_files, session,
                                 session_agnostic_files = ['sessions.tsv'],
-                                session_level = None):
+                                session_level = None, s3_inventory = None,
+                                subject_id = None):
     '''Function that reduces list of S3 files to those from specific subject session
     
     Parameters
@@ -438,9 +1633,29 @@ def grab_session_specific_file_info(all_subject_files, session,
         it will assume that there is organization such as /study/subject/ses/...
         and it will only accept files where the ses is found at that specific
         location (2 is like 3 here because of zero indexing)
+    s3_inventory: None or dict, default None
+        Inventory generated by build_s3_inventory. If provided
+        along with subject_id and a session_level matching the
+        inventory, the session specific files will be taken
+        from the inventory's session index.
+    subject_id: None or str, default None
+        The subject (i.e. 'sub-1234') that all_subject_files
+        belongs to. Only used with s3_inventory.
     
     '''
     
+    #Use the session index from the inventory when possible. Session
+    #agnostic files are still searched for in all_subject_files, and
+    #the output keeps the same (key sorted) ordering as below.
+    if (type(s3_inventory) != type(None)) and (type(subject_id) != type(None)):
+        if session_level == s3_inventory['session_level']:
+            session_files = list(s3_inventory['sessions'].get(subject_id, {}).get(session, []))
+            for temp_file in all_subject_files:
+                for temp_agnostic in session_agnostic_files:
+                    if temp_agnostic in temp_file['Key']:
+                        session_files.append(temp_file)
+            session_files.sort(key = lambda f: f['Key'])
+            return session_files
 
     if type(session_level) == type(None):
         if session[0] != '/':
@@ -519,91 +1734,306 @@ def download_scans_tsv_file(bucket_config, output_folder, subject, session, bids
             
     return downloaded_file
 
-def create_boto3_client(s3_config = None):
-    '''Utility to create a boto3 client
-    
+def fetch_scans_tsv_file(bucket_config, subject, session, bids_prefix = 'assembly_bids', bucket = 'hbcd-pilot',
+                         etag = None, client = None):
+    '''Load the scans.tsv file for a given subject/session into memory
+
+    The file is read directly from S3 (no local copy is made) and
+    parsed into a DataFrame. Parsed files are cached in memory based
+    on their ETag, so a file that has not changed is only parsed once
+    (up to SCANS_TSV_CACHE_MAX_FILES files are kept).
+
     Parameters
     ----------
-    
-    s3_config : str or None, default None
-        Path to s3 configuration file
-        
+
+    bucket_config : str
+        This will be used as a config file to identify
+        the s3 credentials
+    subject : str
+        Name of subject
+    session : str
+        Name of session
+    bids_prefix : str, default 'assembly_bids'
+        The path to the BIDS study directory
+    bucket : str, default 'hbcd-pilot'
+        The bucket where the file is
+    etag : None or str, default None
+        ETag of the file if already known (i.e. from an S3
+        inventory). When provided, a cached copy of the file
+        will be used without contacting S3.
+    client : existing boto3 client, or None, default None
+        Option to use an existing boto3 client instead
+        of the shared one
+
     Returns
     -------
-    
-    boto3 client
-    
+
+    DataFrame with the contents of the scans.tsv file (indexed
+    by index_qc_df), or None if the file doesn't exist. Other
+    errors from S3 are raised. The ETag of the file is stored
+    under df.attrs['qc_version'].
+
     '''
-    
-    #Grab config path
-    if s3_config == False:
-        config_path = ''
-    else:
-        if type(s3_config) != str:
-            raise NameError('Error: different config path should eithe be string or boolean')
-        else:
-            config_path = s3_config
-            
-    #Find info from config file    
-    with open(config_path, 'r') as f:
-        lines = f.read().splitlines()
-        for temp_line in lines:
-            if 'access_key' == temp_line[:10]:
-                access_key = temp_line.split('=')[-1].strip()
-            if 'secret_key' == temp_line[:10]:
-                secret_key = temp_line.split('=')[-1].strip()
-            if 'host_base' == temp_line[:9]:
-                host_base = temp_line.split('=')[-1].strip()
-                if 'https' != host_base[:5]:
-                    host_base = 'https://' + host_base
-        
-    #Create s3 client
-    client = boto3.client(
-        's3',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        endpoint_url =host_base
-    )
-    
-    return client
 
-def cbrain_mark_as_newer(file_id, cbrain_api_token):
-    '''Mark file as newer on CBRAIN
-    
-    If a file is cached in cbrain, you can call
-    this function to make sure the cache is updated
-    before the file is used in any upcoming processing.
-    This means the file will be re-downloaded from the
-    data provider where the file lives. If mark as newer
-    has already been called then CBRAIN will say 0 files
-    were marked as newer. This same behavior is also
-    observed in the case where the file is on the data
-    provider but not yet cached on the system where processing
-    occurs.
-    
+    file_to_load = os.path.join(bids_prefix, subject, session, '{}_{}_scans.tsv'.format(subject,session))
+    if type(etag) != type(None):
+        with _scans_tsv_cache_lock:
+            if (bucket, file_to_load, etag) in _scans_tsv_cache:
+                _scans_tsv_cache.move_to_end((bucket, file_to_load, etag))
+                return _scans_tsv_cache[(bucket, file_to_load, etag)]
+
+    if type(client) == type(None):
+        client = create_boto3_client(s3_config = bucket_config)
+    try:
+        response = client.get_object(Bucket = bucket, Key = file_to_load)
+        contents = response['Body'].read()
+    except ClientError as error:
+        if error.response.get('Error', {}).get('Code') in S3_MISSING_OBJECT_CODES:
+            return None
+        raise
+
+    etag = response['ETag']
+    qc_df = index_qc_df(pd.read_csv(BytesIO(contents), delimiter = '\t', na_values=['_NaN_', '_Inf_']))
+    qc_df.attrs['qc_version'] = etag
+    with _scans_tsv_cache_lock:
+        _scans_tsv_cache[(bucket, file_to_load, etag)] = qc_df
+        _scans_tsv_cache.move_to_end((bucket, file_to_load, etag))
+        while len(_scans_tsv_cache) > SCANS_TSV_CACHE_MAX_FILES:
+            _scans_tsv_cache.popitem(last = False)
+
+    return qc_df
+
+
+def prefetch_scans_tsv_files(bucket_config, subject_sessions, bids_prefix = 'assembly_bids', bucket = 'hbcd-pilot',
+                             s3_inventory = None, max_workers = 16):
+    '''Load the scans.tsv files for many subject/sessions at once
+
+    See fetch_scans_tsv_file for details about how each file is loaded.
+    Files are loaded concurrently.
+
     Parameters
     ----------
-    file_id : str
-        The id of the CBRAIN file that
-        should be "marked as newer"
-    cbrain_api_token : str
-        The api token generated when you logged into cbrain
 
-    '''    
-    
-    data = {
-              "file_ids": [file_id],
-              "operation": "all_newer",
-            }
-    
-    
-    base_url = 'https://portal.cbrain.mcgill.ca'
-    task_params = (
-        ('cbrain_api_token', cbrain_api_token),
+    bucket_config : str
+        This will be used as a config file to identify
+        the s3 credentials
+    subject_sessions : list of tuples
+        (subject, session) pairs whose scans.tsv should be loaded
+        (i.e. [('sub-1', 'ses-V02')])
+    bids_prefix : str, default 'assembly_bids'
+        The path to the BIDS study directory
+    bucket : str, default 'hbcd-pilot'
+        The bucket where the files are
+    s3_inventory : None or dict, default None
+        Inventory generated by build_s3_inventory. If provided
+        (and made for the same bucket/prefix), files missing from
+        the inventory will not be requested, and the ETags from the
+        inventory will be used to find cached copies of the files.
+    max_workers : int, default 16
+        The number of files to load at the same time
+        (see map_with_workers)
+
+    Returns
+    -------
+
+    dict
+        Dictionary whose keys are (subject, session) pairs and whose
+        values are the output of fetch_scans_tsv_file (DataFrame or None)
+
+    '''
+
+    if type(s3_inventory) != type(None):
+        if (s3_inventory['bucket'] != bucket) or (s3_inventory['prefix'] != bids_prefix):
+            s3_inventory = None
+
+    scans_tsv_files = {}
+    to_fetch = []
+    for subject, session in set(subject_sessions):
+        if type(s3_inventory) == type(None):
+            to_fetch.append((subject, session, None))
+            continue
+        file_to_load = os.path.join(bids_prefix, subject, session, '{}_{}_scans.tsv'.format(subject,session))
+        etag = None
+        for temp_file in s3_inventory['sessions'].get(subject, {}).get(session, []):
+            if temp_file['Key'] == file_to_load:
+                etag = temp_file['ETag']
+                break
+        if type(etag) == type(None):
+            scans_tsv_files[(subject, session)] = None
+        else:
+            to_fetch.append((subject, session, etag))
+
+    client = create_boto3_client(s3_config = bucket_config)
+    def fetch(subject_session_etag):
+        subject, session, etag = subject_session_etag
+        return fetch_scans_tsv_file(bucket_config, subject, session, bids_prefix = bids_prefix,
+                                    bucket = bucket, etag = etag, client = client)
+
+    for temp_fetch, qc_df in zip(to_fetch, map_with_workers(fetch, to_fetch, max_workers = max_workers)):
+        scans_tsv_files[(temp_fetch[0], temp_fetch[1])] = qc_df
+
+    return scans_tsv_files
+
+
+def map_with_workers(function, items, max_workers = 16):
+    '''Return [function(item) for item in items], using up to max_workers threads
+
+    If max_workers is 1, the items are handled one at a time in the
+    calling thread without starting a thread pool (this is how
+    update_processing_async runs the prefetch helpers, see
+    AsyncBackendLimits).
+
+    '''
+
+    if max_workers <= 1:
+        return [function(temp_item) for temp_item in items]
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers) as executor:
+        return list(executor.map(function, items))
+
+
+def grab_s3_config_path(s3_config):
+    '''Utility to validate the path to an s3 configuration file'''
+
+    if s3_config == False:
+        return ''
+    elif type(s3_config) != str:
+        raise NameError('Error: different config path should eithe be string or boolean')
+    else:
+        return s3_config
+
+
+@functools.lru_cache(maxsize = None)
+def parse_s3_config(config_path):
+    '''Read the credentials from an s3cmd style configuration file
+
+    The file is only read the first time a given path is
+    requested, after which the parsed values are reused.
+
+    Parameters
+    ----------
+
+    config_path : str
+        Path to s3 configuration file
+
+    Returns
+    -------
+
+    access_key : str
+    secret_key : str
+    host_base : str
+        The endpoint url (always starting with https)
+
+    '''
+
+    with open(config_path, 'r') as f:
+        lines = f.read().splitlines()
+        for temp_line in lines:
+            if 'access_key' == temp_line[:10]:
+                access_key = temp_line.split('=')[-1].strip()
+            if 'secret_key' == temp_line[:10]:
+                secret_key = temp_line.split('=')[-1].strip()
+            if 'host_base' == temp_line[:9]:
+                host_base = temp_line.split('=')[-1].strip()
+                if 'https' != host_base[:5]:
+                    host_base = 'https://' + host_base
+
+    return access_key, secret_key, host_base
+
+
+def create_boto3_client(s3_config = None):
+    '''Utility to grab a boto3 client
+    
+    Clients are shared across the whole process, with one
+    client per (config file, endpoint) combination. The first
+    request for a given config file creates the client (using
+    BOTO3_CLIENT_CONFIG for connection pooling, keep-alive and
+    retries), and later requests reuse it along with its open
+    connections. boto3 clients are safe to share between threads.
+    
+    Parameters
+    ----------
+    
+    s3_config : str or None, default None
+        Path to s3 configuration file
+        
+    Returns
+    -------
+    
+    boto3 client
+    
+    '''
+    
+    config_path = grab_s3_config_path(s3_config)
+    access_key, secret_key, host_base = parse_s3_config(config_path)
+    registry_key = (os.path.abspath(config_path), host_base)
+
+    with _boto3_clients_lock:
+        if registry_key not in _boto3_clients:
+            _boto3_clients[registry_key] = boto3.client(
+                's3',
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+                endpoint_url =host_base,
+                config = BOTO3_CLIENT_CONFIG
+            )
+        client = _boto3_clients[registry_key]
+    
+    return client
+
+
+def clear_boto3_clients():
+    '''Forget all shared boto3 clients and parsed s3 config files
+
+    Useful if credentials in a config file have changed
+    while the current python process is running.
+
+    '''
+
+    with _boto3_clients_lock:
+        _boto3_clients.clear()
+    parse_s3_config.cache_clear()
+
+    return
+
+def cbrain_mark_as_newer(file_id, cbrain_api_token, cbrain_client = None):
+    '''Mark file as newer on CBRAIN
+    
+    If a file is cached in cbrain, you can call
+    this function to make sure the cache is updated
+    before the file is used in any upcoming processing.
+    This means the file will be re-downloaded from the
+    data provider where the file lives. If mark as newer
+    has already been called then CBRAIN will say 0 files
+    were marked as newer. This same behavior is also
+    observed in the case where the file is on the data
+    provider but not yet cached on the system where processing
+    occurs.
+    
+    Parameters
+    ----------
+    file_id : str
+        The id of the CBRAIN file that
+        should be "marked as newer"
+    cbrain_api_token : str
+        The api token generated when you logged into cbrain
+    cbrain_client : CbrainClient or None, default None
+        Client used to talk to CBRAIN. If None, the
+        default client from get_cbrain_client is used.
+
+    '''    
+    
+    data = {
+              "file_ids": [file_id],
+              "operation": "all_newer",
+            }
+    
+    
+    task_params = (
+        ('cbrain_api_token', cbrain_api_token),
     )
     
-    dp_response = requests.post(
-        url = '/'.join([base_url, 'userfiles', 'sync_multiple']),
+    dp_response = get_cbrain_client(cbrain_client).post(
+        'userfiles', 'sync_multiple',
         headers = {'Accept': 'application/json'},
         params = task_params,
         json = data
@@ -623,6 +2053,50 @@ def file_exists_under_prefix(bucket_name, prefix, s3_config):
     s3 = create_boto3_client(s3_config = s3_config)
     response = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix, MaxKeys=1)
     return 'Contents' in response
+
+def find_subjects_with_derivatives(bucket_name, prefix, s3_config):
+    '''Find which subjects already have outputs under a derivatives prefix
+
+    Lists the prefix once with a delimiter instead of checking
+    each subject with file_exists_under_prefix.
+
+    Parameters
+    ----------
+    bucket_name : str
+        Name of the derivatives bucket
+    prefix : str
+        The pipeline folder within the bucket (i.e.
+        'derivatives/ses-V02/mriqc')
+    s3_config : str
+        Path to s3 config file used to access the bucket
+
+    Returns
+    -------
+    set
+        Names of subjects (i.e. 'sub-1') that have a folder
+        or file directly underneath the prefix. For files, the
+        subject name is the part of the file name before the
+        first '_' or '.'.
+
+    '''
+
+    if len(prefix) and (prefix[-1] != '/'):
+        prefix = prefix + '/'
+
+    s3 = create_boto3_client(s3_config = s3_config)
+    paginator = s3.get_paginator('list_objects_v2')
+    page_iterator = paginator.paginate(Bucket = bucket_name, Prefix = prefix, Delimiter = '/')
+
+    subjects_with_derivatives = set()
+    for page in page_iterator:
+        for temp_prefix in page.get('CommonPrefixes', []):
+            subjects_with_derivatives.add(temp_prefix['Prefix'][len(prefix):].rstrip('/'))
+        for temp_object in page.get('Contents', []):
+            temp_name = temp_object['Key'][len(prefix):]
+            if len(temp_name):
+                subjects_with_derivatives.add(re.split('[_.]', temp_name)[0])
+
+    return subjects_with_derivatives
     
 def grab_json(json_config_location, pipeline_name, session_label = None):
     """Load json config for a given pipeline
@@ -759,7 +2233,7 @@ def construct_generic_cbrain_task_info_dict(cbrain_api_token, group_id, user_id,
     
     return task_headers, task_params, task_data
 
-def submit_generic_cbrain_task(task_headers, task_params, task_data, pipeline_name):
+def submit_generic_cbrain_task(task_headers, task_params, task_data, pipeline_name, cbrain_client = None):
     '''Function to submit CBRAIN task via API
 
     This is only used by launch_task_concise_dict.
@@ -775,6 +2249,9 @@ def submit_generic_cbrain_task(task_headers, task_params, task_data, pipeline_na
         generated by construct_generic_cbrain_task_info_dict(dict)
     pipeline_name : str
         name of pipeline (used only for troubleshooting)
+    cbrain_client : CbrainClient or None, default None
+        Client used to talk to CBRAIN. If None, the
+        default client from get_cbrain_client is used.
         
     Returns
     -------
@@ -783,8 +2260,8 @@ def submit_generic_cbrain_task(task_headers, task_params, task_data, pipeline_na
         
     '''
     
-    task_response = requests.post(
-        url = '/'.join(['https://portal.cbrain.mcgill.ca', 'tasks']),
+    task_response = get_cbrain_client(cbrain_client).post(
+        'tasks',
         headers = task_headers,
         params = task_params,
         data = json.dumps(task_data)
@@ -811,7 +2288,7 @@ def launch_task_concise_dict(pipeline_name, variable_parameters_dict, cbrain_api
                              data_provider_id = 710, override_tool_config_id = False,
                              group_id = 10367, user_id = 4022, task_description = '',
                              custom_json_config_location = False, all_to_keep = None,
-                             session_label = None):
+                             session_label = None, cbrain_client = None):
 
     '''Uses submit_generic_cbrain_task to launch processing
     
@@ -862,6 +2339,12 @@ def launch_task_concise_dict(pipeline_name, variable_parameters_dict, cbrain_api
         some T1 file from the anat dir, it will remove other
         files from the anat dir, but will leave the func dir,
         or other session dirs untouched.
+    session_label : str or None, default None
+        Session label (i.e. 'V02') to pass to pipelines that
+        accept a session argument (see session_arguments.json)
+    cbrain_client : CbrainClient or None, default None
+        Client used to talk to CBRAIN. If None, the
+        default client from get_cbrain_client is used.
         
     Returns
     -------
@@ -884,11 +2367,14 @@ def launch_task_concise_dict(pipeline_name, variable_parameters_dict, cbrain_api
     task_headers, task_params, task_data = construct_generic_cbrain_task_info_dict(cbrain_api_token, group_id, user_id, tool_config_id, data_provider_id, task_description, variable_parameters_dict, fixed_parameters_dict, all_to_keep = all_to_keep)
         
     #Submit task to CBRAIN
-    status, json_for_logging = submit_generic_cbrain_task(task_headers, task_params, task_data, pipeline_name)
+    status, json_for_logging = submit_generic_cbrain_task(task_headers, task_params, task_data, pipeline_name,
+                                                          cbrain_client = cbrain_client)
     return status, json_for_logging
 
 
-def find_current_cbrain_tasks(cbrain_api_token, data_provider_id = None):
+def find_current_cbrain_tasks(cbrain_api_token, data_provider_id = None, cbrain_client = None,
+                              page_callback = None, tool_config_id = None, snapshot_path = None,
+                              snapshot_max_age_minutes = 0, snapshot_full_reconcile_hours = 24):
     '''Generates info on extended file list files
     
     Parameters
@@ -898,50 +2384,79 @@ def find_current_cbrain_tasks(cbrain_api_token, data_provider_id = None):
         The CBRAIN API token for the current session
     data_provider_id : None or int
         Restrict tasks to the specific data provider
+    cbrain_client : CbrainClient or None, default None
+        Client used to talk to CBRAIN. If None, the
+        default client from get_cbrain_client is used.
+    page_callback : None or function, default None
+        Called with the (filtered) tasks from each page
+        as they arrive (see CbrainClient.get_all_pages)
+    tool_config_id : None or int
+        Restrict tasks to the specific tool config
+    snapshot_path : None or str, default None
+        If provided, tasks will be grabbed through the local
+        snapshot store at this path (see sync_cbrain_snapshot)
+    snapshot_max_age_minutes : float, default 0
+        See find_cbrain_entities
+    snapshot_full_reconcile_hours : float, default 24
+        See find_cbrain_entities
         
     Returns
     -------
     list of dictionaries with info on current CBRAIN tasks
     
     '''
-    base_url = 'https://portal.cbrain.mcgill.ca'
-    tasks = []
-    tasks_request = {'cbrain_api_token': cbrain_api_token, 'page': 1, 'per_page': 1000}
 
-    while True:
-        tasks_response = requests.get(
-            url = '/'.join([base_url, 'tasks']),
-            data = tasks_request,
-            headers = {'Accept': 'application/json'}
-        )
-        if tasks_response.status_code != requests.codes.ok:
-            print('User tasks request failed.')
-            print(tasks_response)
-            break
-        # Collect the responses on this page then increment
-        tasks += tasks_response.json()
-        tasks_request['page'] += 1
-        # Stop requesting responses when we're at the last page
-        if len(tasks_response.json()) < tasks_request['per_page']:
-            break 
+    #Let CBRAIN do the filtering when possible (see find_cbrain_entities)
+    filters = {}
+    if type(data_provider_id) != type(None):
+        filters['results_data_provider_id'] = data_provider_id
+    if type(tool_config_id) != type(None):
+        filters['tool_config_id'] = tool_config_id
+
+    tasks = find_cbrain_entities(cbrain_api_token, 'tasks', cbrain_client = cbrain_client,
+                                 page_callback = page_callback, filters = filters,
+                                 snapshot_path = snapshot_path,
+                                 snapshot_max_age_minutes = snapshot_max_age_minutes,
+                                 snapshot_full_reconcile_hours = snapshot_full_reconcile_hours)
             
-    if type(data_provider_id) == type(None):
-        return tasks
-    else:
-        if type(data_provider_id) == str:
-            data_provider_id = int(data_provider_id)
-        tasks_to_return = []
-        for temp_task in tasks:
-            if temp_task['results_data_provider_id'] == data_provider_id:
-                tasks_to_return.append(temp_task)
-        return tasks_to_return
+    return tasks
+
+
+
+def build_cbrain_file_index(cbrain_files):
+    '''Index CBRAIN files by name, type and data provider
+
+    Used with grab_external_requirements so that a subject's
+    files can be found without scanning every CBRAIN file.
+
+    Parameters
+    ----------
+    cbrain_files : list of dicts
+        CBRAIN files (as returned by the CBRAIN API)
+
+    Returns
+    -------
+    dict
+        Dictionary whose keys are (name, type, data_provider_id)
+        and whose values are the list of matching files in the
+        same order as cbrain_files. Keys of the form (name, type, None)
+        hold the matching files from all data providers.
+
+    '''
+
+    cbrain_file_index = {}
+    for temp_file in cbrain_files:
+        cbrain_file_index.setdefault((temp_file['name'], temp_file['type'], temp_file['data_provider_id']), []).append(temp_file)
+        cbrain_file_index.setdefault((temp_file['name'], temp_file['type'], None), []).append(temp_file)
 
+    return cbrain_file_index
 
 
 def grab_external_requirements(subject_name, cbrain_files, 
                                 requirements_dict,
                                 bids_data_provider_id = None,
-                                derivatives_data_provider_id = None):
+                                derivatives_data_provider_id = None,
+                                cbrain_file_index = None, output = None):
     '''Grab's external requirements for a subject
 
     External requirements are either non-BIDS files
@@ -976,6 +2491,12 @@ def grab_external_requirements(subject_name, cbrain_files,
         derivatives files to the specified data provider.
         Any non-numeric requirements (i.e. file types) that
         are not BidsSubjects will be assumed to be derivatives
+    cbrain_file_index : None or dict, default None
+        Index of cbrain_files made by build_cbrain_file_index.
+        If provided, files will be looked up in the index instead
+        of searching through cbrain_files (which can then be None).
+    output : None or file-like object, default None
+        Where messages are printed (sys.stdout if None)
     
     Returns
     -------
@@ -1001,7 +2522,16 @@ def grab_external_requirements(subject_name, cbrain_files,
         #Otherwise, we will look for a CBRAIN file with the specified file type and with the subject
         #name
         else:
-            for temp_file in cbrain_files:
+            if type(cbrain_file_index) == type(None):
+                candidate_files = cbrain_files
+            else:
+                #Only grab the files that the data provider checks below could accept
+                temp_type = requirements_dict[temp_requirement]
+                if (temp_type == 'BidsSubject') and (type(bids_data_provider_id) != type(None)):
+                    candidate_files = cbrain_file_index.get((subject_name, temp_type, bids_data_provider_id), [])
+                else:
+                    candidate_files = cbrain_file_index.get((subject_name, temp_type, None), [])
+            for temp_file in candidate_files:
                 if (temp_file['name'] == subject_name) and (temp_file['type'] == requirements_dict[temp_requirement]):
                     #Dont use the file if (1) the bids data provider is specified
                     # (2) the file is a BIDS subject and (3)
@@ -1022,14 +2552,14 @@ def grab_external_requirements(subject_name, cbrain_files,
                     break
             if requirement_found == False:
                 requirements_tracking_dict[temp_requirement] = 'No File'
-                print('    Requirement {} not found for subject {}'.format(temp_requirement, subject_name))
+                print('    Requirement {} not found for subject {}'.format(temp_requirement, subject_name), file = output)
                 return None, requirements_tracking_dict
 
     return subject_external_requirements, requirements_tracking_dict
 
 def find_potential_subjects_for_processing(cbrain_api_token, bids_bucket_config, bids_bucket = 'hbcd-pilot',
                                            bids_prefix = 'assembly_bids', data_provider_id = '710',
-                                           verbose = False):
+                                           verbose = False, cbrain_client = None):
     """Find subjects that may be ready for processing
     
     Looks for subjects that are already registered in CBRAIN
@@ -1050,6 +2580,9 @@ def find_potential_subjects_for_processing(cbrain_api_token, bids_bucket_config,
         Prefix to look for subjects in (i.e. assembly_bids)
     data_provider_id : str
         CBRAIN Data Provider ID to look for subjects in
+    cbrain_client : CbrainClient or None, default None
+        Client used to talk to CBRAIN. If None, the
+        default client from get_cbrain_client is used.
     
     Returns
     -------
@@ -1068,7 +2601,7 @@ def find_potential_subjects_for_processing(cbrain_api_token, bids_bucket_config,
     s3_subjects = find_s3_subjects(bids_bucket_config, bucket = bids_bucket, prefix = bids_prefix)
 
     #Grab data provider id for bucket from cbrain web instance
-    cbrain_subjects, ids, sizes = find_cbrain_subjects(cbrain_api_token, data_provider_id = data_provider_id) #710 = HBCD Pilot Official, #725 is old
+    cbrain_subjects, ids, sizes = find_cbrain_subjects(cbrain_api_token, data_provider_id = data_provider_id, cbrain_client = cbrain_client) #710 = HBCD Pilot Official, #725 is old
 
     total_subjects = set(cbrain_subjects + s3_subjects)
     non_registered_subjects = set(s3_subjects) - set(cbrain_subjects)
@@ -1077,23 +2610,26 @@ def find_potential_subjects_for_processing(cbrain_api_token, bids_bucket_config,
     print('Total identified subjects: {},\nSubjects Still Needing to Be Registered in CBRAIN: {},\nSubjects Registered in CBRAIN and in S3 (ready to process): {},\nRegistered Subjects Not in S3 (this should be 0): {}\n\n'.format(len(total_subjects), len(non_registered_subjects), len(registered_and_s3), len(missing_in_s3_subjects)))
     if verbose:
         print('Not Registered:')
-        for temp_subject in list(non_registered_subjects):
+        for temp_subject in sorted(non_registered_subjects):
             print('    {}'.format(temp_subject))
         print('Not in S3:')
-        for temp_subject in list(missing_in_s3_subjects):
+        for temp_subject in sorted(missing_in_s3_subjects):
             print('    {}'.format(temp_subject))
 
 
+    #Look up the CBRAIN info for each subject by name (returned in sorted order)
+    cbrain_subject_indices = {}
+    for i, temp_cbrain in enumerate(cbrain_subjects):
+        cbrain_subject_indices.setdefault(temp_cbrain, i)
+
     registered_and_s3_ids = []
     registered_and_s3_names = []
     registered_and_s3_sizes = []
-    for temp_subject in registered_and_s3:
-        for i, temp_cbrain in enumerate(cbrain_subjects):
-            if temp_cbrain == temp_subject:
-                registered_and_s3_ids.append(ids[i])
-                registered_and_s3_names.append(temp_cbrain)
-                registered_and_s3_sizes.append(sizes[i])
-                break
+    for temp_subject in sorted(registered_and_s3):
+        i = cbrain_subject_indices[temp_subject]
+        registered_and_s3_ids.append(ids[i])
+        registered_and_s3_names.append(temp_subject)
+        registered_and_s3_sizes.append(sizes[i])
 
     return registered_and_s3_names, registered_and_s3_ids, registered_and_s3_sizes
 
@@ -1132,15 +2668,15 @@ def check_rerun_status(cbrain_subject_id, cbrain_tasks, derivatives_data_provide
     
     '''
 
-    rerun_group_1 = ['Terminated', 'Failed To Setup', 'Failed To PostProcess', 'Failed Setup Prerequisites', 'Failed PostProcess Prerequisites']
-    rerun_group_2 = ['Suspended', 'Failed', 'Failed On Cluster']
     cbrain_subject_id_str = str(cbrain_subject_id)
+    tool_config_id = int(tool_config_id)
+    derivatives_data_provider_id = int(derivatives_data_provider_id)
 
     task_statuses = []
     task_ids = []
     for temp_task in cbrain_tasks:
-        if temp_task['tool_config_id'] == int(tool_config_id):
-            if temp_task['results_data_provider_id'] == int(derivatives_data_provider_id):
+        if temp_task['tool_config_id'] == tool_config_id:
+            if temp_task['results_data_provider_id'] == derivatives_data_provider_id:
                 try:
                     if cbrain_subject_id_str in temp_task['params']['interface_userfile_ids']:
                         task_statuses.append(temp_task['status'])
@@ -1148,6 +2684,114 @@ def check_rerun_status(cbrain_subject_id, cbrain_tasks, derivatives_data_provide
                 except:
                     continue
 
+    return evaluate_rerun_statuses(task_ids, task_statuses, rerun_level = rerun_level)
+
+
+def build_cbrain_task_index(cbrain_tasks):
+    '''Index CBRAIN tasks by the userfiles they were run on
+
+    Parameters
+    ----------
+    cbrain_tasks : list of dicts or dict
+        Tasks in CBRAIN (returned by CBRAIN API). Can also
+        be a dictionary whose values are lists of tasks (i.e.
+        tasks seperated by session), in which case all lists
+        will be combined into a single index. Tasks that show
+        up more than once are only indexed once. A single
+        interface_userfile_ids value (instead of a list) is
+        treated as a list with one userfile.
+
+    Returns
+    -------
+    dict
+        Dictionary whose keys are (tool_config_id, results_data_provider_id,
+        userfile_id) with userfile_id as a string, and whose values are lists
+        of (task_id, status) tuples. To be used with check_rerun_status_from_index.
+
+    '''
+
+    if type(cbrain_tasks) == dict:
+        task_lists = list(cbrain_tasks.values())
+    else:
+        task_lists = [cbrain_tasks]
+
+    cbrain_task_index = {}
+    task_ids_found = set()
+    for temp_tasks in task_lists:
+        for temp_task in temp_tasks:
+            if temp_task['id'] in task_ids_found:
+                continue
+            task_ids_found.add(temp_task['id'])
+            try:
+                userfile_ids = temp_task['params']['interface_userfile_ids']
+            except (KeyError, TypeError):
+                continue
+            if type(userfile_ids) == type(None):
+                continue
+            if type(userfile_ids) not in (list, tuple):
+                userfile_ids = [userfile_ids]
+            for temp_userfile_id in set(str(temp_id) for temp_id in userfile_ids):
+                temp_key = (temp_task['tool_config_id'], temp_task['results_data_provider_id'], temp_userfile_id)
+                cbrain_task_index.setdefault(temp_key, []).append((temp_task['id'], temp_task['status']))
+
+    return cbrain_task_index
+
+
+def check_rerun_status_from_index(cbrain_subject_id, cbrain_task_index, derivatives_data_provider_id, tool_config_id, rerun_level = 1, output = None):
+    '''Same as check_rerun_status, but uses a task index
+
+    Parameters
+    ----------
+    cbrain_subject_id : str
+        Numeric ID of CBRAIN subject or file.
+    cbrain_task_index : dict
+        Index of CBRAIN tasks made by build_cbrain_task_index
+    derivatives_data_provider_id : int
+        The data provider being used for processing
+    tool_config_id : int
+        The id of the tool config being used for processing
+    rerun_level : 0, 1, 2, default 1
+        See check_rerun_status
+    output : None or file-like object, default None
+        Where messages are printed (sys.stdout if None)
+
+    Returns
+    -------
+    Same as check_rerun_status
+
+    '''
+
+    temp_key = (int(tool_config_id), int(derivatives_data_provider_id), str(cbrain_subject_id))
+    matching_tasks = cbrain_task_index.get(temp_key, [])
+    task_ids = [temp_task[0] for temp_task in matching_tasks]
+    task_statuses = [temp_task[1] for temp_task in matching_tasks]
+
+    return evaluate_rerun_statuses(task_ids, task_statuses, rerun_level = rerun_level, output = output)
+
+
+def evaluate_rerun_statuses(task_ids, task_statuses, rerun_level = 1, output = None):
+    '''Decide whether processing should be ran given the statuses of existing tasks
+
+    Parameters
+    ----------
+    task_ids : list
+        IDs of the tasks associated with the subject
+    task_statuses : list of str
+        Statuses of the tasks in task_ids
+    rerun_level : 0, 1, 2, default 1
+        See check_rerun_status
+    output : None or file-like object, default None
+        Where messages are printed (sys.stdout if None)
+
+    Returns
+    -------
+    Same as check_rerun_status
+
+    '''
+
+    rerun_group_1 = ['Terminated', 'Failed To Setup', 'Failed To PostProcess', 'Failed Setup Prerequisites', 'Failed PostProcess Prerequisites']
+    rerun_group_2 = ['Suspended', 'Failed', 'Failed On Cluster']
+
     num_rerun_group_1 = 0
     num_rerun_group_2 = 0
     example_status = None
@@ -1167,17 +2811,17 @@ def check_rerun_status(cbrain_subject_id, cbrain_tasks, derivatives_data_provide
         return True, example_status
     else:
         if rerun_level == 0:
-            print('    Found existing task(s), consider deleting the task(s) or using higher rerun level. Tasks: {}, Statuses: {}'.format(task_ids, task_statuses))
+            print('    Found existing task(s), consider deleting the task(s) or using higher rerun level. Tasks: {}, Statuses: {}'.format(task_ids, task_statuses), file = output)
         elif rerun_level == 1:
             if len(task_statuses) == num_rerun_group_1:
                 return True, example_status
             else:
-                print('    Found existing task(s) with status within rerun_level = 1, consider deleting the task(s) or using higher rerun level. Tasks: {}, Statuses {}'.format(task_ids, task_statuses))
+                print('    Found existing task(s) with status within rerun_level = 1, consider deleting the task(s) or using higher rerun level. Tasks: {}, Statuses {}'.format(task_ids, task_statuses), file = output)
         elif rerun_level == 2:
             if len(task_statuses) == (num_rerun_group_1 + num_rerun_group_2):
                 return True, example_status
             else:
-                print('    Found existing task(s) with status within rerun_level = 2, consider deleting the task(s) or using higher rerun level. Tasks: {}, Statuses {}'.format(task_ids, task_statuses))
+                print('    Found existing task(s) with status within rerun_level = 2, consider deleting the task(s) or using higher rerun level. Tasks: {}, Statuses {}'.format(task_ids, task_statuses), file = output)
         else:
             raise ValueError('Error: rerun_level must be 0, 1, or 2')
 
@@ -1189,7 +2833,7 @@ def check_bids_requirements_v2(subject_id, session_files, requirements_dict,
                                qc_df = None, bucket = 'hbcd-pilot', prefix = 'assembly_bids',
                                bids_bucket_config = False, session = None,
                                session_agnostic_files = ['sessions.tsv'],
-                               verbose = False):
+                               verbose = False, group_evaluations = None, output = None):
     
     '''Function that checks if a subject has required BIDS data for processing
     
@@ -1210,6 +2854,8 @@ def check_bids_requirements_v2(subject_id, session_files, requirements_dict,
     the right quality. Of course if you only want to process subjects that have good
     T1w and good T2w images then you would give both this function and grab_required_bids_files_v2
     requirements_dict files that specify both image types.
+
+    The check only uses session_files and qc_df, so no requests are made to S3.
     
     
     Parameters
@@ -1233,14 +2879,11 @@ def check_bids_requirements_v2(subject_id, session_files, requirements_dict,
         as a pandas dataframe. This will be used for any
         inforporation of qc information.
     bucket : str, default 'hbcd-pilot'
-        The name of the bucket to query for files
+        Not used, kept for compatibility
     prefix : str, default 'assembly_bids'
-        The prefix to restrict the files returned by
+        Not used, kept for compatibility
     bids_bucket_config : bool or str, default False
-        If bids_bucket_config is a string, this
-        will be used as a config file to identify
-        the s3 credentials... otherwise the default
-        location will be used
+        Not used, kept for compatibility
     session : str
         The session being used for processing (i.e. ses-V02)
     session_agnostic_files : list of str, default ['sessions.tsv']
@@ -1248,6 +2891,13 @@ def check_bids_requirements_v2(subject_id, session_files, requirements_dict,
         specific
     verbose : bool, default False
         Print more details
+    group_evaluations : None or dict, default None
+        Dictionary shared between calls for the same subject/session
+        (i.e. with check_bids_requirements_v2, grab_required_bids_files_v2
+        and check_if_ancestor_file_selection_is_same) so that each
+        requirement group is only evaluated once. See evaluate_requirement_group.
+    output : None or file-like object, default None
+        Where messages are printed (sys.stdout if None)
 
     
     Returns
@@ -1281,72 +2931,31 @@ def check_bids_requirements_v2(subject_id, session_files, requirements_dict,
     for temp_req in requirements_dict.keys():
         requirements_tracking_dict[temp_req] = 'No File'
 
-    
-    # Do some cosmetics so that the prefix includes the pipeline
-    # name and so that later we look for the subject ID at the
-    # right level
-    full_prefix = os.path.join(prefix, subject_id)
-    prefix_offset = len(full_prefix.split('/')) - 1
-    if len(prefix) == 0:
-        prefix_offset = prefix_offset - 1
-        
-    # Create a PageIterator from the Paginator
-    page_iterator = create_page_iterator(bucket = bucket, prefix = full_prefix, bucket_config = bids_bucket_config)
-
-    #Iterate through bucket to find BIDS files for this subject
-    subject_files = []
-    for page in page_iterator:
-        if 'Contents' in page:
-            for temp_dict in page['Contents']:
-                subject_files.append(temp_dict['Key'].split('/')[-1])
-        else:
-            print('No BIDS contents found for: {}'.format(subject_id))
 
     parent_requirements_satisfied = 0
     for parent_requirement in requirements_dict.keys():
         
-        #Check if the current requirement has any associated QC criteria
         if verbose:
-            print('Parent Requirement: {}'.format(parent_requirement))
-        if 'qc_criteria' in requirements_dict[parent_requirement]:
-            num_iters_allowed = len(requirements_dict[parent_requirement]['qc_criteria'])
-            qc_index = 0
-        else:
-            num_iters_allowed = 1
-            qc_index = None
-            
-        #The following loop to find files is necessary because there may
+            print('Parent Requirement: {}'.format(parent_requirement), file = output)
+
+        #Different QC criteria may be tried for the requirement because there may
         #be cases where there is different QC information available for
         #different subjects, and we want to process as many subjects as
         #possible using manual QC measures when they are available, but
         #in absence of manual QC measures we may use automated QC measures.
-        continue_loop = True
-        while continue_loop:
-            requirement_status, temp_tracking_str = check_bids_requirements_v2_inner(session_files, requirements_dict[parent_requirement], 
-                                             qc_index = qc_index, qc_df = qc_df, 
-                                             session_agnostic_files = session_agnostic_files, verbose = verbose)
-            if verbose:
-                print('Requirement Status {}: {}'.format(parent_requirement, requirement_status))
-                print('Temp_tracking_str: {}'.format(temp_tracking_str))
-            if type(qc_index) == type(None):
-                continue_loop = False
-            else:
-                qc_index += 1
-            if (type(requirement_status) == type(None)) and (qc_index != num_iters_allowed):
-                continue
-            else:
-                continue_loop = False
-            continue_loop = False
-           
-                             
-        #print('Requirement Disqualified Status: {}\n'.format(requirement_disqualified))
-        if requirement_status == True:
+        #(see evaluate_requirement_group)
+        group_evaluation = evaluate_requirement_group(session_files, requirements_dict[parent_requirement], qc_df = qc_df,
+                                                      session_agnostic_files = session_agnostic_files, verbose = verbose,
+                                                      group_evaluations = group_evaluations, output = output)
+        if verbose:
+            print('Requirement Status {}: {}'.format(parent_requirement, group_evaluation['status']), file = output)
+            print('Temp_tracking_str: {}'.format(group_evaluation['tracking']), file = output)
+        if group_evaluation['status'] == True:
             parent_requirements_satisfied += 1
-            temp_tracking_str = 'Satisfied'
-        requirements_tracking_dict[parent_requirement] = temp_tracking_str
+        requirements_tracking_dict[parent_requirement] = group_evaluation['tracking']
         
     if verbose:
-        print('Num parent reqs satisfied: {}/{}'.format(parent_requirements_satisfied, len(requirements_dict.keys())))
+        print('Num parent reqs satisfied: {}/{}'.format(parent_requirements_satisfied, len(requirements_dict.keys())), file = output)
     
     #If all requirements have been satisfied at least once return true, else false
     if parent_requirements_satisfied == len(requirements_dict.keys()):
@@ -1363,103 +2972,295 @@ def check_bids_requirements_v2_inner(session_files, partial_requirements_dict, q
     #is a standalone function is so that different qc_indices can be used, signifying
     #different qc criteria that will be referred to based on what qc measures are
     #available for a given subject.
-    
-    
-    #Grab the current QC criteria. Only necessary if QC Criteria
-    #is in the partial_requirements_dict. If there are more than
-    #one QC Criteria (i.e. there are backup QC criteria), then 
-    #the qc_index will say which one is currently being referenced
-    any_passing = False
-    temp_tracking_status = 'No File'
-    if verbose:
-        print('Current QC Index: {}'.format(qc_index))
-    if 'qc_criteria' in partial_requirements_dict:
-        if type(qc_index) == type(None):
-            temp_qc_criteria_group = partial_requirements_dict['qc_criteria']
-        else:
-            temp_qc_criteria_group = partial_requirements_dict['qc_criteria'][qc_index]
-    
-    temp_requirement_file_list = []
-    child_requirements = partial_requirements_dict['file_naming']
-    for j, temp_file in enumerate(session_files):
-        child_requirements_satisfied = 0
-        for child_requirement in child_requirements.keys():
-            if (child_requirement in temp_file['Key']) == child_requirements[child_requirement]:
-                child_requirements_satisfied += 1
-            else:
-                break
-        if child_requirements_satisfied == len(child_requirements.keys()):
-            temp_requirement_file_list.append(temp_file['Key'])
 
+    requirement_files = get_requirement_matcher(partial_requirements_dict).classify(session_files)
+    file_assessments = assess_requirement_files(requirement_files, partial_requirements_dict, qc_index = qc_index,
+                                                qc_df = qc_df, session_agnostic_files = session_agnostic_files,
+                                                verbose = verbose)
 
-    for j, temp_file in enumerate(temp_requirement_file_list):
-        requirement_disqualified = 0
-        if ('qc_criteria' in partial_requirements_dict) and (type(qc_df) != type(None)):
-            partial_df = qc_df[qc_df['filename'].str.contains(temp_file.split('/')[-1])]
-            if len(partial_df) == 0:
-                is_ses_agnostic = 0
-                for temp_ses_agnostic in session_agnostic_files:
-                    if temp_ses_agnostic in temp_file:
-                        is_ses_agnostic = 1
-                if is_ses_agnostic == 0:
-                    print('   Exiting processing attempt: No QC info for {}'.format(temp_file))
-                    return None, 'No QC'
+    return summarize_requirement_assessments(file_assessments)
 
 
-            #Iterate through each QC requirement (the requirements are
-            #stored as a list of dictionaries, each with one key/value pair)
-            if verbose:
-                print('File being investigated: {}'.format(temp_file.split('/')[-1]))
-            if verbose:
-                print('   temp_qc_criteria_group: {}'.format(temp_qc_criteria_group))
-            for temp_qc_criteria in temp_qc_criteria_group:
-                if verbose:
-                    print('   temp_qc_criteria: {}'.format(temp_qc_criteria))
-                for temp_dict_key in temp_qc_criteria:
-                    
-                    #Check if there is a null value for the current QC criteria.
-                    #If there is a null value here, we will want to error out so
-                    #the next grouping of QC criteria can be used if one is available.
-                    #print('temp_dict: {}'.format(temp_dict))
-                    #temp_dict_key = list(temp_dict.keys())[0]
-                    if pd.isnull(partial_df[temp_dict_key].values[0]):
-                        if verbose:
-                            print('   SKIPPING CRITERIA BECAUSE NULL WAS IDENTIFIED: {}'.format(partial_df[temp_dict_key].values[0]))
-                        temp_tracking_status = 'Missing QC'
-                        return None, temp_tracking_status
-                    
-                    if verbose:
-                        print('     is {} {} {} : {}'.format(partial_df[temp_dict_key].values[0], temp_qc_criteria[temp_dict_key][1], temp_qc_criteria[temp_dict_key][0], temp_file))
-                    if make_comparison(partial_df[temp_dict_key].values[0], temp_qc_criteria[temp_dict_key][1], temp_qc_criteria[temp_dict_key][0]):
-                        continue
-                        #temp_tracking_status = 'Satisfied'
-                    else:
-                        if temp_tracking_status != 'Satisfied':
-                            temp_tracking_status = 'Failed QC'
-                        requirement_disqualified = 1
-                    
+def qc_value_in(new_val, reference):
+    '''True if new_val is one of the values in reference (elementwise for pandas series)'''
+
+    if isinstance(new_val, pd.Series):
+        return new_val.isin(reference)
+    return new_val in reference
 
-        if requirement_disqualified == 0:
-            any_passing = True
-            temp_tracking_status = 'Satisfied'
-            
-    #If it gets to this point, it means that the current grouping
-    #of QC criteria had all the requisite info to determine whether
-    #the current file was good enough for processing. Then a true/false
-    #rating mentions whether that criteria was satisfied or not.
-    return any_passing, temp_tracking_status
+
+def qc_value_between(new_val, reference):
+    '''True if new_val is within [reference[0], reference[1]] (elementwise for pandas series)'''
+
+    return (new_val >= reference[0]) & (new_val <= reference[1])
+
+
+#Operators that can be used in "qc_criteria". Each function takes the
+#QC value (or a pandas series of QC values) and the reference value.
+QC_OPERATORS = {'equals' : operator.eq,
+                'not_equals' : operator.ne,
+                'less_than' : operator.lt,
+                'less_than_or_equal' : operator.le,
+                'greater_than' : operator.gt,
+                'greater_than_or_equal' : operator.ge,
+                'in' : qc_value_in,
+                'between' : qc_value_between}
+
+#Operators that only make sense for numbers. Columns that are used
+#with these operators are converted to numbers (see coerce_qc_columns).
+NUMERIC_QC_OPERATORS = ('less_than', 'less_than_or_equal', 'greater_than',
+                        'greater_than_or_equal', 'between')
 
 
 def make_comparison(new_val, operator, reference):
-    if operator == 'equals':
-        return new_val == reference
-    elif operator == 'less_than':
-        return new_val < reference
-    elif operator == 'greater_than':
-        return new_val > reference
-    else:
+    if operator not in QC_OPERATORS:
         raise NameError('Error: unknown operator {}'.format(operator))
-    
+    return QC_OPERATORS[operator](new_val, reference)
+
+
+def validate_qc_criteria(qc_criteria):
+    '''Make sure that the "qc_criteria" of a requirement group can be evaluated
+
+    Raises a ValueError if a criteria group isn't a list of
+    {measure : [reference, operator]} dictionaries, if an operator
+    isn't in QC_OPERATORS, or if the reference for 'in' or 'between'
+    isn't a list (of two values for 'between').
+
+    '''
+
+    for temp_qc_criteria_group in qc_criteria:
+        if type(temp_qc_criteria_group) != list:
+            raise ValueError('Error: each qc_criteria group should be a list, but found {}'.format(temp_qc_criteria_group))
+        for temp_qc_criteria in temp_qc_criteria_group:
+            if type(temp_qc_criteria) != dict:
+                raise ValueError('Error: each qc_criteria should be a dictionary, but found {}'.format(temp_qc_criteria))
+            for temp_dict_key, temp_criteria in temp_qc_criteria.items():
+                if (type(temp_criteria) != list) or (len(temp_criteria) != 2):
+                    raise ValueError('Error: qc_criteria for {} should be [reference, operator], but found {}'.format(temp_dict_key, temp_criteria))
+                reference, temp_operator = temp_criteria
+                if temp_operator not in QC_OPERATORS:
+                    raise ValueError('Error: unknown operator {} for {} (options: {})'.format(temp_operator, temp_dict_key, list(QC_OPERATORS.keys())))
+                if (temp_operator in ['in', 'between']) and (type(reference) != list):
+                    raise ValueError('Error: the reference for {} with operator {} should be a list, but found {}'.format(temp_dict_key, temp_operator, reference))
+                if (temp_operator == 'between') and (len(reference) != 2):
+                    raise ValueError('Error: the reference for {} with operator between should be [minimum, maximum], but found {}'.format(temp_dict_key, reference))
+
+
+def coerce_qc_columns(qc_df, numeric_columns):
+    '''Convert text columns of a scans.tsv dataframe that only hold numbers to numbers
+
+    Only the columns in numeric_columns are converted (see
+    NUMERIC_QC_OPERATORS), so values that are compared with
+    'equals' or 'in' (i.e. "001") keep their original type.
+    Columns with any value that isn't a number (i.e. "Yes")
+    are left as is. qc_df is not modified; a copy is returned
+    if any column was converted.
+
+    '''
+
+    coerced_df = qc_df
+    for temp_column in numeric_columns:
+        if (temp_column not in qc_df.columns) or pd.api.types.is_numeric_dtype(qc_df[temp_column]):
+            continue
+        numeric_values = pd.to_numeric(qc_df[temp_column], errors = 'coerce')
+        if numeric_values.isnull().sum() == qc_df[temp_column].isnull().sum():
+            if coerced_df is qc_df:
+                coerced_df = qc_df.copy()
+                coerced_df.attrs = dict(qc_df.attrs)
+            coerced_df[temp_column] = numeric_values
+
+    return coerced_df
+
+
+def index_qc_df(qc_df):
+    '''Index a scans.tsv dataframe by file name
+
+    The index (named 'qc_filename') holds the name of each file in
+    the 'filename' column without any folders (i.e. 'anat/sub-1_T1w.nii.gz'
+    becomes 'sub-1_T1w.nii.gz'). If a file name shows up more than
+    once, only the first row is kept. Dataframes that are already
+    indexed are returned as is.
+
+    '''
+
+    if qc_df.index.name == 'qc_filename':
+        return qc_df
+
+    qc_filenames = qc_df['filename'].astype(str).str.split('/').str[-1]
+    indexed_qc_df = qc_df[~qc_filenames.duplicated().values].copy()
+    indexed_qc_df.index = pd.Index(qc_filenames[~qc_filenames.duplicated()].values, name = 'qc_filename')
+    indexed_qc_df.attrs = dict(qc_df.attrs)
+
+    return indexed_qc_df
+
+
+def lookup_qc_row(qc_df, file_name):
+    '''Find the QC information for a file in a scans.tsv dataframe
+
+    Parameters
+    ----------
+    qc_df : pandas dataframe
+        The scans.tsv file, ideally already indexed by index_qc_df
+        (otherwise it will be indexed every time this is called)
+    file_name : str
+        Path of the file (only the name of the file is used)
+
+    Returns
+    -------
+    pandas dataframe with the single row whose file name is
+    exactly the same as file_name, or None if there is no such row
+
+    '''
+
+    qc_df = index_qc_df(qc_df)
+    try:
+        row_index = qc_df.index.get_loc(file_name.split('/')[-1])
+    except KeyError:
+        return None
+
+    return qc_df.iloc[[row_index]]
+
+
+def qc_verdict_column(qc_criteria_group):
+    '''Name of the column in a QC table that holds verdicts for a QC criteria group'''
+
+    group_hash = hashlib.md5(json.dumps(qc_criteria_group, sort_keys = True).encode()).hexdigest()
+    return 'qc_verdict_{}'.format(group_hash[:12])
+
+
+def evaluate_qc_criteria_group(qc_df, qc_criteria_group):
+    '''Evaluate a QC criteria group for every row of a QC dataframe
+
+    Returns a numpy array with 'missing', 'pass' or 'fail' for each
+    row (see build_qc_table). Raises a TypeError if the values of a
+    measure can't be compared with the reference.
+
+    '''
+
+    missing = np.zeros(len(qc_df), dtype = bool)
+    passing = np.ones(len(qc_df), dtype = bool)
+    for temp_qc_criteria in qc_criteria_group:
+        for temp_dict_key in temp_qc_criteria:
+            if temp_dict_key not in qc_df.columns:
+                missing[:] = True
+                continue
+            temp_values = qc_df[temp_dict_key]
+            missing |= temp_values.isnull().values
+            passing &= np.asarray(make_comparison(temp_values, temp_qc_criteria[temp_dict_key][1], temp_qc_criteria[temp_dict_key][0]), dtype = bool)
+
+    return np.where(missing, 'missing', np.where(passing, 'pass', 'fail'))
+
+
+def build_qc_table(scans_tsv_files, requirements_dicts):
+    '''Combine scans.tsv files into one table and evaluate QC criteria
+
+    Every QC criteria group found in requirements_dicts is evaluated
+    for all files of all subjects at once. The outcome is stored in a
+    new column (see qc_verdict_column) that is 'missing' if any of the
+    QC measures used by the group are null for the file, otherwise
+    'pass' if the file satisfies all criteria in the group, or 'fail'.
+    Measures that are used with numeric operators are converted to
+    numbers in each scans.tsv file (see coerce_qc_columns). If the
+    combined table can't be compared (i.e. a column is numeric for
+    one session but text for another), the group is evaluated one
+    subject/session at a time, and sessions whose values still
+    can't be compared get no verdict. Their files are evaluated
+    one by one in assess_requirement_files.
+
+    Parameters
+    ----------
+    scans_tsv_files : dict
+        Dictionary whose keys are (subject, session) pairs and whose
+        values are the scans.tsv file for the subject/session (pandas
+        dataframe) or None (see prefetch_scans_tsv_files).
+    requirements_dicts : list of dicts
+        Requirements dictionaries (see grab_required_bids_files_v2)
+        whose QC criteria should be evaluated.
+
+    Returns
+    -------
+    pandas dataframe or None
+        Table indexed by (qc_subject, qc_session, qc_filename) where
+        qc_filename is the name of the file without any folders. None
+        if there were no scans.tsv files.
+
+    '''
+
+    qc_criteria_groups = {}
+    numeric_columns = set()
+    for temp_requirements_dict in requirements_dicts:
+        for temp_requirement in temp_requirements_dict.values():
+            for temp_group in temp_requirement.get('qc_criteria', []):
+                qc_criteria_groups[qc_verdict_column(temp_group)] = temp_group
+                for temp_qc_criteria in temp_group:
+                    for temp_dict_key, temp_criteria in temp_qc_criteria.items():
+                        if temp_criteria[1] in NUMERIC_QC_OPERATORS:
+                            numeric_columns.add(temp_dict_key)
+
+    frames = []
+    frame_keys = []
+    for temp_key, temp_df in scans_tsv_files.items():
+        if (type(temp_df) == type(None)) or ('filename' not in temp_df.columns):
+            continue
+        frames.append(coerce_qc_columns(index_qc_df(temp_df), numeric_columns))
+        frame_keys.append(temp_key)
+    if len(frames) == 0:
+        return None
+    qc_table = pd.concat(frames, keys = frame_keys, names = ['qc_subject', 'qc_session'])
+
+    verdict_columns = {}
+    for temp_column, temp_group in qc_criteria_groups.items():
+        try:
+            verdict_columns[temp_column] = evaluate_qc_criteria_group(qc_table, temp_group)
+        except TypeError:
+            #Fall back to one subject/session at a time. The rows of
+            #qc_table are in the same order as frames.
+            temp_verdicts = np.full(len(qc_table), None, dtype = object)
+            start_row = 0
+            for temp_df in frames:
+                try:
+                    temp_verdicts[start_row:start_row + len(temp_df)] = evaluate_qc_criteria_group(temp_df, temp_group)
+                except TypeError:
+                    pass
+                start_row += len(temp_df)
+            verdict_columns[temp_column] = temp_verdicts
+
+    if len(verdict_columns):
+        qc_table = pd.concat([qc_table, pd.DataFrame(verdict_columns, index = qc_table.index)], axis = 1)
+
+    return qc_table
+
+
+def split_qc_table(qc_table, scans_tsv_files):
+    '''Split a table from build_qc_table back into one dataframe per subject/session
+
+    Parameters
+    ----------
+    qc_table : pandas dataframe or None
+        Output of build_qc_table
+    scans_tsv_files : dict
+        The dictionary that was given to build_qc_table
+
+    Returns
+    -------
+    dict
+        Same as scans_tsv_files, but with dataframes that
+        include the QC verdict columns from qc_table. The
+        dataframes given in scans_tsv_files are not modified.
+
+    '''
+
+    split_scans_tsv_files = dict(scans_tsv_files)
+    if type(qc_table) == type(None):
+        return split_scans_tsv_files
+
+    for temp_key, temp_df in qc_table.groupby(level = ['qc_subject', 'qc_session'], sort = False):
+        temp_df = temp_df.droplevel(['qc_subject', 'qc_session'])
+        temp_df.attrs = dict(scans_tsv_files[temp_key].attrs)
+        split_scans_tsv_files[temp_key] = temp_df
+
+    return split_scans_tsv_files
+
 def find_associated_files(subject_id, associated_files_dict, output_file_list,
                           session_files, prefix):
     '''
@@ -1482,7 +3283,7 @@ def find_associated_files(subject_id, associated_files_dict, output_file_list,
                             if temp_dict['Key'] == temp_file_path:
                                 new_file_name = temp_dict['Key']
                                 new_files.append(new_file_name)
-                                metadata_dict[new_file_name] = temp_dict
+                                metadata_dict[new_file_name] = dict(temp_dict)
 
         output_file_list = list(set(output_file_list + new_files))
         output_file_list.sort()
@@ -1494,7 +3295,7 @@ def find_associated_files(subject_id, associated_files_dict, output_file_list,
 def grab_required_bids_files_v2(subject_id, session_files, requirements_dict, qc_df = None, bucket = 'hbcd-pilot',
                                 prefix = 'assembly_bids', bids_bucket_config = False, session = None, 
                                 session_agnostic_files = ['sessions.tsv'], associated_files_dict = None,
-                                verbose = False):
+                                verbose = False, group_evaluations = None, output = None):
     '''Utility to grab the names of BIDS files required for processing.
     
     This function assumes check_bids_requirements
@@ -1548,6 +3349,8 @@ def grab_required_bids_files_v2(subject_id, session_files, requirements_dict, qc
     The following entry means that brain_SNR should be more than -1000:
     
         {"brain_SNR" : [-1000, "greater_than"]}
+
+    The available operators are listed in QC_OPERATORS.
         
     In some cases criteria may be set to be extremely inclusive. For example
     the brain_SNR criteria will never say that an image should be excluded
@@ -1639,6 +3442,13 @@ def grab_required_bids_files_v2(subject_id, session_files, requirements_dict, qc
         json files, sbref files, bval, bvec files, etc.
     verbose : bool, default False
         Print more details
+    group_evaluations : None or dict, default None
+        Dictionary shared between calls for the same subject/session
+        (i.e. with check_bids_requirements_v2, grab_required_bids_files_v2
+        and check_if_ancestor_file_selection_is_same) so that each
+        requirement group is only evaluated once. See evaluate_requirement_group.
+    output : None or file-like object, default None
+        Where messages are printed (sys.stdout if None)
 
     
     Returns
@@ -1655,51 +3465,26 @@ def grab_required_bids_files_v2(subject_id, session_files, requirements_dict, qc
     output_file_list = []
     metadata_dict = {}
     for i, parent_requirement in enumerate(requirements_dict.keys()):
-        #Check if the current requirement has any associated QC criteria
         if verbose:
-            print('Parent Requirement: {}'.format(parent_requirement))
-        if 'qc_criteria' in requirements_dict[parent_requirement]:
-            num_iters_allowed = len(requirements_dict[parent_requirement]['qc_criteria'])
-            qc_index = 0
-        else:
-            num_iters_allowed = 1
-            qc_index = None
+            print('Parent Requirement: {}'.format(parent_requirement), file = output)
             
-        #The following loop to find files is necessary because there may
+        #Different QC criteria may be tried for the requirement because there may
         #be cases where there is different QC information available for
         #different subjects, and we want to process as many subjects as
         #possible using manual QC measures when they are available, but
         #in absence of manual QC measures we may use automated QC measures.
-        continue_loop = True
-        while continue_loop:
-            #if 1:
-            try:
-                partial_file_list, partial_metadata_dict = grab_required_bids_files_inner(session_files, requirements_dict[parent_requirement], 
-                                                 qc_index = qc_index, qc_df = qc_df, 
-                                                 session_agnostic_files = session_agnostic_files, verbose = verbose)
-                continue_loop = False
-            #if 1:
-            except Exception as error:
-
-                print('    Found the following potential error: {}'.format(error))
-                
-                #I don't think this will ever occur
-                if type(qc_index) == type(None):
-                    raise ValueError('Error: No QC expected for current pipeline, but grab_bids_files_v2_inner still failed.')
-                #If there are more QC Criteria that can be used
-                #then try the next one (since previous one already failed)
-                else:
-                    qc_index += 1
-                    if qc_index == num_iters_allowed:
-                        print('   No QC list was properly evaluated for this subject:')
-                        print(error)
-                        continue_loop = False
-                        return None, None
-           
-        #This should update be only be made once per parent requirement
-        #after the while loop finishes
-        output_file_list = output_file_list + partial_file_list
-        metadata_dict.update(partial_metadata_dict)
+        #(see evaluate_requirement_group)
+        group_evaluation = evaluate_requirement_group(session_files, requirements_dict[parent_requirement], qc_df = qc_df,
+                                                      session_agnostic_files = session_agnostic_files, verbose = verbose,
+                                                      group_evaluations = group_evaluations, output = output)
+        if type(group_evaluation['files']) == type(None):
+            print('   No QC list was properly evaluated for this subject: {} ({})'.format(parent_requirement, group_evaluation['tracking']), file = output)
+            return None, None
+
+        output_file_list = output_file_list + group_evaluation['files']
+        #Copies, since the memoized evaluation may be used again by other calls
+        for temp_key, temp_metadata in group_evaluation['metadata'].items():
+            metadata_dict[temp_key] = dict(temp_metadata)
             
 
         
@@ -1708,7 +3493,8 @@ def grab_required_bids_files_v2(subject_id, session_files, requirements_dict, qc
                               session_files, prefix)
     metadata_dict.update(partial_metadata_dict)
 
-    #Reformat the date information
+    #Reformat the date information. The metadata dicts are copies, so the
+    #S3 inventory and the memoized group evaluations are left untouched.
     for a in metadata_dict.keys():
         for b in metadata_dict[a].keys():
              if isinstance(metadata_dict[a][b], datetime.datetime):
@@ -1733,250 +3519,1034 @@ def grab_required_bids_files_inner(session_files, partial_requirements_dict, qc_
     #is a standalone function is so that different qc_indices can be used, signifying
     #different qc criteria that will be referred to based on what qc measures are
     #available for a given subject.
-    
-    
-    #Grab the current QC criteria. Only necessary if QC Criteria
-    #is in the partial_requirements_dict. If there are more than
+
+    requirement_files = get_requirement_matcher(partial_requirements_dict).classify(session_files)
+    file_assessments = assess_requirement_files(requirement_files, partial_requirements_dict, qc_index = qc_index,
+                                                qc_df = qc_df, session_agnostic_files = session_agnostic_files,
+                                                verbose = verbose)
+
+    candidate_files = []
+    for temp_file, temp_state, qc_values in file_assessments:
+        if temp_state == 'No QC':
+            print('   Exiting processing attempt: No QC info for {}'.format(temp_file['Key']))
+            return None, None
+        elif temp_state == 'Missing QC':
+            raise ValueError('    QC info not available for {}'.format(temp_file['Key']))
+        elif temp_state == 'Satisfied':
+            candidate_files.append((temp_file, qc_values))
+
+    return select_files_to_keep(candidate_files, partial_requirements_dict, qc_index = qc_index, verbose = verbose)
+
+
+def assess_requirement_files(requirement_files, partial_requirements_dict, qc_index = None, qc_df = None,
+                             session_agnostic_files = ['sessions.tsv'], verbose = False, qc_rows = None, output = None):
+    '''Judge the QC of the files that satisfy a requirement group's file naming
+
+    Parameters
+    ----------
+    requirement_files : list of dicts
+        File info (from boto3) for the files that satisfy the
+        "file_naming" of the requirement group (see classify_session_files)
+    partial_requirements_dict : dict
+        The requirement group
+    qc_index : None or int, default None
+        Which of the requirement group's QC criteria groups to use
+    qc_df : None or pandas dataframe
+        The scans.tsv file for the current session
+    session_agnostic_files : list of str, default ['sessions.tsv']
+        Files that aren't expected to have QC information
+    verbose : bool, default False
+        Print more details
+    qc_rows : None or list, default None
+        The output of lookup_qc_row for each entry of requirement_files.
+        Will be looked up if not provided.
+    output : None or file-like object, default None
+        Where messages are printed (sys.stdout if None)
+
+    Returns
+    -------
+    list of (file info, state, qc_values) tuples, one per entry of
+    requirement_files. The state is 'Satisfied', 'Failed QC', 'Missing QC'
+    (a QC value used by the criteria is null or unavailable) or 'No QC'
+    (the file isn't in the scans.tsv). qc_values holds the value of each
+    QC measure in the criteria group for files that are 'Satisfied'.
+
+    '''
+
+    if ('qc_criteria' not in partial_requirements_dict) or (type(qc_df) == type(None)):
+        return [(temp_file, 'Satisfied', []) for temp_file in requirement_files]
+
+    #Grab the current QC criteria. If there are more than
     #one QC Criteria (i.e. there are backup QC criteria), then 
     #the qc_index will say which one is currently being referenced
+    if type(qc_index) == type(None):
+        temp_qc_criteria_group = partial_requirements_dict['qc_criteria']
+    else:
+        temp_qc_criteria_group = partial_requirements_dict['qc_criteria'][qc_index]
+    requirement_matcher = get_requirement_matcher(partial_requirements_dict)
+    temp_verdict_column = requirement_matcher.verdict_column(qc_index)
+    qc_predicates = requirement_matcher.predicates(qc_index)
     if verbose:
-        print('Current QC Index: {}'.format(qc_index))
-    if 'qc_criteria' in partial_requirements_dict:
-        if type(qc_index) == type(None):
-            temp_qc_criteria_group = partial_requirements_dict['qc_criteria']
-        else:
-            temp_qc_criteria_group = partial_requirements_dict['qc_criteria'][qc_index]
-    
-    temp_requirement_file_list = []
-    temp_requirements_metadata_list = []
-    child_requirements = partial_requirements_dict['file_naming']
-    for j, temp_file in enumerate(session_files):
-        child_requirements_satisfied = 0
-        for child_requirement in child_requirements.keys():
-            if (child_requirement in temp_file['Key']) == child_requirements[child_requirement]:
-                child_requirements_satisfied += 1
-            else:
-                break
-        if child_requirements_satisfied == len(child_requirements.keys()):
-            temp_requirement_file_list.append(temp_file['Key'])
-            temp_requirements_metadata_list.append(temp_file)
-
-    counter = 0
-    partial_output_file_list = []
-    partial_output_file_list_qc = []
-    partial_metadata_dict = {}
-    for j, temp_file in enumerate(temp_requirement_file_list):
-        qc_values = []
-        requirement_disqualified = 0
-        if ('qc_criteria' in partial_requirements_dict) and (type(qc_df) != type(None)):
-            partial_df = qc_df[qc_df['filename'].str.contains(temp_file.split('/')[-1])]
-            if len(partial_df) == 0:
-                is_ses_agnostic = 0
-                for temp_ses_agnostic in session_agnostic_files:
-                    if temp_ses_agnostic in temp_file:
-                        is_ses_agnostic = 1
-                if is_ses_agnostic == 0:
-                    print('   Exiting processing attempt: No QC info for {}'.format(temp_file))
-                    return None, None
+        print('Current QC Index: {}'.format(qc_index), file = output)
+        print('   temp_qc_criteria_group: {}'.format(temp_qc_criteria_group), file = output)
 
+    if type(qc_rows) == type(None):
+        qc_rows = [lookup_qc_row(qc_df, temp_file['Key']) for temp_file in requirement_files]
 
+    file_assessments = []
+    for temp_file, partial_df in zip(requirement_files, qc_rows):
+        qc_values = []
+        if type(partial_df) == type(None):
+            is_ses_agnostic = 0
+            for temp_ses_agnostic in session_agnostic_files:
+                if temp_ses_agnostic in temp_file['Key']:
+                    is_ses_agnostic = 1
+            if is_ses_agnostic == 0:
+                temp_state = 'No QC'
+            elif len(temp_qc_criteria_group):
+                temp_state = 'Missing QC'
+            else:
+                temp_state = 'Satisfied'
+            file_assessments.append((temp_file, temp_state, qc_values))
+            continue
+
+        #Use the verdict from build_qc_table if one is available. Files
+        #that pass still need their QC values for ranking.
+        temp_verdict = None
+        if temp_verdict_column in partial_df.columns:
+            temp_verdict = partial_df[temp_verdict_column].values[0]
+        if temp_verdict == 'missing':
+            temp_state = 'Missing QC'
+        elif temp_verdict == 'fail':
+            temp_state = 'Failed QC'
+        else:
             #Iterate through each QC requirement (the requirements are
-            #stored as a list of dictionaries, each with one key/value pair)
-            if verbose:
-                print('File being investigated: {}'.format(temp_file.split('/')[-1]))
-            if verbose:
-                print('   temp_qc_criteria_group: {}'.format(temp_qc_criteria_group))
-            for temp_qc_criteria in temp_qc_criteria_group:
-                if verbose:
-                    print('   temp_qc_criteria: {}'.format(temp_qc_criteria))
-                for temp_dict_key in temp_qc_criteria:
-                    
-                    #Check if there is a null value for the current QC criteria.
-                    #If there is a null value here, we will want to error out so
-                    #the next grouping of QC criteria can be used if one is available.
-                    #print('temp_dict: {}'.format(temp_dict))
-                    #temp_dict_key = list(temp_dict.keys())[0]
-                    if pd.isnull(partial_df[temp_dict_key].values[0]):
-                        if verbose:
-                            print('   SKIPPING CRITERIA BECAUSE NULL WAS IDENTIFIED: {}'.format(partial_df[temp_dict_key].values[0]))
-                        raise ValueError('    QC info not available for {}: {} ({})'.format(temp_dict_key, partial_df[temp_dict_key].values[0], temp_file))
-                    
-                    if verbose:
-                        print('     is {} {} {} : {}'.format(partial_df[temp_dict_key].values[0], temp_qc_criteria[temp_dict_key][1], temp_qc_criteria[temp_dict_key][0], temp_file))
-                    if make_comparison(partial_df[temp_dict_key].values[0], temp_qc_criteria[temp_dict_key][1], temp_qc_criteria[temp_dict_key][0]):
-                        qc_values.append(partial_df[temp_dict_key].values[0])
-                    else:
-                        requirement_disqualified = 1
-                    
-
-        #I think the code below should work whether or not QC information is present
-        if requirement_disqualified == 0:
-            if 'num_to_keep' not in partial_requirements_dict.keys():
-                partial_output_file_list.append(temp_file)
-                partial_output_file_list_qc.append(qc_values)
-                partial_metadata_dict[temp_file] = temp_requirements_metadata_list[j]
-            elif partial_requirements_dict['num_to_keep'] > counter:
-                partial_output_file_list.append(temp_file)
-                partial_output_file_list_qc.append(qc_values)
-                partial_metadata_dict[temp_file] = temp_requirements_metadata_list[j]
-                counter += 1
-            else:                
-                
-                if verbose:
-                    print('Partial output file list qc: {}'.format(partial_output_file_list_qc))
-                #Check which of the existing files has the worst QC values
-                worst_existing_file_qc = partial_output_file_list_qc[0]
-                worst_existing_file_qc_index = 0
-                for qc_ind, temp_qc_partial in enumerate(partial_output_file_list_qc):
-                    for temp_qc_item in range(len(partial_output_file_list_qc[0])):
-                        if verbose:
-                            print('temp_qc_partial {}'.format(temp_qc_partial))
-                            print('qc_ind {}'.format(qc_ind))
-                        #If QC measure is worse in the current file, then remark this as the worst file
-                        #if temp_qc_partial[temp_qc_item] > worst_existing_file_qc[temp_qc_item]:
-                        temp_inner_qc_criteria_dict = temp_qc_criteria_group[temp_qc_item]
-                        temp_operator = list(temp_inner_qc_criteria_dict.values())[0][1]
-                        if make_comparison(worst_existing_file_qc[temp_qc_item], temp_operator, temp_qc_partial[temp_qc_item]): #Ordering of make_comparison is swapped here to highlight the worst
-                            #If QC measure is the same in the current file, check the next item
-                            if temp_qc_partial[temp_qc_item] == worst_existing_file_qc[temp_qc_item]:
-                                continue
-                            #If QC measure is better in the current file, move on to the next file
-                            else:
-                                worst_existing_file_qc_index = qc_ind
-                                worst_existing_file_qc = partial_output_file_list_qc[qc_ind]
-                                break
-                                
-                if verbose:
-                    print('   Worst existing file qc: {}'.format(worst_existing_file_qc))
-                    print('   Worst existing file qc index: {}'.format(worst_existing_file_qc_index))
-
-                #See if the current file is better/worse than the worst file
-                for temp_qc_item in range(len(worst_existing_file_qc)):
-
-                    #If new file is better, then update the file list with the
-                    #current file
-                    temp_inner_qc_criteria_dict = temp_qc_criteria_group[temp_qc_item]
-                    temp_operator = list(temp_inner_qc_criteria_dict.values())[0][1]
-                    #if worst_existing_file_qc[temp_qc_item] > qc_values[temp_qc_item]:
-                    if verbose:
-                        print('is {} {} {}'.format(qc_values[temp_qc_item], temp_operator, worst_existing_file_qc[temp_qc_item]))
-                        
-                    #Skip the comparison if the measure is boolean. If both files are considered, then they both will
-                    #have already passed this.
-                    if type(qc_values[temp_qc_item]) == bool:
-                        continue
-                    #If there is a tie, then check the next measure. Eventually this will lead to one file being
-                    #arbritrarily being chosen based on file name if there are ties all the way down (this is fine)
-                    elif qc_values[temp_qc_item] == worst_existing_file_qc[temp_qc_item]:
-                        continue
-                    elif make_comparison(qc_values[temp_qc_item], temp_operator, worst_existing_file_qc[temp_qc_item]):
-                        del partial_metadata_dict[partial_output_file_list[worst_existing_file_qc_index]]
-                        partial_metadata_dict[temp_file] = temp_requirements_metadata_list[j]
-                        partial_output_file_list[worst_existing_file_qc_index] = temp_file
-                        partial_output_file_list_qc[worst_existing_file_qc_index] = qc_values
+            #stored as a list of dictionaries, each with one key/value pair).
+            #A null value for any of the criteria means that the next grouping
+            #of QC criteria should be used if one is available.
+            temp_state = 'Satisfied'
+            try:
+                for temp_dict_key, temp_comparison, reference in qc_predicates:
+                    temp_value = partial_df[temp_dict_key].values[0]
+                    if pd.isnull(temp_value):
+                        temp_state = 'Missing QC'
                         break
-                    #If new file is worse, then move on and ignore the current file
-                    #elif worst_existing_file_qc[temp_qc_item] > qc_values[temp_qc_item]:
+                    if (temp_verdict == 'pass') or temp_comparison(temp_value, reference):
+                        qc_values.append(temp_value)
                     else:
-                        break
+                        temp_state = 'Failed QC'
+            except (KeyError, TypeError) as error:
+                if verbose:
+                    print('   Unable to evaluate QC for {}: {}'.format(temp_file['Key'], error), file = output)
+                temp_state = 'Missing QC'
+
+        if verbose:
+            print('   QC for {}: {}'.format(temp_file['Key'].split('/')[-1], temp_state), file = output)
+        file_assessments.append((temp_file, temp_state, qc_values))
+
+    return file_assessments
+
+
+def summarize_requirement_assessments(file_assessments, output = None):
+    '''Turn the output of assess_requirement_files into a requirement status
+
+    Messages are printed to output (sys.stdout if None).
+
+    Returns
+    -------
+    True if at least one file is satisfied, False if not, or None if
+    a file is missing QC information (for the first such file, in order)
+    str
+        Tracking status ('Satisfied', 'Failed QC', 'No File', 'Missing QC' or 'No QC')
+
+    '''
+
+    any_passing = False
+    temp_tracking_status = 'No File'
+    for temp_file, temp_state, _ in file_assessments:
+        if temp_state == 'No QC':
+            print('   Exiting processing attempt: No QC info for {}'.format(temp_file['Key']), file = output)
+            return None, 'No QC'
+        elif temp_state == 'Missing QC':
+            return None, 'Missing QC'
+        elif temp_state == 'Failed QC':
+            if temp_tracking_status != 'Satisfied':
+                temp_tracking_status = 'Failed QC'
+        else:
+            any_passing = True
+            temp_tracking_status = 'Satisfied'
+
+    return any_passing, temp_tracking_status
+
+
+def select_files_to_keep(candidate_files, partial_requirements_dict, qc_index = None, verbose = False, output = None):
+    '''Choose which files that pass QC will be used for processing
+
+    If the requirement group has "num_to_keep" and more files than
+    that pass QC, the files are ranked by their QC values (see
+    qc_ranking_key) and only the best "num_to_keep" files are kept.
+    Files with the same QC values are ranked by file name.
+
+    Parameters
+    ----------
+    candidate_files : list of tuples
+        (file info, qc_values) for each file that passed QC, in the
+        order of the session files (see assess_requirement_files)
+    partial_requirements_dict : dict
+        The requirement group
+    qc_index : None or int, default None
+        Which of the requirement group's QC criteria groups was used
+    verbose : bool, default False
+        Print more details
+    output : None or file-like object, default None
+        Where messages are printed (sys.stdout if None)
+
+    Returns
+    -------
+    list
+        Paths of the files that were kept, in the same order
+        as candidate_files
+    dict
+        File info for each kept file (copies of the
+        dicts in candidate_files)
+
+    '''
+
+    num_to_keep = partial_requirements_dict.get('num_to_keep', None)
+    if (type(num_to_keep) != type(None)) and (len(candidate_files) > num_to_keep):
+        temp_qc_criteria_group = []
+        if 'qc_criteria' in partial_requirements_dict:
+            if type(qc_index) == type(None):
+                temp_qc_criteria_group = partial_requirements_dict['qc_criteria']
+            else:
+                temp_qc_criteria_group = partial_requirements_dict['qc_criteria'][qc_index]
+        best_files = heapq.nsmallest(num_to_keep, enumerate(candidate_files),
+                                     key = lambda temp_candidate: (qc_ranking_key(temp_candidate[1][1], temp_qc_criteria_group),
+                                                                   temp_candidate[1][0]['Key']))
+        candidate_files = [temp_candidate for _, temp_candidate in sorted(best_files, key = lambda temp_candidate: temp_candidate[0])]
+        if verbose:
+            print('   Best {} file(s) by QC: {}'.format(num_to_keep, [temp_file['Key'] for temp_file, _ in candidate_files]), file = output)
+
+    partial_output_file_list = [temp_file['Key'] for temp_file, _ in candidate_files]
+    partial_metadata_dict = {temp_file['Key'] : dict(temp_file) for temp_file, _ in candidate_files}
+
+    return partial_output_file_list, partial_metadata_dict
+
+
+#How QC values are ranked when choosing between files (see qc_ranking_key).
+#1 means that smaller values are better, and -1 means that larger values are
+#better. QC measures whose operator isn't listed are not used for ranking.
+QC_RANKING_DIRECTIONS = {'less_than' : 1, 'less_than_or_equal' : 1,
+                         'greater_than' : -1, 'greater_than_or_equal' : -1}
+
+
+class _DescendingValue:
+    '''Wrapper that reverses the ordering of a (non-numeric) value'''
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def qc_ranking_key(qc_values, qc_criteria_group):
+    '''Build a key for sorting files from best to worst QC
+
+    Parameters
+    ----------
+    qc_values : list
+        Value of each QC measure in qc_criteria_group for a file
+        (see assess_requirement_files)
+    qc_criteria_group : list of dicts
+        The QC criteria group used to judge the file
+
+    Returns
+    -------
+    tuple
+        Key where smaller means better QC. Measures are compared in the
+        order they are listed in qc_criteria_group, so later measures are
+        only used to break ties. Boolean measures and measures whose operator
+        doesn't imply an ordering (i.e. 'equals') are skipped.
+
+    '''
+
+    qc_operators = [temp_qc_criteria[temp_dict_key][1] for temp_qc_criteria in qc_criteria_group for temp_dict_key in temp_qc_criteria]
+    ranking_key = []
+    for temp_value, temp_operator in zip(qc_values, qc_operators):
+        direction = QC_RANKING_DIRECTIONS.get(temp_operator, None)
+        if (type(direction) == type(None)) or isinstance(temp_value, (bool, np.bool_)):
+            continue
+        if direction == 1:
+            ranking_key.append(temp_value)
+        elif isinstance(temp_value, numbers.Number):
+            ranking_key.append(-temp_value)
+        else:
+            ranking_key.append(_DescendingValue(temp_value))
+
+    return tuple(ranking_key)
+
+
+def group_evaluation_key(requirement, qc_df = None, session_agnostic_files = ['sessions.tsv']):
+    '''Key used to store the output of evaluate_requirement_group
+
+    Made from the content of the requirement group (so identical groups
+    from different pipelines share a key), the version of the scans.tsv
+    file (its ETag, see fetch_scans_tsv_file) and the session agnostic files.
+    The session files are not part of the key, so keys should only be
+    compared for the same subject/session. Returns None if qc_df has no
+    'qc_version' (i.e. it wasn't loaded by fetch_scans_tsv_file), in which
+    case the evaluation shouldn't be stored.
+
+    '''
+
+    if type(qc_df) == type(None):
+        qc_version = None
+    elif 'qc_version' in qc_df.attrs:
+        qc_version = qc_df.attrs['qc_version']
+    else:
+        return None
+
+    return (get_requirement_matcher(requirement).requirement_hash, qc_version, tuple(session_agnostic_files))
+
+
+def evaluate_requirement_group(session_files, requirement, qc_df = None,
+                               session_agnostic_files = ['sessions.tsv'], verbose = False,
+                               group_evaluations = None, output = None):
+    '''Evaluate a requirement group once for both checking and grabbing files
+
+    Files are matched to the requirement group and their QC rows are found
+    once. Then QC criteria groups are tried in order until one can be used
+    to judge all files (the same fallback used by check_bids_requirements_v2
+    and grab_required_bids_files_v2).
+
+    Parameters
+    ----------
+    session_files : list of dicts
+        File info for the subject/session (see grab_session_specific_file_info)
+    requirement : dict
+        The requirement group (i.e. the "T1" entry of a requirements dict)
+    qc_df : None or pandas dataframe
+        The scans.tsv file for the current session
+    session_agnostic_files : list of str, default ['sessions.tsv']
+        Files that aren't expected to have QC information
+    verbose : bool, default False
+        Print more details
+    group_evaluations : None or dict, default None
+        Evaluations that have already been made for the current
+        subject/session. If provided, the evaluation is looked up
+        here (and stored here) using group_evaluation_key, so that
+        requirement groups with the same content are only evaluated
+        once per subject/session, no matter which pipeline they
+        come from. The same dictionary must never be used for a
+        different subject/session. Nothing is stored if qc_df has
+        no 'qc_version' (see group_evaluation_key).
+    output : None or file-like object, default None
+        Where messages are printed (sys.stdout if None)
+
+    Returns
+    -------
+    dict
+        'status' : True/False/None, as returned by check_bids_requirements_v2_inner
+        'tracking' : tracking status for the requirement group
+        'files' : list of selected file paths, or None if no QC criteria
+        group could be used to select files
+        'metadata' : dict with the file info of selected files, or None
+
+    '''
+
+    requirement_matcher = get_requirement_matcher(requirement)
+    evaluation_key = None
+    if type(group_evaluations) != type(None):
+        evaluation_key = group_evaluation_key(requirement, qc_df = qc_df, session_agnostic_files = session_agnostic_files)
+        if evaluation_key in group_evaluations:
+            return group_evaluations[evaluation_key]
+
+    requirement_files = requirement_matcher.classify(session_files)
+    if ('qc_criteria' in requirement) and (type(qc_df) != type(None)):
+        qc_rows = [lookup_qc_row(qc_df, temp_file['Key']) for temp_file in requirement_files]
+        qc_indices = list(range(len(requirement['qc_criteria'])))
+    else:
+        qc_rows = None
+        qc_indices = [0] if 'qc_criteria' in requirement else [None]
+
+    group_evaluation = {'status' : None, 'tracking' : 'No File', 'files' : None, 'metadata' : None}
+    qc_row_missing = False
+    for qc_index in qc_indices:
+        file_assessments = assess_requirement_files(requirement_files, requirement, qc_index = qc_index, qc_df = qc_df,
+                                                    session_agnostic_files = session_agnostic_files,
+                                                    verbose = verbose, qc_rows = qc_rows, output = output)
+        temp_status, temp_tracking = summarize_requirement_assessments(file_assessments, output = output)
+        group_evaluation['status'] = temp_status
+        group_evaluation['tracking'] = temp_tracking
+        #A file without a row in scans.tsv can't be judged, so no files are selected for the group
+        if temp_tracking == 'No QC':
+            qc_row_missing = True
+        if type(temp_status) != type(None):
+            if qc_row_missing == False:
+                candidate_files = [(temp_file, qc_values) for temp_file, temp_state, qc_values in file_assessments if temp_state == 'Satisfied']
+                group_evaluation['files'], group_evaluation['metadata'] = select_files_to_keep(candidate_files, requirement,
+                                                                                                qc_index = qc_index, verbose = verbose, output = output)
+            break
+
+    if type(evaluation_key) != type(None):
+        group_evaluations[evaluation_key] = group_evaluation
+
+    return group_evaluation
+
+
+def check_all_files_old_enough(metadata_dict, minimum_file_age_days, 
+                               file_patterns_to_ignore = ['sessions.tsv'],
+                               verbose = False, output = None):
+    '''
+    If all files in metadata_dict have timestamp of at least minimum_file_age_days
+    ago, return True, otherwise return False. Allow files to be excluded in this
+    age comparison through the file_patterns_to_ignore list.
+    Messages are printed to output (sys.stdout if None).
+    '''
+    
+    
+    today = date.today()
+    
+    for temp_file in metadata_dict.keys():
+        skip_file = False
+        for temp_pattern in file_patterns_to_ignore:
+            if metadata_dict[temp_file]['Key'].endswith(temp_pattern):
+                skip_file = True
+                break
+        
+        if skip_file == False:
+            file_upload_day = date.fromisoformat(metadata_dict[temp_file]['LastModified'].split('T')[0])
+            day_difference = today - file_upload_day
+            if verbose:
+                print('{} Uploaded {} days ago'.format(temp_file.split('/')[-1], day_difference.days), file = output)
+            if day_difference.days < minimum_file_age_days:
+                return False
+        
+    return True
+
+class RequirementMatcher:
+    '''Compiled version of a single requirement group
+
+    A requirement group is one entry of a comprehensive_processing_prerequisites
+    json (i.e. the "T1" entry in the example from grab_required_bids_files_v2).
+    The "file_naming" entry is split into the phrases that must be in a file
+    name and the phrases that must not be, and the QC criteria groups are
+    stored along with the names of their verdict columns (see build_qc_table)
+    and their compiled comparisons (see compile_qc_criteria_group). Invalid
+    QC criteria raise a ValueError (see validate_qc_criteria).
+    requirement_hash identifies requirement groups with the same content.
+
+    Parameters
+    ----------
+
+    requirement : dict
+        The requirement group
+
+    '''
+
+    def __init__(self, requirement):
+
+        file_naming = requirement['file_naming']
+        self.include_tokens = tuple(temp_token for temp_token, temp_value in file_naming.items() if temp_value == True)
+        self.exclude_tokens = tuple(temp_token for temp_token, temp_value in file_naming.items() if temp_value == False)
+        self.other_tokens = tuple((temp_token, temp_value) for temp_token, temp_value in file_naming.items()
+                                  if (temp_value != True) and (temp_value != False))
+        if len(self.exclude_tokens):
+            self.exclude_pattern = re.compile('|'.join(re.escape(temp_token) for temp_token in self.exclude_tokens))
+        else:
+            self.exclude_pattern = None
+
+        if 'qc_criteria' in requirement:
+            validate_qc_criteria(requirement['qc_criteria'])
+            self.qc_criteria_groups = tuple(requirement['qc_criteria'])
+            self.verdict_columns = tuple(qc_verdict_column(temp_group) for temp_group in self.qc_criteria_groups)
+            self.qc_predicates = tuple(compile_qc_criteria_group(temp_group) for temp_group in self.qc_criteria_groups)
+        else:
+            self.qc_criteria_groups = None
+            self.verdict_columns = None
+            self.qc_predicates = None
+        self.num_to_keep = requirement.get('num_to_keep', None)
+        self.requirement_hash = hashlib.md5(json.dumps(requirement, sort_keys = True).encode()).hexdigest()
+
+    def matches(self, file_key):
+        '''Return True if file_key satisfies the "file_naming" requirements'''
+
+        for temp_token in self.include_tokens:
+            if temp_token not in file_key:
+                return False
+        if (type(self.exclude_pattern) != type(None)) and self.exclude_pattern.search(file_key):
+            return False
+        for temp_token, temp_value in self.other_tokens:
+            if (temp_token in file_key) != temp_value:
+                return False
+        return True
+
+    def classify(self, session_files):
+        '''Return the entries of session_files (boto3 file info) whose Key matches'''
+
+        return [temp_file for temp_file in session_files if self.matches(temp_file['Key'])]
+
+    def predicates(self, qc_index):
+        '''Compiled comparisons for the QC criteria group at qc_index'''
+
+        if type(qc_index) == type(None):
+            return compile_qc_criteria_group(list(self.qc_criteria_groups))
+        return self.qc_predicates[qc_index]
+
+    def verdict_column(self, qc_index):
+        '''Name of the verdict column for the QC criteria group at qc_index'''
+
+        if type(qc_index) == type(None):
+            return qc_verdict_column(list(self.qc_criteria_groups))
+        return self.verdict_columns[qc_index]
+
+
+def compile_qc_criteria_group(qc_criteria_group):
+    '''Turn a QC criteria group into a tuple of (measure, comparison function, reference)'''
+
+    qc_predicates = []
+    for temp_qc_criteria in qc_criteria_group:
+        for temp_dict_key in temp_qc_criteria:
+            reference, temp_operator = temp_qc_criteria[temp_dict_key]
+            qc_predicates.append((temp_dict_key, QC_OPERATORS[temp_operator], reference))
+    return tuple(qc_predicates)
+
+
+class RequirementGroup(dict):
+    '''A requirement group (dict) that carries its compiled RequirementMatcher
+
+    Behaves exactly like the dictionary loaded from json, but also
+    has a matcher attribute so that the requirements don't need to
+    be interpreted again for every subject.
+
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.matcher = RequirementMatcher(self)
+
+
+@functools.lru_cache(maxsize = 256)
+def compile_requirement_matcher(requirement_json):
+    '''Compile a RequirementMatcher from a requirement group saved as json text
+
+    Requirement groups with the same content share one
+    matcher (see get_requirement_matcher).
+
+    '''
+
+    return RequirementMatcher(json.loads(requirement_json))
+
+
+def get_requirement_matcher(requirement):
+    '''Return the RequirementMatcher for a requirement group
+
+    Uses the matcher stored on RequirementGroup objects. Plain
+    dictionaries are looked up by content, so they are only
+    compiled the first time they are seen (see compile_requirement_matcher).
+
+    '''
+
+    if isinstance(requirement, RequirementGroup):
+        return requirement.matcher
+    return compile_requirement_matcher(json.dumps(requirement, sort_keys = True))
+
+
+def classify_session_files(session_files, requirement):
+    '''Find the session files that satisfy a requirement group's file naming
+
+    Parameters
+    ----------
+    session_files : list of dicts
+        File info generated from boto3 (see grab_session_specific_file_info)
+    requirement : dict or RequirementGroup
+        The requirement group
+
+    Returns
+    -------
+    list of the entries in session_files whose Key satisfies the
+    "file_naming" requirements, in the same order as session_files
+
+    '''
+
+    return get_requirement_matcher(requirement).classify(session_files)
+
+
+def load_requirements_infos(pipeline_name):
+
+    #Load the "comprehensive_processing_prerequisites" json files that are the same for each subject
+    #These files at least say which files are required for processing, and may also specify other
+    #requirements such as the number of files required for processing or whether any QC requirements
+    #need to be met for a file to be included in processing
+    requirements_files = []
+    comp_proc_recs_dir = os.path.join(Path(inspect.getfile(update_processing)).absolute().parent.resolve(), 'comprehensive_processing_prerequisites')
+    for filename in os.listdir(comp_proc_recs_dir):
+        # Use regular expression to match pipeline name with or without underscore and number
+        match = re.match(rf"^{pipeline_name}(?:_[0-9]+)?\.json$", filename)
+        if match:
+            requirements_files.append(os.path.join(comp_proc_recs_dir, filename))
+
+    requirements_dicts = []
+    for temp_requirement_file in requirements_files:
+        with open(temp_requirement_file, 'r') as f:
+            temp_dict = json.load(f)
+        requirements_dicts.append({temp_key : RequirementGroup(temp_value) for temp_key, temp_value in temp_dict.items()})
+    
+    #Rearange the requirements files dictionaries into one dictionary
+    #that has all the possible file types that we will want to grab.
+    file_selection_dict = {}
+    for temp_dict in requirements_dicts:
+        for temp_key in temp_dict.keys():
+            if temp_key in file_selection_dict.keys():
+                if temp_dict[temp_key] != file_selection_dict[temp_key]:
+                    raise ValueError('Error: {} has conflicting requirements for {}'.format(pipeline_name, temp_key))
+            else:
+                file_selection_dict[temp_key] = temp_dict[temp_key]
+    
+    return requirements_dicts, file_selection_dict
+
+def download_cbrain_misc_file(derivative_bucket_config, derivatives_bucket_prefix,
+                              subject, bucket, pipeline_name, output_folder,
+                              ending = 'UMNProcSubmission.json'):
+    '''Download json from cbrain_misc folder
+    
+    Assumes there will be a file in the derivatives bucket with
+    the naming convention:
+    
+    {bucket}/{derivatives_bucket_prefix}/cbrain_misc/{subject}_{pipeline_name}_{ending}
+        
+    Returns
+    -------
+    
+    Path to downloaded json file if download was successful,
+    otherwise returns None
+        
+    '''
+
+    client = create_boto3_client(s3_config = derivative_bucket_config)
+    file_to_download = os.path.join(derivatives_bucket_prefix, 'cbrain_misc', '{}_{}_{}'.format(subject, pipeline_name, ending))
+    downloaded_file = os.path.join(output_folder, file_to_download.split('/')[-1])
+    try:
+        client.download_file(bucket, file_to_download, downloaded_file)
+    except:
+        return None
+            
+    return downloaded_file
+
+def load_submission_log_metadata(client, bucket, log_key, output = None):
+    '''Load a submission log from S3 and return its s3_metadata reduced to file sizes
+
+    Returns None (and prints a warning to output, or sys.stdout
+    if output is None) if the log can't be loaded.
+    See prefetch_submission_logs for the format of the output.
+
+    '''
+
+    try:
+        response = client.get_object(Bucket = bucket, Key = log_key)
+        json_content = json.loads(response['Body'].read())
+        return {temp_file : {'Size' : temp_metadata['Size']} for temp_file, temp_metadata in json_content['s3_metadata'].items()}
+    except Exception as error:
+        print('   Warning: unable to load {} ({})'.format(log_key, error), file = output)
+        return None
+
+
+def list_submission_logs(derivatives_bucket_config, derivatives_bucket, derivatives_bucket_prefix,
+                         subjects = None, pipelines = None, ending = 'UMNProcSubmission.json'):
+    '''List the cbrain_misc submission logs of a session
+
+    Lists {derivatives_bucket_prefix}/cbrain_misc/ once and finds the
+    logs named {subject}_{pipeline}_{ending} (see download_cbrain_misc_file).
+
+    Parameters
+    ----------
+    derivatives_bucket_config : str
+        Path to s3 config file used to access the derivatives bucket
+    derivatives_bucket : str
+        Name of the derivatives bucket
+    derivatives_bucket_prefix : str
+        The prefix for the current session (i.e. 'derivatives/ses-V02')
+    subjects : None or list of str, default None
+        If provided, only logs for these subjects will be listed
+    pipelines : None or list of str, default None
+        If provided, only logs for these pipelines will be listed
+    ending : str, default 'UMNProcSubmission.json'
+        The ending of the log file names
+
+    Returns
+    -------
+    dict
+        Dictionary whose keys are (subject, pipeline) pairs and whose
+        values are dictionaries with the 'Key', 'ETag' and 'LastModified'
+        (isoformat string) of the log (see submission_log_info).
+
+    '''
+
+    if type(subjects) != type(None):
+        subjects = set(subjects)
+    if type(pipelines) != type(None):
+        pipelines = set(pipelines)
+
+    misc_prefix = os.path.join(derivatives_bucket_prefix, 'cbrain_misc') + '/'
+    client = create_boto3_client(s3_config = derivatives_bucket_config)
+    paginator = client.get_paginator('list_objects_v2')
+    page_iterator = paginator.paginate(Bucket = derivatives_bucket, Prefix = misc_prefix, Delimiter = '/')
+
+    log_listing = {}
+    for page in page_iterator:
+        for temp_object in page.get('Contents', []):
+            temp_name = temp_object['Key'][len(misc_prefix):]
+            if (not temp_name.endswith('_' + ending)) or ('_' not in temp_name[:-len(ending) - 1]):
+                continue
+            subject, pipeline = temp_name[:-len(ending) - 1].split('_', 1)
+            if (type(subjects) != type(None)) and (subject not in subjects):
+                continue
+            if (type(pipelines) != type(None)) and (pipeline not in pipelines):
+                continue
+            log_listing[(subject, pipeline)] = submission_log_info(temp_object['Key'], temp_object)
+
+    return log_listing
+
+
+def submission_log_info(log_key, s3_object):
+    '''Version information of a submission log from a listing or head_object response'''
+
+    last_modified = s3_object['LastModified']
+    if hasattr(last_modified, 'isoformat'):
+        last_modified = last_modified.isoformat()
+    return {'Key' : log_key, 'ETag' : s3_object['ETag'], 'LastModified' : last_modified}
+
+
+def prefetch_submission_logs(derivatives_bucket_config, derivatives_bucket, derivatives_bucket_prefix,
+                             subjects = None, pipelines = None, ending = 'UMNProcSubmission.json',
+                             max_workers = 16, exclude = None, log_listing = None):
+    '''Load the s3_metadata from many cbrain_misc submission logs at once
+
+    Lists {derivatives_bucket_prefix}/cbrain_misc/ once (see list_submission_logs),
+    and then loads the logs named {subject}_{pipeline}_{ending} concurrently,
+    without saving them to disk.
+
+    Parameters
+    ----------
+    derivatives_bucket_config : str
+        Path to s3 config file used to access the derivatives bucket
+    derivatives_bucket : str
+        Name of the derivatives bucket
+    derivatives_bucket_prefix : str
+        The prefix for the current session (i.e. 'derivatives/ses-V02')
+    subjects : None or list of str, default None
+        If provided, only logs for these subjects will be loaded
+    pipelines : None or list of str, default None
+        If provided, only logs for these pipelines will be loaded
+    ending : str, default 'UMNProcSubmission.json'
+        The ending of the log file names
+    max_workers : int, default 16
+        The number of logs to load at the same time
+        (see map_with_workers)
+    exclude : None or set, default None
+        (subject, pipeline) pairs whose logs should not be loaded
+    log_listing : None or dict, default None
+        Output of list_submission_logs for the same session, if it
+        has already been made. subjects, pipelines and ending are
+        not used if log_listing is provided.
+
+    Returns
+    -------
+    dict
+        Dictionary whose keys are (subject, pipeline) pairs and whose
+        values are the s3_metadata from the log, reduced to the 'Size' of
+        each file (i.e. {'ses-V02/anat/sub-1_T1w.nii.gz' : {'Size' : 100}}).
+        Subjects/pipelines without a log are not included.
+
+    '''
+
+    if type(log_listing) == type(None):
+        log_listing = list_submission_logs(derivatives_bucket_config, derivatives_bucket, derivatives_bucket_prefix,
+                                           subjects = subjects, pipelines = pipelines, ending = ending)
+    client = create_boto3_client(s3_config = derivatives_bucket_config)
+
+    logs_to_load = {}
+    for temp_key, temp_log_info in log_listing.items():
+        if (type(exclude) != type(None)) and (temp_key in exclude):
+            continue
+        logs_to_load[temp_key] = temp_log_info['Key']
+
+    def load_s3_metadata(log_key):
+        return load_submission_log_metadata(client, derivatives_bucket, log_key)
+
+    submission_logs = {}
+    log_keys = list(logs_to_load.keys())
+    for temp_key, s3_metadata in zip(log_keys, map_with_workers(load_s3_metadata, [logs_to_load[temp_key] for temp_key in log_keys],
+                                                                max_workers = max_workers)):
+        if type(s3_metadata) != type(None):
+            submission_logs[temp_key] = s3_metadata
+
+    return submission_logs
+
+
+def compute_selection_fingerprint(s3_metadata, session_agnostic_files = ['sessions.tsv'], extensions_to_skip = ['.json']):
+    '''Summarize the files selected for processing in a short string
+
+    Two selections have the same fingerprint when they have the same
+    files (ignoring session agnostic files) and the same file sizes
+    (ignoring files with extensions_to_skip), which is the same thing
+    that check_if_ancestor_file_selection_is_same compares.
+
+    Parameters
+    ----------
+    s3_metadata : dict
+        Dictionary whose keys are the selected files and whose values
+        have the 'Size' of each file (i.e. the s3_metadata of a submission log)
+    session_agnostic_files : list of str, default ['sessions.tsv']
+        Files ending with these are ignored
+    extensions_to_skip : list of str, default ['.json']
+        The sizes of files ending with these are ignored
+
+    Returns
+    -------
+    str
+        'sha256:' followed by the hash of the selection
+
+    '''
+
+    selection = []
+    for temp_file in sorted(s3_metadata.keys()):
+        if any(temp_file.endswith(temp_agnostic) for temp_agnostic in session_agnostic_files):
+            continue
+        if any(temp_file.endswith(temp_extension) for temp_extension in extensions_to_skip):
+            selection.append([temp_file, None])
+        else:
+            selection.append([temp_file, s3_metadata[temp_file]['Size']])
+
+    return 'sha256:' + hashlib.sha256(json.dumps(selection).encode()).hexdigest()
+
+
+#Name of the file (under each session's cbrain_misc folder) that holds the
+#selection fingerprints of the subjects/pipelines submitted for the session.
+#Each entry also has the ETag and LastModified of the submission log it was
+#made from, so that entries can be checked against the current logs.
+SELECTION_FINGERPRINTS_FILE = 'selection_fingerprints.json'
+
+#How many times save_selection_fingerprints tries to update SELECTION_FINGERPRINTS_FILE
+#when another run changes the file between loading and saving it
+SELECTION_FINGERPRINTS_SAVE_ATTEMPTS = 5
+
+
+def selection_fingerprint_entry(fingerprint, log_info):
+    '''Entry stored in SELECTION_FINGERPRINTS_FILE for a submission log (see submission_log_info)'''
+
+    return {'fingerprint' : fingerprint, 'log_etag' : log_info['ETag'], 'log_last_modified' : log_info['LastModified']}
+
+
+def load_selection_fingerprints(derivatives_bucket_config, derivatives_bucket, misc_prefix):
+    '''Load the selection fingerprints stored for a session
+
+    Parameters
+    ----------
+    derivatives_bucket_config : str
+        Path to s3 config file used to access the derivatives bucket
+    derivatives_bucket : str
+        Name of the derivatives bucket
+    misc_prefix : str
+        The cbrain_misc folder for the session (i.e. 'derivatives/ses-V02/cbrain_misc')
+
+    Returns
+    -------
+    dict
+        Dictionary whose keys are (subject, pipeline) pairs and whose values are
+        entries made by selection_fingerprint_entry. Empty if there is no file.
+        Entries in any other format are skipped. The entries should be checked
+        with validate_selection_fingerprints before they are used.
+
+    '''
+
+    client = create_boto3_client(s3_config = derivatives_bucket_config)
+    try:
+        selection_fingerprints, _ = read_selection_fingerprints_file(client, derivatives_bucket,
+                                                                     os.path.join(misc_prefix, SELECTION_FINGERPRINTS_FILE))
+    except ClientError:
+        return {}
+
+    return selection_fingerprints
 
 
-    return partial_output_file_list, partial_metadata_dict
+def read_selection_fingerprints_file(client, derivatives_bucket, fingerprints_key):
+    '''Load SELECTION_FINGERPRINTS_FILE along with its ETag
+
+    Returns the entries (see load_selection_fingerprints) and the
+    ETag of the file, or ({}, None) if there is no file. Other
+    errors from S3 are raised.
 
-def check_all_files_old_enough(metadata_dict, minimum_file_age_days, 
-                               file_patterns_to_ignore = ['sessions.tsv'],
-                               verbose = False):
     '''
-    If all files in metadata_dict have timestamp of at least minimum_file_age_days
-    ago, return True, otherwise return False. Allow files to be excluded in this
-    age comparison through the file_patterns_to_ignore list.
+
+    try:
+        response = client.get_object(Bucket = derivatives_bucket, Key = fingerprints_key)
+        stored_fingerprints = json.loads(response['Body'].read())
+    except ClientError as error:
+        if error.response.get('Error', {}).get('Code') in S3_MISSING_OBJECT_CODES:
+            return {}, None
+        raise
+
+    selection_fingerprints = {}
+    for temp_key, temp_entry in stored_fingerprints.items():
+        if (type(temp_entry) != dict) or ('fingerprint' not in temp_entry):
+            continue
+        subject, pipeline = temp_key.split('/', 1)
+        selection_fingerprints[(subject, pipeline)] = temp_entry
+
+    return selection_fingerprints, response['ETag']
+
+
+def validate_selection_fingerprints(selection_fingerprints, log_listing):
+    '''Keep the stored selection fingerprints that still describe a submission log
+
+    An entry is only trusted if the log it was made from is in the
+    current listing of cbrain_misc and still has the same ETag and
+    LastModified. Entries for logs that were deleted or replaced
+    since the fingerprint was saved are dropped.
+
+    Parameters
+    ----------
+    selection_fingerprints : dict
+        Output of load_selection_fingerprints
+    log_listing : dict
+        Output of list_submission_logs for the same session
+
+    Returns
+    -------
+    dict
+        Dictionary whose keys are (subject, pipeline) pairs and whose
+        values are fingerprints (see compute_selection_fingerprint)
+
     '''
-    
-    
-    today = date.today()
-    
-    for temp_file in metadata_dict.keys():
-        skip_file = False
-        for temp_pattern in file_patterns_to_ignore:
-            if metadata_dict[temp_file]['Key'].endswith(temp_pattern):
-                skip_file = True
-                break
-        
-        if skip_file == False:
-            file_upload_day = date.fromisoformat(metadata_dict[temp_file]['LastModified'].split('T')[0])
-            day_difference = today - file_upload_day
-            if verbose:
-                print('{} Uploaded {} days ago'.format(temp_file.split('/')[-1], day_difference.days))
-            if day_difference.days < minimum_file_age_days:
-                return False
-        
-    return True
 
-def load_requirements_infos(pipeline_name):
+    valid_fingerprints = {}
+    for temp_key, temp_entry in selection_fingerprints.items():
+        if temp_key not in log_listing:
+            continue
+        if (temp_entry.get('log_etag', None) != log_listing[temp_key]['ETag']) or (temp_entry.get('log_last_modified', None) != log_listing[temp_key]['LastModified']):
+            continue
+        valid_fingerprints[temp_key] = temp_entry['fingerprint']
 
-    #Load the "comprehensive_processing_prerequisites" json files that are the same for each subject
-    #These files at least say which files are required for processing, and may also specify other
-    #requirements such as the number of files required for processing or whether any QC requirements
-    #need to be met for a file to be included in processing
-    requirements_files = []
-    comp_proc_recs_dir = os.path.join(Path(inspect.getfile(update_processing)).absolute().parent.resolve(), 'comprehensive_processing_prerequisites')
-    for filename in os.listdir(comp_proc_recs_dir):
-        # Use regular expression to match pipeline name with or without underscore and number
-        match = re.match(rf"^{pipeline_name}(?:_[0-9]+)?\.json$", filename)
-        if match:
-            requirements_files.append(os.path.join(comp_proc_recs_dir, filename))
+    return valid_fingerprints
 
-    requirements_dicts = []
-    for temp_requirement_file in requirements_files:
-        with open(temp_requirement_file, 'r') as f:
-            requirements_dicts.append(json.load(f))    
-    
-    #Rearange the requirements files dictionaries into one dictionary
-    #that has all the possible file types that we will want to grab.
-    file_selection_dict = {}
-    for temp_dict in requirements_dicts:
-        for temp_key in temp_dict.keys():
-            if temp_key in file_selection_dict.keys():
-                if temp_dict[temp_key] != file_selection_dict[temp_key]:
-                    raise ValueError('Error: {} has conflicting requirements for {}'.format(pipeline_name, temp_key))
-            else:
-                file_selection_dict[temp_key] = temp_dict[temp_key]
-    
-    return requirements_dicts, file_selection_dict
 
-def download_cbrain_misc_file(derivative_bucket_config, derivatives_bucket_prefix,
-                              subject, bucket, pipeline_name, output_folder,
-                              ending = 'UMNProcSubmission.json'):
-    '''Download json from cbrain_misc folder
-    
-    Assumes there will be a file in the derivatives bucket with
-    the naming convention:
-    
-    {bucket}/{derivatives_bucket_prefix}/cbrain_misc/{subject}_{pipeline_name}_{ending}
-        
+def save_selection_fingerprints(derivatives_bucket_config, derivatives_bucket, misc_prefix, selection_fingerprints):
+    '''Add selection fingerprints to the ones stored for a session
+
+    The stored file is loaded again right before it is updated so
+    that fingerprints saved by other runs in the meantime are kept.
+    The update is only written if the file hasn't changed since it
+    was loaded (or still doesn't exist), otherwise it is loaded and
+    written again, up to SELECTION_FINGERPRINTS_SAVE_ATTEMPTS times.
+
+    Parameters
+    ----------
+    derivatives_bucket_config : str
+        Path to s3 config file used to access the derivatives bucket
+    derivatives_bucket : str
+        Name of the derivatives bucket
+    misc_prefix : str
+        The cbrain_misc folder for the session (i.e. 'derivatives/ses-V02/cbrain_misc')
+    selection_fingerprints : dict
+        Dictionary whose keys are (subject, pipeline) pairs and whose values
+        are entries to store (see selection_fingerprint_entry)
+
     Returns
     -------
-    
-    Path to downloaded json file if download was successful,
-    otherwise returns None
-        
+    bool
+        True if the fingerprints were saved. False (with a warning)
+        if the file kept changing while it was being updated.
+
     '''
 
-    client = create_boto3_client(s3_config = derivative_bucket_config)
-    file_to_download = os.path.join(derivatives_bucket_prefix, 'cbrain_misc', '{}_{}_{}'.format(subject, pipeline_name, ending))
-    downloaded_file = os.path.join(output_folder, file_to_download.split('/')[-1])
-    try:
-        client.download_file(bucket, file_to_download, downloaded_file)
-    except:
-        return None
-            
-    return downloaded_file
+    if len(selection_fingerprints) == 0:
+        return True
+
+    client = create_boto3_client(s3_config = derivatives_bucket_config)
+    fingerprints_key = os.path.join(misc_prefix, SELECTION_FINGERPRINTS_FILE)
+    for _ in range(SELECTION_FINGERPRINTS_SAVE_ATTEMPTS):
+        all_fingerprints, etag = read_selection_fingerprints_file(client, derivatives_bucket, fingerprints_key)
+        all_fingerprints.update(selection_fingerprints)
+        stored_fingerprints = {}
+        for (subject, pipeline) in sorted(all_fingerprints.keys()):
+            stored_fingerprints['{}/{}'.format(subject, pipeline)] = all_fingerprints[(subject, pipeline)]
+
+        if type(etag) == type(None):
+            write_condition = {'IfNoneMatch' : '*'}
+        else:
+            write_condition = {'IfMatch' : etag}
+        try:
+            client.put_object(Bucket = derivatives_bucket, Key = fingerprints_key,
+                              Body = json.dumps(stored_fingerprints, indent = 4).encode(), **write_condition)
+            return True
+        except ClientError as error:
+            if error.response.get('Error', {}).get('Code') not in S3_WRITE_CONFLICT_CODES:
+                raise
+
+    print('   Warning: unable to save selection fingerprints to {}, the file kept changing while it was being updated'.format(fingerprints_key))
+    return False
+
+
+def record_selection_fingerprints(derivatives_bucket_config, derivatives_bucket, derivatives_bucket_prefix, misc_prefix,
+                                  fingerprints, other_entries = None, ending = 'UMNProcSubmission.json'):
+    '''Save the selection fingerprints of submission logs that were uploaded for a session
+
+    Lists the session's submission logs once (see list_submission_logs) to
+    find the ETag and LastModified of each log, and then saves all of the
+    fingerprints in one update (see save_selection_fingerprints).
+    Fingerprints whose log can't be found are not saved.
+
+    Parameters
+    ----------
+    derivatives_bucket_config : str
+        Path to s3 config file used to access the derivatives bucket
+    derivatives_bucket : str
+        Name of the derivatives bucket
+    derivatives_bucket_prefix : str
+        The prefix for the session (i.e. 'derivatives/ses-V02')
+    misc_prefix : str
+        The cbrain_misc folder for the session (i.e. 'derivatives/ses-V02/cbrain_misc')
+    fingerprints : dict
+        Dictionary whose keys are (subject, pipeline) pairs and whose
+        values are fingerprints (see compute_selection_fingerprint)
+    other_entries : None or dict, default None
+        Entries made by selection_fingerprint_entry (i.e. for logs of
+        earlier runs) to save along with fingerprints
+    ending : str, default 'UMNProcSubmission.json'
+        The ending of the log file names
+
+    '''
+
+    selection_fingerprints = {}
+    if type(other_entries) != type(None):
+        selection_fingerprints.update(other_entries)
+    if len(fingerprints):
+        log_listing = list_submission_logs(derivatives_bucket_config, derivatives_bucket, derivatives_bucket_prefix,
+                                           subjects = [temp_key[0] for temp_key in fingerprints.keys()],
+                                           pipelines = [temp_key[1] for temp_key in fingerprints.keys()], ending = ending)
+        for temp_key, temp_fingerprint in fingerprints.items():
+            if temp_key not in log_listing:
+                print('   Warning: unable to save the selection fingerprint for {} {}, no submission log was found'.format(temp_key[0], temp_key[1]))
+                continue
+            selection_fingerprints[temp_key] = selection_fingerprint_entry(temp_fingerprint, log_listing[temp_key])
+
+    save_selection_fingerprints(derivatives_bucket_config, derivatives_bucket, misc_prefix, selection_fingerprints)
+
 
 def check_if_ancestor_file_selection_is_same(subject_id, session_files, ancestor_pipelines_file_selection_dict, qc_df = None,
                                              bids_bucket = None, bids_prefix = None, bids_bucket_config = None,
                                              session = None, session_agnostic_files = ['sessions.tsv'], associated_files_dict = None,
                                              verbose = False, derivatives_bucket_config = None, derivatives_bucket = None,
-                                             derivatives_bucket_prefix = None, logs_directory = None, extensions_to_skip = ['.json']):
+                                             derivatives_bucket_prefix = None, logs_directory = None, extensions_to_skip = ['.json'],
+                                             group_evaluations = None, submission_logs = None,
+                                             selection_fingerprints = None, output = None):
     
     '''
     Function that assumes there will be a directory named "cbrain_misc"
@@ -1990,7 +4560,16 @@ def check_if_ancestor_file_selection_is_same(subject_id, session_files, ancestor
     all pipelines, the function returns true otherwise the function returns false.
     
     All inputs used for this pipeline are also used in various other functions
-    in this file...
+    in this file... (group_evaluations is passed to grab_required_bids_files_v2)
+
+    If submission_logs (see prefetch_submission_logs) is provided, the logs
+    will be taken from there instead of being downloaded. If selection_fingerprints
+    (see validate_selection_fingerprints) is provided, the fingerprint of the files
+    that would be selected today is compared to the stored fingerprint first, and
+    the log is only needed (and loaded if not in submission_logs) when they differ.
+    Only fingerprints whose log is known to exist should be in selection_fingerprints.
+
+    Messages are printed to output (sys.stdout if None).
     
     '''
 
@@ -2005,20 +4584,47 @@ def check_if_ancestor_file_selection_is_same(subject_id, session_files, ancestor
         _, current_file_metadata = grab_required_bids_files_v2(subject_id, session_files, temp_reqs, qc_df = qc_df, bucket = bids_bucket,
                                                                                 prefix = bids_prefix, bids_bucket_config = bids_bucket_config, session = session, 
                                                                                 session_agnostic_files = session_agnostic_files, associated_files_dict = associated_files_dict,
-                                                                                verbose = verbose)
+                                                                                verbose = verbose, group_evaluations = group_evaluations, output = output)
+
+        #Compare fingerprints first, the file by file comparison below
+        #is only needed if they differ (or if there is no fingerprint)
+        recorded_fingerprint = None
+        if type(selection_fingerprints) != type(None):
+            recorded_fingerprint = selection_fingerprints.get((subject_id, temp_pipeline), None)
+        if (type(recorded_fingerprint) == type(None)) and (type(submission_logs) != type(None)):
+            if (subject_id, temp_pipeline) in submission_logs:
+                recorded_fingerprint = compute_selection_fingerprint(submission_logs[(subject_id, temp_pipeline)], session_agnostic_files = session_agnostic_files,
+                                                                     extensions_to_skip = extensions_to_skip)
+        if (type(recorded_fingerprint) != type(None)) and (type(current_file_metadata) != type(None)):
+            current_fingerprint = compute_selection_fingerprint(current_file_metadata, session_agnostic_files = session_agnostic_files,
+                                                                extensions_to_skip = extensions_to_skip)
+            if current_fingerprint == recorded_fingerprint:
+                continue
 
-        json_path = download_cbrain_misc_file(derivatives_bucket_config, derivatives_bucket_prefix,
-                              subject_id, derivatives_bucket, temp_pipeline, logs_directory,
-                              ending = 'UMNProcSubmission.json')
+        if type(submission_logs) != type(None):
+            original_s3_metadata = submission_logs.get((subject_id, temp_pipeline), None)
+            if (type(original_s3_metadata) == type(None)) and (type(recorded_fingerprint) != type(None)):
+                client = create_boto3_client(s3_config = derivatives_bucket_config)
+                log_key = os.path.join(derivatives_bucket_prefix, 'cbrain_misc', '{}_{}_{}'.format(subject_id, temp_pipeline, 'UMNProcSubmission.json'))
+                original_s3_metadata = load_submission_log_metadata(client, derivatives_bucket, log_key, output = output)
+        else:
+            original_s3_metadata = None
+            json_path = download_cbrain_misc_file(derivatives_bucket_config, derivatives_bucket_prefix,
+                                  subject_id, derivatives_bucket, temp_pipeline, logs_directory,
+                                  ending = 'UMNProcSubmission.json')
+            if type(json_path) != type(None):
+                with open(json_path, 'r') as f:
+                    json_content = json.load(f)
+                os.remove(json_path)
+                original_s3_metadata = json_content['s3_metadata']
         
-        if type(json_path) == type(None):
-            print('   Warning: no ancestor cbrain_misc was identified. Assuming subject should not be processed.')
+        if type(original_s3_metadata) == type(None):
+            print('   Warning: no ancestor cbrain_misc was identified. Assuming subject should not be processed.', file = output)
+            return False
+        elif type(current_file_metadata) == type(None):
+            print('   Warning: files for {} could not be selected with the current QC information. Assuming subject should not be processed.'.format(temp_pipeline), file = output)
             return False
         else:
-            with open(json_path, 'r') as f:
-                json_content = json.load(f)
-            os.remove(json_path)
-            original_s3_metadata = json_content['s3_metadata']
             original_keys_sorted = list(original_s3_metadata.keys())
             original_keys_sorted.sort()
             current_keys_sorted = list(current_file_metadata.keys())
@@ -2028,9 +4634,9 @@ def check_if_ancestor_file_selection_is_same(subject_id, session_files, ancestor
             current_keys_sorted_no_session_ag  = remove_indices_by_suffix(current_keys_sorted, session_agnostic_files)
 
             if original_keys_sorted_no_session_ag != current_keys_sorted_no_session_ag:
-                print('   Files that would be selected for {} processing today are different than what is found in the processing logs. Delete previous results and reprocess if you want to run the current pipeline.'.format(temp_pipeline))
-                print('   Files that were previously used: {} (excluding session agnostic files)'.format(original_keys_sorted_no_session_ag))
-                print('   Files that would be selected today: {} (excluding session agnostic files)'.format(current_keys_sorted_no_session_ag))
+                print('   Files that would be selected for {} processing today are different than what is found in the processing logs. Delete previous results and reprocess if you want to run the current pipeline.'.format(temp_pipeline), file = output)
+                print('   Files that were previously used: {} (excluding session agnostic files)'.format(original_keys_sorted_no_session_ag), file = output)
+                print('   Files that would be selected today: {} (excluding session agnostic files)'.format(current_keys_sorted_no_session_ag), file = output)
                 
                 return False
             else:
@@ -2046,13 +4652,435 @@ def check_if_ancestor_file_selection_is_same(subject_id, session_files, ancestor
                             break #dont evaluate the size of jsons (or other files with extensions_to_skip)
                     if skip_file == False:
                         if original_s3_metadata[temp_file]['Size'] != current_file_metadata[temp_file]['Size']:
-                            print('Chosen file {} has different size ({} vs. now {}) when compared to when {} was ran.'.format(temp_file.split('/')[-1], original_s3_metadata[temp_file]['Size'], current_file_metadata[temp_file]['Size'], temp_pipeline))
+                            print('Chosen file {} has different size ({} vs. now {}) when compared to when {} was ran.'.format(temp_file.split('/')[-1], original_s3_metadata[temp_file]['Size'], current_file_metadata[temp_file]['Size'], temp_pipeline), file = output)
                             return False
                         
         
     
     return True
 
+def run_with_output_buffer(function, *args, **kwargs):
+    '''Call function(*args, output = buffer, **kwargs) with a new text buffer
+
+    Exceptions are returned instead of raised so that the
+    messages written before the exception aren't lost.
+
+    Returns
+    -------
+
+    result, printed_text, error
+        result is None if an exception was raised, and
+        error is None if no exception was raised.
+
+    '''
+
+    output = StringIO()
+    try:
+        result, error = function(*args, output = output, **kwargs), None
+    except Exception as exception:
+        result, error = None, exception
+
+    return result, output.getvalue(), error
+
+
+def evaluate_subject_session(subject_name, subject_id, session_dp_name, run_info, group_evaluations = None, output = None):
+    '''Decide whether a subject/session should be processed
+
+    Runs steps (1) - (10) described in update_processing for one
+    subject and session. Nothing is submitted to CBRAIN and nothing
+    is written to S3 or the logs directory, so many subject/sessions
+    can be evaluated at the same time (see evaluate_subject_sessions_async).
+
+    Parameters
+    ----------
+
+    subject_name : str
+        The BIDS subject name (i.e. 'sub-1')
+    subject_id : str or int
+        The CBRAIN userfile ID of the BidsSubject
+    session_dp_name : str
+        The name of the session's CBRAIN DataProvider (key of
+        run_info['session_dps_dict'])
+    run_info : dict
+        Information that is the same for every subject/session in the
+        run, prepared by update_processing. Has the keys 'pipeline_name',
+        'tool_config_id', 'rerun_level', 'file_selection_dict',
+        'requirements_dicts', 'external_requirements_dict',
+        'ancestor_pipelines_file_selection_dict', 'associated_files_dict',
+        'qc_info_required', 'scans_tsv_files' (None if scans.tsv files
+        were not loaded), 'session_dps_dict', 'session_subjects_with_derivatives',
+        'cbrain_task_index', 'cbrain_file_indices', 'bids_data_provider_id',
+        'bids_bucket_config', 'bids_bucket', 'bids_bucket_prefix', 's3_inventory',
+        'session_agnostic_files', 'minimum_file_age_days', 'check_ancestor_pipelines',
+        'derivatives_bucket_config', 'logs_directory', 'session_submission_logs',
+        'session_selection_fingerprints' and 'verbose'. The values are the
+        variables with the same names in update_processing.
+    group_evaluations : None or dict, default None
+        See evaluate_requirement_group. Must be specific to the
+        current subject/session. If None, a new dictionary is
+        used for this subject/session.
+    output : None or file-like object, default None
+        Where messages about the subject/session are printed. If None,
+        they are printed to sys.stdout. evaluate_subject_sessions_async
+        gives each subject/session its own buffer.
+
+    Returns
+    -------
+
+    dict
+        Dictionary with 'tracking' (the row describing the subject/session
+        for the processing details spreadsheet) and 'ready' (True if the
+        subject/session should be processed). If 'ready' is True, also has
+        'external_requirements' (see grab_external_requirements), 'files_to_keep'
+        and 's3_metadata' (see grab_required_bids_files_v2).
+
+    '''
+
+    if type(group_evaluations) == type(None):
+        group_evaluations = {}
+
+    file_selection_dict = run_info['file_selection_dict']
+    external_requirements_dict = run_info['external_requirements_dict']
+    session_dp = run_info['session_dps_dict'][session_dp_name]
+
+    #This should always be something like 'ses-V01', 'ses-V02', etc.
+    temp_ses_name = session_dp['prefix'].split('/')[-1]
+
+    print('Evaluating: {}, {}'.format(subject_name, temp_ses_name), file = output)
+
+    #A dictionary to store details that will later be used to populate
+    #a spreadsheet that will be used to track processing across subjects
+    subject_processing_details = {}
+    subject_processing_details['subject'] = subject_name
+    subject_processing_details['pipeline'] = run_info['pipeline_name']
+    subject_processing_details['session'] = temp_ses_name
+    subject_processing_details['derivatives_found'] = "Not Evaluated"
+    subject_processing_details['CBRAIN_Status'] = "Not Evaluated"
+    subject_processing_details['scans_tsv_present'] = "Not Evaluated"
+    subject_processing_details['Ancestor_Files'] = "Not Evaluated"
+    evaluation = {'tracking' : subject_processing_details, 'ready' : False}
+
+    #Be sure that the current subject doesn't have existing output before starting processing
+    if subject_name in run_info['session_subjects_with_derivatives'][session_dp_name]:
+        subject_processing_details['derivatives_found'] = True
+        for temp_req in file_selection_dict.keys():
+            subject_processing_details[temp_req] = 'Already Processed'
+        for temp_req in external_requirements_dict.keys():
+            subject_processing_details['CBRAIN_' + temp_req] = 'Already Processed'
+        subject_processing_details['CBRAIN_Status'] = 'Already Processed'
+        subject_processing_details['scans_tsv_present'] = "Already Processed"
+
+        print('    Already has derivatives', file = output)
+        return evaluation
+    else:
+        subject_processing_details['derivatives_found'] = False
+
+    #Check what type of processing has already occured for the subject with
+    #this pipeline and only continue if processing hasn't already been initiated
+    #or under certain failure conditions (see documentation for check_rerun_status)
+    to_rerun, example_status = check_rerun_status_from_index(subject_id, run_info['cbrain_task_index'], session_dp['id'],
+                                                             run_info['tool_config_id'], rerun_level = run_info['rerun_level'], output = output)
+    subject_processing_details['CBRAIN_Status'] = example_status
+    if False == to_rerun:
+        return evaluation #Check rerun status will print out a message to the user if processing is not going to be rerun
+
+    #Grab the QC file for this subject so we can figure out which files can be used for processing.
+    #If no QC requirements are specified in the comprehensive processing prerequisites, then the QC file will be ignored.
+    if type(run_info['scans_tsv_files']) != type(None):
+        subj_ses_qc_file = run_info['scans_tsv_files'][(subject_name, temp_ses_name)]
+        if (type(subj_ses_qc_file) == type(None)) and (run_info['qc_info_required'] == True):
+            print('    Skipping Processing - No QC file found for subject', file = output)
+            subject_processing_details['scans_tsv_present'] = False
+            for temp_req in file_selection_dict.keys():
+                subject_processing_details[temp_req] = 'No scans.tsv'
+            for temp_req in external_requirements_dict.keys():
+                subject_processing_details['CBRAIN_' + temp_req] = 'No scans.tsv'
+            subject_processing_details['CBRAIN_Status'] = 'No scans.tsv'
+            subject_processing_details['derivatives_found'] = "No (Missing scans.tsv)"
+            return evaluation
+        else:
+            subject_processing_details['scans_tsv_present'] = True
+            if run_info['qc_info_required'] == False:
+                subj_ses_qc_file = None
+    else:
+        subj_ses_qc_file = None
+
+    #Grab a list of BIDS associated files for this subject in S3
+    bids_bucket = run_info['bids_bucket']
+    bids_bucket_prefix = run_info['bids_bucket_prefix']
+    bids_bucket_config = run_info['bids_bucket_config']
+    session_agnostic_files = run_info['session_agnostic_files']
+    try:
+        subject_files = grab_subject_file_info(subject_name, bids_bucket_config, bucket = bids_bucket, prefix = bids_bucket_prefix,
+                                               s3_inventory = run_info['s3_inventory'])
+    except Exception as error:
+        print(error, file = output)
+        raise RuntimeError('Error: unable to grab file names for S3 for current subject. This likely means S3 access is having issues.')
+    if len(subject_files) == 0:
+        print('   Warning: No S3 files found for subject', file = output)
+
+    #Reduce the files to those that are relevant for
+    #the current session being processed
+    session_level = len(bids_bucket_prefix.split('/')) + 1
+    session_files = grab_session_specific_file_info(subject_files, temp_ses_name,
+                        session_agnostic_files = session_agnostic_files,
+                        session_level = session_level, s3_inventory = run_info['s3_inventory'],
+                        subject_id = subject_name)
+    if len(session_files) == 0:
+        print('   No files found for subject/session combo', file = output)
+        return evaluation
+
+    #First run preliminary check for requirements that is only used
+    #for the purpose of populating the processing details spreadsheet.
+    #Later requirements check will actually be used to determine if
+    #processing will be attempted.
+    temp_req_output, req_tracking_dict = check_bids_requirements_v2(subject_name, session_files, file_selection_dict,
+                        qc_df = subj_ses_qc_file, bucket = bids_bucket, prefix = bids_bucket_prefix,
+                        bids_bucket_config = bids_bucket_config, session = temp_ses_name,
+                        session_agnostic_files = session_agnostic_files,
+                        verbose = run_info['verbose'], group_evaluations = group_evaluations, output = output)
+    subject_processing_details.update(req_tracking_dict)
+
+    #Check that the subject has requirements satisfiying at least one pipeline specific json in the processing_prerequisites folder
+    requirements_satisfied = 0
+    none_found = 0
+    for temp_requirement in run_info['requirements_dicts']:
+        temp_req_output, _ = check_bids_requirements_v2(subject_name, session_files, temp_requirement,
+                    qc_df = subj_ses_qc_file, bucket = bids_bucket, prefix = bids_bucket_prefix,
+                    bids_bucket_config = bids_bucket_config, session = temp_ses_name,
+                    session_agnostic_files = session_agnostic_files,
+                    verbose = run_info['verbose'], group_evaluations = group_evaluations, output = output)
+        #If return == None, this is because some QC info was expected but is missing
+        if type(temp_req_output) == type(None):
+            none_found = 1
+        #Otherwise, a requirement was either passed or failed as expected
+        else:
+            requirements_satisfied += int(temp_req_output)
+
+    if (requirements_satisfied == 0) or (none_found == 1):
+        print('    Requirements not satisfied', file = output)
+        subject_processing_details['derivatives_found'] = "No (Missing BIDS Reqs)"
+        subject_processing_details['CBRAIN_Status'] = "No Proc. (Missing BIDS Reqs)"
+        return evaluation
+
+    #Check that the external requirements are satisfied for the subject (these are pipeline inputs that will be files/file collections
+    #that should already be available for the subject on CBRAIN if the subject is ready for processing). Note that
+    #the files being passed to this function are already specific to a single data provider.
+    subject_external_requirements, req_tracking_dict = grab_external_requirements(subject_name, None,
+                                                                external_requirements_dict, bids_data_provider_id = run_info['bids_data_provider_id'],
+                                                                derivatives_data_provider_id = session_dp['id'],
+                                                                cbrain_file_index = run_info['cbrain_file_indices'][session_dp_name], output = output)
+
+    #Update tracking dict based on grab_external_requirements results
+    for temp_key in req_tracking_dict.keys():
+        subject_processing_details['CBRAIN_' + temp_key] = req_tracking_dict[temp_key]
+
+    #Skip processing for subject if external requirements aren't found
+    if subject_external_requirements is None:
+        print('    Missing external requirements', file = output)
+        subject_processing_details['derivatives_found'] = "No (Missing Derived Reqs)"
+        subject_processing_details['CBRAIN_Status'] = "No Proc. (Missing Derived Reqs)"
+        return evaluation #skip processing if external requirements aren't found
+
+    #Grab files for the subject according to pipeline specific jsons in processing_file_numbers and processing_file_selection folders
+    subject_files_list, metadata_dict = grab_required_bids_files_v2(subject_name, session_files, file_selection_dict,
+                                                                    qc_df = subj_ses_qc_file, bucket = bids_bucket,
+                                                                    prefix = bids_bucket_prefix,
+                                                                    bids_bucket_config = bids_bucket_config,
+                                                                    session = temp_ses_name, session_agnostic_files = session_agnostic_files,
+                                                                    associated_files_dict = run_info['associated_files_dict'],
+                                                                    verbose = False, group_evaluations = group_evaluations, output = output)
+    if type(subject_files_list) == type(None):
+        print('    An issue was encountered in grab_required_bids_files_v2. If processing has gotten to this point', file = output)
+        print('    it is likely the case that (1) the subject has at least some files that satisfy QC requirements,', file = output)
+        print('    but that, (2) at least one file is missing QC information for one category, making', file = output)
+        print('    a comparison of files within that category impossible. For this reason the subject', file = output)
+        print('    will not be processed at this time. Look at the subject scans.tsv file for relevant details', file = output)
+        subject_processing_details['derivatives_found'] = "No (scans.tsv issue)"
+        subject_processing_details['CBRAIN_Status'] = "No Proc. (scans.tsv issue)"
+        return evaluation
+
+    #Check if all files are old enough for processing. Generally we will
+    #want to wait several days before processing to be sure that there is
+    #time for the QC information to get populated
+    files_old_enough = check_all_files_old_enough(metadata_dict, run_info['minimum_file_age_days'],
+                        file_patterns_to_ignore = session_agnostic_files,
+                        verbose = False, output = output)
+    if files_old_enough == False:
+        print('    Files not old enough for processing', file = output)
+        subject_processing_details['derivatives_found'] = "No (Files Not Old Enough)"
+        subject_processing_details['CBRAIN_Status'] = "No Proc. (Files Not Old Enough)"
+        return evaluation
+
+    #Go through all "ancestor" processing requirements, and ensure
+    #that the files that would be selected for processing today are
+    #the same as the files that were selected when the ancestor
+    #pipelines were ran. If this is not the case, then processing
+    #of this subject will be paused until the ancestor pipelines are rerun.
+    if run_info['check_ancestor_pipelines']:
+        if len(run_info['ancestor_pipelines_file_selection_dict']) > 0:
+            are_ancestors_the_same = check_if_ancestor_file_selection_is_same(subject_name, session_files, run_info['ancestor_pipelines_file_selection_dict'], qc_df = subj_ses_qc_file,
+                                                        bids_bucket = bids_bucket, bids_prefix = bids_bucket_prefix, bids_bucket_config = bids_bucket_config,
+                                                        session = temp_ses_name, session_agnostic_files = session_agnostic_files, associated_files_dict = run_info['associated_files_dict'],
+                                                        verbose = run_info['verbose'], derivatives_bucket_config = run_info['derivatives_bucket_config'], derivatives_bucket = session_dp['bucket'],
+                                                        derivatives_bucket_prefix = session_dp['prefix'], logs_directory = run_info['logs_directory'],
+                                                        group_evaluations = group_evaluations,
+                                                        submission_logs = run_info['session_submission_logs'][session_dp_name],
+                                                        selection_fingerprints = run_info['session_selection_fingerprints'][session_dp_name], output = output)
+            if are_ancestors_the_same == False:
+                print('    Pausing processing until ancestor pipelines are rerun', file = output)
+                subject_processing_details['derivatives_found'] = "No (Ancestor Files Different)"
+                subject_processing_details['CBRAIN_Status'] = "No Proc. (Ancestor Files Different)"
+                subject_processing_details['Ancestor_Files'] = 'Different'
+                return evaluation
+            else:
+                subject_processing_details['Ancestor_Files'] = 'Same'
+
+    subject_processing_details['CBRAIN_Status'] = 'Initiating Processing'
+    evaluation['ready'] = True
+    evaluation['external_requirements'] = subject_external_requirements
+    evaluation['files_to_keep'] = subject_files_list
+    evaluation['s3_metadata'] = metadata_dict
+
+    return evaluation
+
+
+class AsyncBackendLimits:
+    '''Limits the number of blocking helper calls running for each backend
+
+    Used by update_processing_async (and the other *_async functions)
+    to run the regular (blocking) helpers from an event loop. Each
+    backend has its own semaphore that limits how many calls given to
+    run (see run_in_backend) are running at the same time. Must be
+    created from inside the running event loop.
+
+    A call only holds one slot, so helpers that would otherwise make
+    requests from their own threads are ran without them:
+    update_processing_async gives prefetch_scans_tsv_files and
+    prefetch_submission_logs one file per call (with max_workers = 1),
+    and lists CBRAIN entities with a client that requests one page at
+    a time (see CbrainClient.with_max_concurrent_pages). The exceptions
+    are the S3 listing cache refresh made by build_s3_inventory, which
+    uses its own threads before any other S3 call is made, and the S3
+    requests made while evaluating a subject/session (see
+    evaluate_subject_session), which are counted under 'evaluation'
+    rather than 's3'.
+
+    Parameters
+    ----------
+
+    s3_concurrency : int, default 50
+        Maximum number of S3 helper calls running at the same time
+    cbrain_concurrency : int, default 8
+        Maximum number of CBRAIN helper calls running at the same time
+    evaluation_concurrency : int, default 8
+        Maximum number of subject/sessions being evaluated
+        at the same time (see evaluate_subject_session)
+
+    '''
+
+    def __init__(self, s3_concurrency = 50, cbrain_concurrency = 8, evaluation_concurrency = 8):
+
+        self.semaphores = {'s3' : asyncio.Semaphore(max(1, s3_concurrency)),
+                           'cbrain' : asyncio.Semaphore(max(1, cbrain_concurrency)),
+                           'evaluation' : asyncio.Semaphore(max(1, evaluation_concurrency))}
+        total_concurrency = max(1, s3_concurrency) + max(1, cbrain_concurrency) + max(1, evaluation_concurrency)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = total_concurrency)
+
+    async def run(self, backend, function, *args, **kwargs):
+        '''Run function(*args, **kwargs) in a thread once the backend has a free slot'''
+        async with self.semaphores[backend]:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait = True)
+
+
+async def run_in_backend(backend_limits, backend, function, *args, **kwargs):
+    '''Run a blocking function from an event loop
+
+    Uses backend_limits (see AsyncBackendLimits) if provided, and
+    otherwise runs the function with asyncio.to_thread without
+    any limit on the number of requests in flight.
+
+    '''
+
+    if type(backend_limits) == type(None):
+        return await asyncio.to_thread(function, *args, **kwargs)
+    return await backend_limits.run(backend, function, *args, **kwargs)
+
+
+def run_coroutine_sync(coroutine):
+    '''Run a coroutine to completion from regular (non async) code
+
+    Uses asyncio.run, unless an event loop is already running in
+    the current thread (i.e. in a Jupyter notebook). In that case
+    the coroutine is ran with its own event loop in a new thread.
+
+    '''
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = 1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+async def upload_processing_config_log_async(*args, backend_limits = None, **kwargs):
+    '''Async version of upload_processing_config_log (see run_in_backend)'''
+    return await run_in_backend(backend_limits, 's3', upload_processing_config_log, *args, **kwargs)
+
+
+async def find_cbrain_entities_async(*args, backend_limits = None, **kwargs):
+    '''Async version of find_cbrain_entities (see run_in_backend)'''
+    return await run_in_backend(backend_limits, 'cbrain', find_cbrain_entities, *args, **kwargs)
+
+
+async def cbrain_mark_as_newer_async(*args, backend_limits = None, **kwargs):
+    '''Async version of cbrain_mark_as_newer (see run_in_backend)'''
+    return await run_in_backend(backend_limits, 'cbrain', cbrain_mark_as_newer, *args, **kwargs)
+
+
+async def evaluate_subject_sessions_async(subject_sessions, run_info, backend_limits = None):
+    '''Run evaluate_subject_session for many subject/sessions at once
+
+    Subject/sessions are evaluated concurrently, with the number
+    evaluated at the same time limited by the 'evaluation' backend
+    of backend_limits. Each evaluation prints to its own buffer
+    (see run_with_output_buffer) so that the text can be printed
+    in the same order as subject_sessions.
+
+    Parameters
+    ----------
+
+    subject_sessions : list of tuples
+        (subject_name, subject_id, session_dp_name) for each
+        subject/session to evaluate
+    run_info : dict
+        See evaluate_subject_session
+    backend_limits : None or AsyncBackendLimits, default None
+        See run_in_backend
+
+    Returns
+    -------
+
+    list of (evaluation, printed_text, error) tuples in the same order
+    as subject_sessions (see run_with_output_buffer). The error should
+    be raised after printed_text is printed.
+
+    '''
+
+    evaluations = []
+    for subject_name, subject_id, session_dp_name in subject_sessions:
+        evaluations.append(run_in_backend(backend_limits, 'evaluation', run_with_output_buffer, evaluate_subject_session,
+                                          subject_name, subject_id, session_dp_name, run_info))
+
+    return list(await asyncio.gather(*evaluations))
+
+
 def update_processing(pipeline_name = None,
                         cbrain_api_token = None,
                         session_data_provider_names = None,
@@ -2069,7 +5097,16 @@ def update_processing(pipeline_name = None,
                         check_ancestor_pipelines = True,
                         verbose = False,
                         minimum_file_age_days = 14,
-                        max_subject_sessions_to_proc = None):
+                        max_subject_sessions_to_proc = None,
+                        s3_listing_cache_path = None,
+                        s3_listing_max_age_hours = 2,
+                        cbrain_client = None,
+                        cbrain_snapshot_path = None,
+                        cbrain_snapshot_max_age_minutes = 0,
+                        cbrain_snapshot_full_reconcile_hours = 24,
+                        max_evaluation_workers = 8,
+                        s3_concurrency = 50,
+                        cbrain_concurrency = 8):
     
     '''Function to manage processing of data using CBRAIN
     
@@ -2090,7 +5127,8 @@ def update_processing(pipeline_name = None,
     evaluated. This file can contain QC information that is used to determine if a
     subject should be processed. If the file is expected but not present, a subject
     won't be processed.
-    (4) Grab a list of the subjects' BIDS files from the bids_bucket, and reduce this
+    (4) Grab a list of the subjects' BIDS files from an inventory of the bids_bucket (the
+    bucket is only listed once at the start of the run), and reduce this
     list to the files that are related to the current session (along with some session
     agnostic files like sessions.tsv).
     (5) Run an initial check of BIDS requirements that will be used to populate a HTML
@@ -2111,7 +5149,9 @@ def update_processing(pipeline_name = None,
     case, skip processing for the current subject.
     
     The previous steps are used to compile all subjects that should be processed, along with the
-    settings that should be used to process them. Once this process is complete:
+    settings that should be used to process them (see evaluate_subject_session). Up to
+    max_evaluation_workers subject/sessions are evaluated at the same time, but the text
+    describing each evaluation is printed in the usual order. Once this process is complete:
 
     (11) iterate through all subjects to be processed and submit them to CBRAIN for processing. The
     only files that will be included for processing are files that are explicitly found in the previous
@@ -2121,6 +5161,10 @@ def update_processing(pipeline_name = None,
     Be aware that if certain fields aren't filled out, this is generally because the subject has already
     been processed so fields from the later portion of this script are not filled out.
 
+    The work is done by update_processing_async, which is ran to completion
+    here (see run_coroutine_sync), so this function can also be used from
+    a Jupyter notebook where an event loop is already running.
+
     (1) first checks if pipeline derivatives already exist in
     'bucket' for a given pipeline, only proceeding for subjects without results,
     (2) checks that all BIDS requirements are satisfied for that subject (as specified
@@ -2163,9 +5207,10 @@ def update_processing(pipeline_name = None,
         Same as BIDS bucket config, but for derivatives. This can either
         be the same or different as the BIDS bucket config.
     logs_directory : str or None, default None
-        Working directory where scans.tsv files will be temporarily downloaded and
-        also other logs describing subject processing before the logs are sent to
-        S3. These files will also be deleted during processing. HTML and csv files 
+        Working directory where logs describing subject processing are stored
+        before the logs are sent to S3. These files will also be deleted during
+        processing. scans.tsv files are only loaded when this is not None (they are
+        read directly into memory and not saved here). HTML and csv files 
         describing processing will also be stored here and will be kept after processing.
         If None is used, spooky behavior will be observed.
     logs_prefix : str, default 'cbrain_misc'
@@ -2199,6 +5244,53 @@ def update_processing(pipeline_name = None,
         Data Provider, or otherwise will only process the specified
         number. Subjects that fail to meet preprocessing requirements
         to not count to this total.
+    s3_listing_cache_path : str or None, default None
+        Path to a SQLite file used to persist the listing of the BIDS
+        bucket between runs. If provided, only subjects that are new
+        or whose cached listing is older than s3_listing_max_age_hours
+        will be listed in S3. See refresh_s3_listing_cache. If None,
+        the whole BIDS prefix is listed at the start of every run (see
+        build_s3_inventory). That is one request per 1000 objects no
+        matter how many subjects end up being evaluated, so runs that
+        only process a handful of subjects (i.e. with a small
+        max_subject_sessions_to_proc) can list more than they need to.
+        Use a listing cache for frequent small runs.
+    s3_listing_max_age_hours : float, default 2
+        Maximum age of a subject's cached listing before it is
+        listed again. Only used with s3_listing_cache_path. Until then,
+        new or deleted sessions and changes to sessions.tsv or scans.tsv
+        files are still detected, but files that change inside of an
+        existing session without its scans.tsv changing are not seen
+        (see refresh_s3_listing_cache).
+    cbrain_client : CbrainClient or None, default None
+        Client used for all requests to CBRAIN. If None, the default
+        client from get_cbrain_client is used.
+    cbrain_snapshot_path : str or None, default None
+        Path to a SQLite file used to keep a snapshot of CBRAIN userfiles
+        and tasks that is shared between pipelines and runs. If provided,
+        the snapshot will be used (and incrementally updated) instead of
+        requesting all userfiles and tasks from CBRAIN. Tasks submitted
+        by this function are added to the snapshot. See sync_cbrain_snapshot.
+    cbrain_snapshot_max_age_minutes : float, default 0
+        How long the snapshot can be used without asking CBRAIN for
+        updates. Only used with cbrain_snapshot_path. The snapshot is
+        used to decide which tasks need to be rerun, so by default
+        CBRAIN is always checked for updated tasks and userfiles.
+    cbrain_snapshot_full_reconcile_hours : float, default 24
+        How often the snapshot is fully replaced (which is needed to
+        remove entities deleted in CBRAIN). Only used with
+        cbrain_snapshot_path.
+    max_evaluation_workers : int, default 8
+        The number of subject/sessions whose requirements are
+        evaluated at the same time (steps 1-10 above). Submission
+        to CBRAIN (step 11) always happens one subject/session at
+        a time.
+    s3_concurrency : int, default 50
+        Maximum number of S3 helper calls made at the same time by
+        update_processing itself (see AsyncBackendLimits)
+    cbrain_concurrency : int, default 8
+        Maximum number of CBRAIN helper calls made at the same time by
+        update_processing itself (see AsyncBackendLimits)
 
     Returns
     -------
@@ -2207,396 +5299,429 @@ def update_processing(pipeline_name = None,
     
     '''
 
+    return run_coroutine_sync(update_processing_async(pipeline_name = pipeline_name,
+                                                      cbrain_api_token = cbrain_api_token,
+                                                      session_data_provider_names = session_data_provider_names,
+                                                      group_name = group_name,
+                                                      user_id = user_id,
+                                                      bids_bucket_config = bids_bucket_config,
+                                                      bids_bucket_prefix = bids_bucket_prefix,
+                                                      bids_data_provider_name = bids_data_provider_name,
+                                                      derivatives_bucket_config = derivatives_bucket_config,
+                                                      logs_directory = logs_directory,
+                                                      logs_prefix = logs_prefix,
+                                                      rerun_level = rerun_level,
+                                                      session_agnostic_files = session_agnostic_files,
+                                                      check_ancestor_pipelines = check_ancestor_pipelines,
+                                                      verbose = verbose,
+                                                      minimum_file_age_days = minimum_file_age_days,
+                                                      max_subject_sessions_to_proc = max_subject_sessions_to_proc,
+                                                      s3_listing_cache_path = s3_listing_cache_path,
+                                                      s3_listing_max_age_hours = s3_listing_max_age_hours,
+                                                      cbrain_client = cbrain_client,
+                                                      cbrain_snapshot_path = cbrain_snapshot_path,
+                                                      cbrain_snapshot_max_age_minutes = cbrain_snapshot_max_age_minutes,
+                                                      cbrain_snapshot_full_reconcile_hours = cbrain_snapshot_full_reconcile_hours,
+                                                      max_evaluation_workers = max_evaluation_workers,
+                                                      s3_concurrency = s3_concurrency,
+                                                      cbrain_concurrency = cbrain_concurrency))
+
+
+async def update_processing_async(pipeline_name = None,
+                                  cbrain_api_token = None,
+                                  session_data_provider_names = None,
+                                  group_name = None,
+                                  user_id = None,
+                                  bids_bucket_config = None,
+                                  bids_bucket_prefix = 'assembly_bids',
+                                  bids_data_provider_name = None,
+                                  derivatives_bucket_config = None,
+                                  logs_directory = None,
+                                  logs_prefix = 'cbrain_misc',
+                                  rerun_level = 1,
+                                  session_agnostic_files = ['sessions.tsv', 'sessions.json'],
+                                  check_ancestor_pipelines = True,
+                                  verbose = False,
+                                  minimum_file_age_days = 14,
+                                  max_subject_sessions_to_proc = None,
+                                  s3_listing_cache_path = None,
+                                  s3_listing_max_age_hours = 2,
+                                  cbrain_client = None,
+                                  cbrain_snapshot_path = None,
+                                  cbrain_snapshot_max_age_minutes = 0,
+                                  cbrain_snapshot_full_reconcile_hours = 24,
+                                  max_evaluation_workers = 8,
+                                  s3_concurrency = 50,
+                                  cbrain_concurrency = 8):
+    
+    '''Async version of update_processing
 
-    group_id, bids_bucket, bids_data_provider_id, session_dps_dict = grab_cbrain_initialization_details(cbrain_api_token,
-                                                                                             group_name,
-                                                                                             bids_data_provider_name,
-                                                                                             session_data_provider_names)
-
-    print("You are currently attempting to launch processing jobs with the tool {}.\n".format(pipeline_name))
+    Runs the same steps as update_processing (see its documentation
+    for the parameters and output) from an event loop. The blocking
+    S3 and CBRAIN helpers are ran in threads, with the number of helper
+    calls running for each backend limited by s3_concurrency and
+    cbrain_concurrency (see AsyncBackendLimits for what is and isn't
+    counted), and up to max_evaluation_workers subject/sessions
+    evaluated at the same time. Submission to CBRAIN still happens one
+    subject/session at a time. Can be awaited directly from a Jupyter notebook.
 
-    #Load the tool config id for the current pipeline being used for processing
-    tool_config_file = os.path.join(Path(inspect.getfile(update_processing)).absolute().parent.resolve(), 'tool_config_ids.json')
-    with open(tool_config_file, 'r') as f:
-        tool_config_dict = json.load(f)
-    tool_config_id = str(tool_config_dict[pipeline_name])
+    '''
 
-    #See if the current pipeline has any 'ancestor pipelines', if so
-    #we will use this list to be sure that the files that were previously
-    #selected when those processing pipelines were ran are still the same
-    #files that would be chosen if those pipelines were ran again. If this
-    #is not the case, then we will want to pause on processing the current
-    #subject until the ancestor pipelines are rerun.
-    ancestor_pipeline_file = os.path.join(Path(inspect.getfile(update_processing)).absolute().parent.resolve(), 'ancestor_pipelines.json')
-    with open(ancestor_pipeline_file, 'r') as f:
-        ancestors_dict = json.load(f)
-    ancestor_pipelines = ancestors_dict[pipeline_name]
-
-    #Load the associated_files dictionary, which tells you which files
-    #are associated with specific requirements (i.e. jsons for nii.gz, sbrefs, etc.)
-    associated_files_file = os.path.join(Path(inspect.getfile(update_processing)).absolute().parent.resolve(), 'associated_files.json')
-    with open(associated_files_file, 'r') as f:
-        associated_files_dict = json.load(f)    
-    
-    #Load the processing prerequisites for the current pipeline
-    requirements_dicts, file_selection_dict = load_requirements_infos(pipeline_name)
-    print('The following is a list of requirements dictionaries that will be used to determine whether a subject should be processed. If any one of these dictionaries is satisfied, processing will occur:')
-    for i, temp_dict in enumerate(requirements_dicts):
-        print('   ({}) {}\n'.format(i, temp_dict))
-
-    #If any of the requirements are dependent on QC info, return True
-    #otherwise return false and allow processing even when QC file is missing
-    qc_info_required = is_qc_info_required(file_selection_dict)
-    print("Is QC Info Required For the Current Pipeline (True/False): {}\n".format(qc_info_required))
-
-    #Load the processing prerequisites for the ancestor pipelines
-    #this will be used to check if the files that were previously
-    #selected for processing are still the same files that would
-    #be selected if the ancestor pipelines were ran again
-    ancestor_pipelines_file_selection_dict = {}
-    for temp_ancestor in ancestor_pipelines:
-        ancestor_pipelines_file_selection_dict[temp_ancestor] = load_requirements_infos(temp_ancestor)[1]
-    print('The following ancestor pipelines will be checked for file selection consistency: {}\n'.format(ancestor_pipelines))
-
-    #Path to external requirements file for the given pipeline      
-    external_requirements_file_path = os.path.join(Path(inspect.getfile(update_processing)).absolute().parent.resolve(), 'external_requirements', '{}.json'.format(pipeline_name))
-    with open(external_requirements_file_path, 'r') as f:
-        external_requirements_dict = json.load(f)
-    print('The external requirements dictionary for the current pipeline is as follows: {}\n'.format(external_requirements_dict))
-    print('The full file selection dictionary (made up of the union of all requirements dictionaries) is as follows:')
-    pretty_print_text = json.dumps(file_selection_dict, indent=4)
-    print('{}\n'.format(pretty_print_text))
-    ##################################################################
+    backend_limits = AsyncBackendLimits(s3_concurrency = s3_concurrency, cbrain_concurrency = cbrain_concurrency,
+                                        evaluation_concurrency = max_evaluation_workers)
+    #One page at a time per call so that cbrain_concurrency limits the requests in flight
+    cbrain_client = get_cbrain_client(cbrain_client).with_max_concurrent_pages(1)
+    try:
+        group_id, bids_bucket, bids_data_provider_id, session_dps_dict = await run_in_backend(backend_limits, 'cbrain', grab_cbrain_initialization_details,
+                                                                                              cbrain_api_token, group_name, bids_data_provider_name,
+                                                                                              session_data_provider_names, cbrain_client = cbrain_client)
+
+        print("You are currently attempting to launch processing jobs with the tool {}.\n".format(pipeline_name))
+
+        #Load the tool config id for the current pipeline being used for processing
+        tool_config_file = os.path.join(Path(inspect.getfile(update_processing)).absolute().parent.resolve(), 'tool_config_ids.json')
+        with open(tool_config_file, 'r') as f:
+            tool_config_dict = json.load(f)
+        tool_config_id = str(tool_config_dict[pipeline_name])
+
+        #See if the current pipeline has any 'ancestor pipelines', if so
+        #we will use this list to be sure that the files that were previously
+        #selected when those processing pipelines were ran are still the same
+        #files that would be chosen if those pipelines were ran again. If this
+        #is not the case, then we will want to pause on processing the current
+        #subject until the ancestor pipelines are rerun.
+        ancestor_pipeline_file = os.path.join(Path(inspect.getfile(update_processing)).absolute().parent.resolve(), 'ancestor_pipelines.json')
+        with open(ancestor_pipeline_file, 'r') as f:
+            ancestors_dict = json.load(f)
+        ancestor_pipelines = ancestors_dict[pipeline_name]
+
+        #Load the associated_files dictionary, which tells you which files
+        #are associated with specific requirements (i.e. jsons for nii.gz, sbrefs, etc.)
+        associated_files_file = os.path.join(Path(inspect.getfile(update_processing)).absolute().parent.resolve(), 'associated_files.json')
+        with open(associated_files_file, 'r') as f:
+            associated_files_dict = json.load(f)    
+    
+        #Load the processing prerequisites for the current pipeline
+        requirements_dicts, file_selection_dict = load_requirements_infos(pipeline_name)
+        print('The following is a list of requirements dictionaries that will be used to determine whether a subject should be processed. If any one of these dictionaries is satisfied, processing will occur:')
+        for i, temp_dict in enumerate(requirements_dicts):
+            print('   ({}) {}\n'.format(i, temp_dict))
+
+        #If any of the requirements are dependent on QC info, return True
+        #otherwise return false and allow processing even when QC file is missing
+        qc_info_required = is_qc_info_required(file_selection_dict)
+        print("Is QC Info Required For the Current Pipeline (True/False): {}\n".format(qc_info_required))
+
+        #Load the processing prerequisites for the ancestor pipelines
+        #this will be used to check if the files that were previously
+        #selected for processing are still the same files that would
+        #be selected if the ancestor pipelines were ran again
+        ancestor_pipelines_file_selection_dict = {}
+        for temp_ancestor in ancestor_pipelines:
+            ancestor_pipelines_file_selection_dict[temp_ancestor] = load_requirements_infos(temp_ancestor)[1]
+        print('The following ancestor pipelines will be checked for file selection consistency: {}\n'.format(ancestor_pipelines))
+
+        #Path to external requirements file for the given pipeline      
+        external_requirements_file_path = os.path.join(Path(inspect.getfile(update_processing)).absolute().parent.resolve(), 'external_requirements', '{}.json'.format(pipeline_name))
+        with open(external_requirements_file_path, 'r') as f:
+            external_requirements_dict = json.load(f)
+        print('The external requirements dictionary for the current pipeline is as follows: {}\n'.format(external_requirements_dict))
+        print('The full file selection dictionary (made up of the union of all requirements dictionaries) is as follows:')
+        pretty_print_text = json.dumps(file_selection_dict, indent=4)
+        print('{}\n'.format(pretty_print_text))
+        ##################################################################
         
         
-    #Code to be sure that only one BidsSubject entry is in the configuration json...
-    #otherwise this script doesn't have logic to fullfill processing requirements...
-    num_bids_subject_requirements = 0
-    for temp_requirement in external_requirements_dict.keys():
-        if external_requirements_dict[temp_requirement] == 'BidsSubject':
-            num_bids_subject_requirements += 1
-    if num_bids_subject_requirements > 1:
-        raise ValueError('Error: This script was not designed to work for pipelines that take more than one BidsSubject inputs since the BidsSubject input will be replaced with an extended file list, and the script only knows how to generate one of these at a time.')
-    ###################################################################################
+        #Code to be sure that only one BidsSubject entry is in the configuration json...
+        #otherwise this script doesn't have logic to fullfill processing requirements...
+        num_bids_subject_requirements = 0
+        for temp_requirement in external_requirements_dict.keys():
+            if external_requirements_dict[temp_requirement] == 'BidsSubject':
+                num_bids_subject_requirements += 1
+        if num_bids_subject_requirements > 1:
+            raise ValueError('Error: This script was not designed to work for pipelines that take more than one BidsSubject inputs since the BidsSubject input will be replaced with an extended file list, and the script only knows how to generate one of these at a time.')
+        ###################################################################################
         
-    #Grab CBRAIN Tasks that will later be referenced, and seperate them by results data provider ########
-    current_cbrain_tasks = find_current_cbrain_tasks(cbrain_api_token, data_provider_id = None) #this is bids_data_provider_id because we currently only support processing that grabs/saves from one DP
-    cbrain_session_tasks = {}
-    for temp_ses in session_dps_dict.keys():
-        temp_dp_id = session_dps_dict[temp_ses]['id']
-        cbrain_session_tasks[temp_ses] = list(filter(lambda f: temp_dp_id == f['results_data_provider_id'], current_cbrain_tasks))
-
-    #Grab CBRAIN Files that will later be referenced ##################################################
-    cbrain_files = find_cbrain_entities(cbrain_api_token, 'userfiles')
-    bids_data_provider_files = list(filter(lambda f: bids_data_provider_id == f['data_provider_id'], cbrain_files))
-    cbrain_deriv_files = {}
-    print('The following derivative data providers will be used to see if processing is needed + to house the outputs of jobs launched later in the script:')
-    for temp_ses in session_dps_dict.keys():
-        temp_dp_id = session_dps_dict[temp_ses]['id']
-        cbrain_deriv_files[temp_ses] = list(filter(lambda f: temp_dp_id == f['data_provider_id'], cbrain_files))
-        print('   Name: {}, ID: {}, Bucket: {}, CBRAIN Defined Prefix: {}'.format(temp_ses, temp_dp_id, session_dps_dict[temp_ses]['bucket'], session_dps_dict[temp_ses]['prefix']))
-        print("      {} total files found under data provider".format(len(cbrain_deriv_files[temp_ses])))
-
-    #Print out info about what files were found
-    print('\n')
-    print('Processing will occur using BidsSubjects under the following DataProvider:\nName: {}, ID: {}, Bucket: {}, User Defined Prefix: {}'.format(bids_data_provider_name, bids_data_provider_id, bids_bucket, bids_bucket_prefix))
-    print("      {} total files found under data provider".format(len(bids_data_provider_files)))
-    ########################################################################################
-    
-    registered_and_s3_names, registered_and_s3_ids = find_potential_subjects_for_processing_v2(bids_data_provider_files, bids_bucket_config,
-                                                       bids_bucket = bids_bucket, bids_prefix = bids_bucket_prefix)
-    print('      Found {} BidsSubjects under DP\n'.format(len(registered_and_s3_names)))
-    
-    
-    #A list to store details about why some subjects were processed
-    #and others were not
-    study_processing_details = []
-    
-    subject_external_requirements_list = []
-    all_to_keep_lists = [] #list of lists of files to keep for each subject
-    final_subjects_ids_for_proc = [] #list of subjects that fullfill requirements for processing
-    final_subjects_names_for_proc = [] #list of subjects that fullfill requirements for processing
-    metadata_dicts_list = [] #list for keeping track of s3 file identifiers
-    subject_sessions_launched = 0
-    for i, temp_subject in enumerate(registered_and_s3_names):
-        for j, temp_ses in enumerate(session_dps_dict.keys()):
-
-            #This should always be something like 'ses-V01', 'ses-V02', etc.
-            temp_ses_name = session_dps_dict[temp_ses]['prefix'].split('/')[-1]
-
-            #Before gathering information about the current subject and session,
-            #check if we have already processed the maximum number of subjects.
+        #Grab CBRAIN Tasks that will later be referenced, seperated by results data provider (only
+        #tasks for the current tool config are relevant, see check_rerun_status), and the CBRAIN Files
+        #that will later be referenced, one data provider at a time. The BIDS bucket is listed at the
+        #same time. CBRAIN requests are made one at a time if they need to update the snapshot.
+        async def find_cbrain_tasks_and_files():
+            cbrain_requests = []
+            for temp_ses in session_dps_dict.keys():
+                cbrain_requests.append(run_in_backend(backend_limits, 'cbrain', find_current_cbrain_tasks, cbrain_api_token,
+                                                      data_provider_id = session_dps_dict[temp_ses]['id'],
+                                                      tool_config_id = tool_config_id, cbrain_client = cbrain_client,
+                                                      snapshot_path = cbrain_snapshot_path,
+                                                      snapshot_max_age_minutes = cbrain_snapshot_max_age_minutes,
+                                                      snapshot_full_reconcile_hours = cbrain_snapshot_full_reconcile_hours))
+            for temp_dp_id in [bids_data_provider_id] + [session_dps_dict[temp_ses]['id'] for temp_ses in session_dps_dict.keys()]:
+                cbrain_requests.append(find_cbrain_entities_async(cbrain_api_token, 'userfiles', cbrain_client = cbrain_client,
+                                                                  filters = {'data_provider_id' : temp_dp_id},
+                                                                  snapshot_path = cbrain_snapshot_path,
+                                                                  snapshot_max_age_minutes = cbrain_snapshot_max_age_minutes,
+                                                                  snapshot_full_reconcile_hours = cbrain_snapshot_full_reconcile_hours,
+                                                                  backend_limits = backend_limits))
+            if type(cbrain_snapshot_path) == type(None):
+                return await asyncio.gather(*cbrain_requests)
+            return [await temp_request for temp_request in cbrain_requests]
+
+        #List the BIDS bucket once. All subject/session file lookups below
+        #will be served from this inventory instead of new S3 requests.
+        cbrain_results, s3_inventory = await asyncio.gather(find_cbrain_tasks_and_files(),
+                                                            run_in_backend(backend_limits, 's3', build_s3_inventory, bids_bucket_config,
+                                                                           bucket = bids_bucket, prefix = bids_bucket_prefix,
+                                                                           listing_cache_path = s3_listing_cache_path,
+                                                                           max_subject_age_hours = s3_listing_max_age_hours))
+        num_sessions = len(session_dps_dict.keys())
+        cbrain_session_tasks = dict(zip(session_dps_dict.keys(), cbrain_results[:num_sessions]))
+        bids_data_provider_files = cbrain_results[num_sessions]
+        cbrain_deriv_files = dict(zip(session_dps_dict.keys(), cbrain_results[num_sessions + 1:]))
+        cbrain_task_index = build_cbrain_task_index(cbrain_session_tasks)
+
+        print('The following derivative data providers will be used to see if processing is needed + to house the outputs of jobs launched later in the script:')
+        for temp_ses in session_dps_dict.keys():
+            temp_dp_id = session_dps_dict[temp_ses]['id']
+            print('   Name: {}, ID: {}, Bucket: {}, CBRAIN Defined Prefix: {}'.format(temp_ses, temp_dp_id, session_dps_dict[temp_ses]['bucket'], session_dps_dict[temp_ses]['prefix']))
+            print("      {} total files found under data provider".format(len(cbrain_deriv_files[temp_ses])))
+
+        #Print out info about what files were found
+        print('\n')
+        print('Processing will occur using BidsSubjects under the following DataProvider:\nName: {}, ID: {}, Bucket: {}, User Defined Prefix: {}'.format(bids_data_provider_name, bids_data_provider_id, bids_bucket, bids_bucket_prefix))
+        print("      {} total files found under data provider".format(len(bids_data_provider_files)))
+        ########################################################################################
+
+        registered_and_s3_names, registered_and_s3_ids = find_potential_subjects_for_processing_v2(bids_data_provider_files, bids_bucket_config,
+                                                           bids_bucket = bids_bucket, bids_prefix = bids_bucket_prefix,
+                                                           s3_inventory = s3_inventory)
+        print('      Found {} BidsSubjects under DP\n'.format(len(registered_and_s3_names)))
+
+        #Index the CBRAIN files that each session can use for its external requirements
+        cbrain_file_indices = {}
+        for temp_ses in session_dps_dict.keys():
+            cbrain_file_indices[temp_ses] = build_cbrain_file_index(bids_data_provider_files + cbrain_deriv_files[temp_ses])
+
+        #Find which subjects already have derivatives, one listing per session data provider
+        derivative_listings = []
+        for temp_ses in session_dps_dict.keys():
+            temp_pipeline_prefix = os.path.join(session_dps_dict[temp_ses]['prefix'], pipeline_name) #derivatives_bucket_prefix currently includes session info
+            derivative_listings.append(run_in_backend(backend_limits, 's3', find_subjects_with_derivatives, session_dps_dict[temp_ses]['bucket'],
+                                                      temp_pipeline_prefix, derivatives_bucket_config))
+        session_subjects_with_derivatives = dict(zip(session_dps_dict.keys(), await asyncio.gather(*derivative_listings)))
+
+        #Load the scans.tsv files for all subject/sessions that don't already have derivatives
+        scans_tsv_files = None
+        if type(logs_directory) != type(None):
+            subject_sessions_to_prefetch = []
+            for temp_subject in registered_and_s3_names:
+                for temp_ses in session_dps_dict.keys():
+                    if temp_subject not in session_subjects_with_derivatives[temp_ses]:
+                        subject_sessions_to_prefetch.append((temp_subject, session_dps_dict[temp_ses]['prefix'].split('/')[-1]))
+            #One file per call so that s3_concurrency limits the files loaded at the same time
+            scans_tsv_fetches = []
+            for temp_subject_session in dict.fromkeys(subject_sessions_to_prefetch):
+                scans_tsv_fetches.append(run_in_backend(backend_limits, 's3', prefetch_scans_tsv_files, bids_bucket_config, [temp_subject_session],
+                                                        bids_prefix = bids_bucket_prefix, bucket = bids_bucket, s3_inventory = s3_inventory,
+                                                        max_workers = 1))
+            scans_tsv_files = {}
+            for temp_scans_tsv_files in await asyncio.gather(*scans_tsv_fetches):
+                scans_tsv_files.update(temp_scans_tsv_files)
+
+            #Evaluate the QC criteria for every file of every subject/session at once
+            if qc_info_required == True:
+                qc_requirements_dicts = [file_selection_dict] + requirements_dicts + list(ancestor_pipelines_file_selection_dict.values())
+                qc_table = build_qc_table(scans_tsv_files, qc_requirements_dicts)
+                scans_tsv_files = split_qc_table(qc_table, scans_tsv_files)
+
+        #Load the selection fingerprints and submission logs of the ancestor pipelines, one listing per
+        #session data provider. Fingerprints are only used if their log is still in the listing with the
+        #same ETag/LastModified. Logs are loaded for the other subjects/pipelines. Their fingerprints,
+        #and the fingerprints of the subjects submitted below, are saved once per session at the end
+        #of the run, and only for sessions where something was submitted.
+        session_submission_logs = {}
+        session_selection_fingerprints = {}
+        session_new_fingerprint_entries = {}
+        session_submitted_fingerprints = {}
+        for temp_ses in session_dps_dict.keys():
+            session_submission_logs[temp_ses] = None
+            session_selection_fingerprints[temp_ses] = None
+            session_new_fingerprint_entries[temp_ses] = {}
+            session_submitted_fingerprints[temp_ses] = {}
+        if check_ancestor_pipelines and (len(ancestor_pipelines) > 0):
+            async def load_ancestor_selections(temp_ses):
+                temp_subjects = [temp_subject for temp_subject in registered_and_s3_names if temp_subject not in session_subjects_with_derivatives[temp_ses]]
+                temp_misc_prefix = os.path.join(session_dps_dict[temp_ses]['prefix'], logs_prefix)
+                stored_fingerprints = await run_in_backend(backend_limits, 's3', load_selection_fingerprints, derivatives_bucket_config,
+                                                           session_dps_dict[temp_ses]['bucket'], temp_misc_prefix)
+                log_listing = await run_in_backend(backend_limits, 's3', list_submission_logs, derivatives_bucket_config,
+                                                   session_dps_dict[temp_ses]['bucket'], session_dps_dict[temp_ses]['prefix'],
+                                                   subjects = temp_subjects, pipelines = ancestor_pipelines)
+                session_selection_fingerprints[temp_ses] = validate_selection_fingerprints(stored_fingerprints, log_listing)
+                #One log per call so that s3_concurrency limits the logs loaded at the same time
+                log_loads = []
+                for temp_key in log_listing.keys():
+                    if temp_key not in session_selection_fingerprints[temp_ses]:
+                        log_loads.append(run_in_backend(backend_limits, 's3', prefetch_submission_logs, derivatives_bucket_config,
+                                                        session_dps_dict[temp_ses]['bucket'], session_dps_dict[temp_ses]['prefix'],
+                                                        log_listing = {temp_key : log_listing[temp_key]}, max_workers = 1))
+                session_submission_logs[temp_ses] = {}
+                for temp_submission_logs in await asyncio.gather(*log_loads):
+                    session_submission_logs[temp_ses].update(temp_submission_logs)
+                for temp_key, temp_s3_metadata in session_submission_logs[temp_ses].items():
+                    session_new_fingerprint_entries[temp_ses][temp_key] = selection_fingerprint_entry(compute_selection_fingerprint(temp_s3_metadata, session_agnostic_files = session_agnostic_files),
+                                                                                                      log_listing[temp_key])
+            await asyncio.gather(*[load_ancestor_selections(temp_ses) for temp_ses in session_dps_dict.keys()])
+    
+    
+        #Everything that evaluate_subject_session needs to know about the run
+        run_info = {'pipeline_name' : pipeline_name,
+                    'tool_config_id' : tool_config_id,
+                    'rerun_level' : rerun_level,
+                    'file_selection_dict' : file_selection_dict,
+                    'requirements_dicts' : requirements_dicts,
+                    'external_requirements_dict' : external_requirements_dict,
+                    'ancestor_pipelines_file_selection_dict' : ancestor_pipelines_file_selection_dict,
+                    'associated_files_dict' : associated_files_dict,
+                    'qc_info_required' : qc_info_required,
+                    'scans_tsv_files' : scans_tsv_files,
+                    'session_dps_dict' : session_dps_dict,
+                    'session_subjects_with_derivatives' : session_subjects_with_derivatives,
+                    'cbrain_task_index' : cbrain_task_index,
+                    'cbrain_file_indices' : cbrain_file_indices,
+                    'bids_data_provider_id' : bids_data_provider_id,
+                    'bids_bucket_config' : bids_bucket_config,
+                    'bids_bucket' : bids_bucket,
+                    'bids_bucket_prefix' : bids_bucket_prefix,
+                    's3_inventory' : s3_inventory,
+                    'session_agnostic_files' : session_agnostic_files,
+                    'minimum_file_age_days' : minimum_file_age_days,
+                    'check_ancestor_pipelines' : check_ancestor_pipelines,
+                    'derivatives_bucket_config' : derivatives_bucket_config,
+                    'logs_directory' : logs_directory,
+                    'session_submission_logs' : session_submission_logs,
+                    'session_selection_fingerprints' : session_selection_fingerprints,
+                    'verbose' : verbose}
+
+        #A list to store details about why some subjects were processed
+        #and others were not
+        study_processing_details = []
+
+        #Subject/sessions are evaluated in chunks (steps 1-10, see evaluate_subject_sessions_async), and then
+        #the subject/sessions that are ready are submitted one at a time in the original order.
+        #Chunks are never larger than the number of launches left before max_subject_sessions_to_proc
+        #is reached (each subject/session launches at most one task), so no extra evaluations are made.
+        subject_sessions = []
+        for i, temp_subject in enumerate(registered_and_s3_names):
+            for temp_ses in session_dps_dict.keys():
+                subject_sessions.append((temp_subject, registered_and_s3_ids[i], temp_ses))
+        evaluation_chunk_size = max(1, max_evaluation_workers) * 4
+
+        subject_sessions_launched = 0
+        chunk_start = 0
+        while chunk_start < len(subject_sessions):
+            chunk_size = evaluation_chunk_size
             if type(max_subject_sessions_to_proc) != type(None):
-                if subject_sessions_launched >= max_subject_sessions_to_proc:
+                chunk_size = min(chunk_size, max_subject_sessions_to_proc - subject_sessions_launched)
+                if chunk_size <= 0:
                     break
-        
-            print('Evaluating: {}, {}'.format(temp_subject, temp_ses_name))
-            
-            #A dictionary to store details that will later be used to populate
-            #a spreadsheet that will be used to track processing across subjects
-            if 'subject_processing_details' in locals():
-                study_processing_details.append(subject_processing_details)
-
-            subject_processing_details = {}
-            subject_processing_details['subject'] = temp_subject
-            subject_processing_details['pipeline'] = pipeline_name
-            subject_processing_details['session'] = temp_ses_name
-            subject_processing_details['derivatives_found'] = "Not Evaluated"
-            subject_processing_details['CBRAIN_Status'] = "Not Evaluated"
-            subject_processing_details['scans_tsv_present'] = "Not Evaluated"
-            subject_processing_details['Ancestor_Files'] = "Not Evaluated"
-            
-            #Be sure that the current subject doesn't have existing output before starting processing
-            subject_derivatives_prefix = os.path.join(session_dps_dict[temp_ses]['prefix'], pipeline_name, temp_subject) #derivatives_bucket_prefix currently includes session info
-            if file_exists_under_prefix(session_dps_dict[temp_ses]['bucket'], subject_derivatives_prefix, derivatives_bucket_config):
-                subject_processing_details['derivatives_found'] = True
-                for temp_req in file_selection_dict.keys():
-                    subject_processing_details[temp_req] = 'Already Processed'
-                for temp_req in external_requirements_dict.keys():
-                    subject_processing_details['CBRAIN_' + temp_req] = 'Already Processed'
-                subject_processing_details['CBRAIN_Status'] = 'Already Processed'
-                subject_processing_details['scans_tsv_present'] = "Already Processed"
-
-                print('    Already has derivatives')
-                continue
-            else:
-                subject_processing_details['derivatives_found'] = False
-
-            #Check what type of processing has already occured for the subject with
-            #this pipeline and only continue if processing hasn't already been initiated
-            #or under certain failure conditions (see documentation for check_rerun_status)
-            to_rerun, example_status = check_rerun_status(registered_and_s3_ids[i], cbrain_session_tasks[temp_ses], session_dps_dict[temp_ses]['id'], tool_config_id, rerun_level = rerun_level)
-            subject_processing_details['CBRAIN_Status'] = example_status
-            if False == to_rerun:
-                continue #Check rerun status will print out a message to the user if processing is not going to be rerun
-
-            #Grab the QC file for this subject so we can figure out which files can be used for processing.
-            #If no QC requirements are specified in the comprehensive processing prerequisites, then the QC file will be ignored.
-            if type(logs_directory) != type(None):
-                subj_ses_qc_file_path = download_scans_tsv_file(bids_bucket_config, logs_directory, temp_subject, temp_ses_name, bids_prefix = bids_bucket_prefix, bucket = bids_bucket, client = None)
-                if (type(subj_ses_qc_file_path) == type(None)) and (qc_info_required == True):
-                    print('    Skipping Processing - No QC file found for subject')
-                    subject_processing_details['scans_tsv_present'] = False
-                    for temp_req in file_selection_dict.keys():
-                        subject_processing_details[temp_req] = 'No scans.tsv'
-                    for temp_req in external_requirements_dict.keys():
-                        subject_processing_details['CBRAIN_' + temp_req] = 'No scans.tsv'
-                    subject_processing_details['CBRAIN_Status'] = 'No scans.tsv'
-                    subject_processing_details['derivatives_found'] = "No (Missing scans.tsv)"
+            chunk = subject_sessions[chunk_start:chunk_start + chunk_size]
+            chunk_start += chunk_size
+            evaluations = await evaluate_subject_sessions_async(chunk, run_info, backend_limits = backend_limits)
+            for (temp_subject, temp_subject_id, temp_ses), (evaluation, printed_text, error) in zip(chunk, evaluations):
+
+                print(printed_text, end = '')
+                if type(error) != type(None):
+                    raise error
+                study_processing_details.append(evaluation['tracking'])
+                if evaluation['ready'] == False:
                     continue
-                else:
-                    subject_processing_details['scans_tsv_present'] = True
-                    if qc_info_required == False:
-                        subj_ses_qc_file = None
-                    else:
-                        subj_ses_qc_file = pd.read_csv(subj_ses_qc_file_path, delimiter = '\t', na_values=['_NaN_', '_Inf_'])
-                    try:
-                        os.remove(subj_ses_qc_file_path)
-                    except:
-                        pass
-            else:
-                subj_ses_qc_file = None
-
-
-            #Grab a list of BIDS associated files for this subject in S3
-            try:
-                subject_files = grab_subject_file_info(temp_subject, bids_bucket_config, bucket = bids_bucket, prefix = bids_bucket_prefix)
-            except Exception as error:
-                print(error)
-                raise RuntimeError('Error: unable to grab file names for S3 for current subject. This likely means S3 access is having issues.')
-            if len(subject_files) == 0:
-                print('   Warning: No S3 files found for subject')
-
-            #Reduce the files to those that are relevant for
-            #the current session being processed
-            session_level = len(bids_bucket_prefix.split('/')) + 1 
-            session_files = grab_session_specific_file_info(subject_files, temp_ses_name,
-                                session_agnostic_files = session_agnostic_files,
-                                session_level = session_level)
-            if len(session_files) == 0:
-                print('   No files found for subject/session combo')
-                continue
-
-
-            #First run preliminary check for requirements that is only used
-            #for the purpose of populating the processing details spreadsheet.
-            #Later requirements check will actually be used to determine if 
-            #processing will be attempted.
-            temp_req_output, req_tracking_dict = check_bids_requirements_v2(temp_subject, session_files, file_selection_dict,
-                                qc_df = subj_ses_qc_file, bucket = bids_bucket, prefix = bids_bucket_prefix,
-                                bids_bucket_config = bids_bucket_config, session = temp_ses_name,
-                                session_agnostic_files = session_agnostic_files,
-                                verbose = verbose)
-            subject_processing_details.update(req_tracking_dict)
-                
-            #Check that the subject has requirements satisfiying at least one pipeline specific json in the processing_prerequisites folder
-            requirements_satisfied = 0
-            none_found = 0
-            for temp_requirement in requirements_dicts:
-                temp_req_output, _ = check_bids_requirements_v2(temp_subject, session_files, temp_requirement,
-                            qc_df = subj_ses_qc_file, bucket = bids_bucket, prefix = bids_bucket_prefix,
-                            bids_bucket_config = bids_bucket_config, session = temp_ses_name,
-                            session_agnostic_files = session_agnostic_files,
-                            verbose = verbose)
-                #If return == None, this is because some QC info was expected but is missing
-                if type(temp_req_output) == type(None):
-                    none_found = 1
-                #Otherwise, a requirement was either passed or failed as expected
-                else:
-                    requirements_satisfied += int(temp_req_output)
-                
-            if (requirements_satisfied == 0) or (none_found == 1):
-                print('    Requirements not satisfied')
-                subject_processing_details['derivatives_found'] = "No (Missing BIDS Reqs)"
-                subject_processing_details['CBRAIN_Status'] = "No Proc. (Missing BIDS Reqs)"
-                continue
-                
-            #Check that the external requirements are satisfied for the subject (these are pipeline inputs that will be files/file collections
-            #that should already be available for the subject on CBRAIN if the subject is ready for processing). Note that
-            #the files being passed to this function are already specific to a single data provider.
-            subject_external_requirements, req_tracking_dict = grab_external_requirements(temp_subject, bids_data_provider_files + cbrain_deriv_files[temp_ses],
-                                                                        external_requirements_dict, bids_data_provider_id = bids_data_provider_id,
-                                                                        derivatives_data_provider_id = session_dps_dict[temp_ses]['id']) #implement function for this...
-            
-            #Update tracking dict based on grab_external_requirements results
-            for temp_key in req_tracking_dict.keys():
-                subject_processing_details['CBRAIN_' + temp_key] = req_tracking_dict[temp_key]
-            
-            #Skip processing for subject if external requirements aren't found
-            if subject_external_requirements is None:
-                print('    Missing external requirements')
-                subject_processing_details['derivatives_found'] = "No (Missing Derived Reqs)"
-                subject_processing_details['CBRAIN_Status'] = "No Proc. (Missing Derived Reqs)"
-                continue #skip processing if external requirements aren't found
-                
-            #Grab files for the subject according to pipeline specific jsons in processing_file_numbers and processing_file_selection folders
-            subject_files_list, metadata_dict = grab_required_bids_files_v2(temp_subject, session_files, file_selection_dict,
-                                                                            qc_df = subj_ses_qc_file, bucket = bids_bucket,
-                                                                            prefix = bids_bucket_prefix,
-                                                                            bids_bucket_config = bids_bucket_config,
-                                                                            session = temp_ses_name, session_agnostic_files = session_agnostic_files,
-                                                                            associated_files_dict = associated_files_dict,
-                                                                            verbose = False)
-            if type(subject_files_list) == type(None):
-                print('    An issue was encountered in grab_required_bids_files_v2. If processing has gotten to this point')
-                print('    it is likely the case that (1) the subject has at least some files that satisfy QC requirements,')
-                print('    but that, (2) at least one file is missing QC information for one category, making')
-                print('    a comparison of files within that category impossible. For this reason the subject')
-                print('    will not be processed at this time. Look at the subject scans.tsv file for relevant details')
-                subject_processing_details['derivatives_found'] = "No (scans.tsv issue)"
-                subject_processing_details['CBRAIN_Status'] = "No Proc. (scans.tsv issue)"
-                continue
-            
-            #Check if all files are old enough for processing. Generally we will
-            #want to wait several days before processing to be sure that there is
-            #time for the QC information to get populated
-            files_old_enough = check_all_files_old_enough(metadata_dict, minimum_file_age_days, 
-                                file_patterns_to_ignore = session_agnostic_files,
-                                verbose = False)
-            if files_old_enough == False:
-                print('    Files not old enough for processing')
-                subject_processing_details['derivatives_found'] = "No (Files Not Old Enough)"
-                subject_processing_details['CBRAIN_Status'] = "No Proc. (Files Not Old Enough)"
-                continue
-            
-            #Go through all "ancestor" processing requirements, and ensure
-            #that the files that would be selected for processing today are
-            #the same as the files that were selected when the ancestor
-            #pipelines were ran. If this is not the case, then processing
-            #of this subject will be paused until the ancestor pipelines are rerun.
-            if check_ancestor_pipelines:
-                if len(ancestor_pipelines) > 0:
-                    are_ancestors_the_same = check_if_ancestor_file_selection_is_same(temp_subject, session_files, ancestor_pipelines_file_selection_dict, qc_df = subj_ses_qc_file,
-                                                                bids_bucket = bids_bucket, bids_prefix = bids_bucket_prefix, bids_bucket_config = bids_bucket_config,
-                                                                session = temp_ses_name, session_agnostic_files = session_agnostic_files, associated_files_dict = associated_files_dict,
-                                                                verbose = verbose, derivatives_bucket_config = derivatives_bucket_config, derivatives_bucket = session_dps_dict[temp_ses]['bucket'],
-                                                                derivatives_bucket_prefix = session_dps_dict[temp_ses]['prefix'], logs_directory = logs_directory)
-                    if are_ancestors_the_same == False:
-                        print('    Pausing processing until ancestor pipelines are rerun')
-                        subject_processing_details['derivatives_found'] = "No (Ancestor Files Different)"
-                        subject_processing_details['CBRAIN_Status'] = "No Proc. (Ancestor Files Different)"
-                        subject_processing_details['Ancestor_Files'] = 'Different'
-                        continue
-                    else:
-                        subject_processing_details['Ancestor_Files'] = 'Same'
 
-                
-            
+                ########################################################################
+                ########################################################################
+                #If script gets to this point for a given subject, session, and pipeline,
+                #then try to launch a job for processing in CBRAIN.
+                #########################################################################
+                #########################################################################
+                temp_ses_name = session_dps_dict[temp_ses]['prefix'].split('/')[-1]
+                subject_external_requirements = evaluation['external_requirements']
+                print('    Processing {} with data from {} using {} via API'.format(temp_subject, temp_ses_name, pipeline_name))
 
-            if type(subject_files_list) == type(None): #Guessing this never happens?
-                print('    scans.tsv missing one or more acquisitions. Skipping processing.')
-                continue
 
-            #Save subject information with other subjects that are ready for processing
-            all_to_keep_lists.append(subject_files_list)
-            metadata_dicts_list.append(metadata_dict)
-            subject_external_requirements_list.append(subject_external_requirements)
-            final_subjects_ids_for_proc.append(registered_and_s3_ids[i])
-            final_subjects_names_for_proc.append(temp_subject)
-            subject_processing_details['CBRAIN_Status'] = 'Initiating Processing'
-
-            #Update the study processing details dict for the last subject
-            if 'subject_processing_details' in locals():
-                study_processing_details.append(subject_processing_details)
-
-            ########################################################################
-            ########################################################################
-            #If script gets to this point for a given subject, session, and pipeline,
-            #then try to launch a job for processing in CBRAIN.
-            #########################################################################
-            #########################################################################
-            print('    Processing {} with data from {} using {} via API'.format(final_subjects_names_for_proc[-1], temp_ses_name, pipeline_name))
-
-
-            #Run "mark as newer" to be sure the latest version of the subject data
-            #is in the local CBRAIN cache once processing begins##################
-            try:
-                for temp_key in subject_external_requirements_list[-1].keys():
-                    cbrain_mark_as_newer(subject_external_requirements_list[-1][temp_key], cbrain_api_token)                
-
-                #Launch Processing
-                status, json_for_logging = launch_task_concise_dict(pipeline_name, subject_external_requirements_list[-1], cbrain_api_token, data_provider_id = session_dps_dict[temp_ses]['id'],
-                                            group_id = group_id, user_id = user_id, task_description = '{} via API'.format(final_subjects_names_for_proc[-1]),
-                                            all_to_keep = all_to_keep_lists[-1], session_label = temp_ses_name.split('-')[1])
-            except:
-                print('Error encountered while trying to submit job for processing. This is likely a networking issue. Will try again in 5 seconds.')
-                time.sleep(5) #wait 5 seconds and try again
-                for temp_key in subject_external_requirements_list[-1].keys():
-                    cbrain_mark_as_newer(subject_external_requirements_list[-1][temp_key], cbrain_api_token)                
-
-                #Launch Processing
-                status, json_for_logging = launch_task_concise_dict(pipeline_name, subject_external_requirements_list[i], cbrain_api_token, data_provider_id = session_dps_dict[temp_ses]['id'],
-                                            group_id = group_id, user_id = user_id, task_description = '{} via API'.format(final_subjects_names_for_proc[-1]),
-                                            all_to_keep = all_to_keep_lists[-1], session_label = temp_ses_name.split('-')[1])
-            #######################################################################
+                #Run "mark as newer" to be sure the latest version of the subject data
+                #is in the local CBRAIN cache once processing begins##################
+                try:
+                    for temp_key in subject_external_requirements.keys():
+                        await cbrain_mark_as_newer_async(subject_external_requirements[temp_key], cbrain_api_token, cbrain_client = cbrain_client,
+                                                         backend_limits = backend_limits)
+
+                    #Launch Processing
+                    status, json_for_logging = await run_in_backend(backend_limits, 'cbrain', launch_task_concise_dict, pipeline_name, subject_external_requirements, cbrain_api_token, data_provider_id = session_dps_dict[temp_ses]['id'],
+                                                group_id = group_id, user_id = user_id, task_description = '{} via API'.format(temp_subject),
+                                                all_to_keep = evaluation['files_to_keep'], session_label = temp_ses_name.split('-')[1],
+                                                cbrain_client = cbrain_client)
+                except:
+                    print('Error encountered while trying to submit job for processing. This is likely a networking issue. Will try again in 5 seconds.')
+                    await asyncio.sleep(5) #wait 5 seconds and try again
+                    for temp_key in subject_external_requirements.keys():
+                        await cbrain_mark_as_newer_async(subject_external_requirements[temp_key], cbrain_api_token, cbrain_client = cbrain_client,
+                                                         backend_limits = backend_limits)
+
+                    #Launch Processing
+                    status, json_for_logging = await run_in_backend(backend_limits, 'cbrain', launch_task_concise_dict, pipeline_name, subject_external_requirements, cbrain_api_token, data_provider_id = session_dps_dict[temp_ses]['id'],
+                                                group_id = group_id, user_id = user_id, task_description = '{} via API'.format(temp_subject),
+                                                all_to_keep = evaluation['files_to_keep'], session_label = temp_ses_name.split('-')[1],
+                                                cbrain_client = cbrain_client)
+                #######################################################################
             
-            json_for_logging['s3_metadata'] = metadata_dicts_list[-1]
-            if status == False:
-                raise ValueError('Error CBRAIN processing tasked was not submitted for {}. Issue must be resolved for processing to continue.'.format(final_subjects_names_for_proc[-1]))
-            else:
-                if type(logs_directory) != type(None):
-                    log_file_name = os.path.join(logs_directory, '{}_{}_UMNProcSubmission.json'.format(final_subjects_names_for_proc[-1], pipeline_name))
-                    with open(log_file_name, 'w') as f:
-                        json.dump(json_for_logging, f, indent = 4)
-                    #derivatives_bucket_prefix
-                    upload_processing_config_log(log_file_name, bucket = session_dps_dict[temp_ses]['bucket'], prefix = os.path.join(session_dps_dict[temp_ses]['prefix'], logs_prefix), bucket_config = derivatives_bucket_config)
-                    os.remove(log_file_name)
-
-            if type(max_subject_sessions_to_proc) != type(None):
-                subject_sessions_launched += 1
+                json_for_logging['s3_metadata'] = evaluation['s3_metadata']
+                json_for_logging['selection_fingerprint'] = compute_selection_fingerprint(evaluation['s3_metadata'], session_agnostic_files = session_agnostic_files)
+                if status == False:
+                    raise ValueError('Error CBRAIN processing tasked was not submitted for {}. Issue must be resolved for processing to continue.'.format(temp_subject))
+                else:
+                    #Make sure the new task is seen by later runs that use the snapshot
+                    if type(cbrain_snapshot_path) != type(None):
+                        submitted_tasks = json_for_logging['returned_by_cbrain']
+                        if type(submitted_tasks) != list:
+                            submitted_tasks = [submitted_tasks]
+                        await run_in_backend(backend_limits, 'cbrain', record_cbrain_snapshot_entities, cbrain_snapshot_path, 'tasks', submitted_tasks)
+                    if type(logs_directory) != type(None):
+                        log_file_name = os.path.join(logs_directory, '{}_{}_UMNProcSubmission.json'.format(temp_subject, pipeline_name))
+                        with open(log_file_name, 'w') as f:
+                            json.dump(json_for_logging, f, indent = 4)
+                        #derivatives_bucket_prefix
+                        await upload_processing_config_log_async(log_file_name, bucket = session_dps_dict[temp_ses]['bucket'], prefix = os.path.join(session_dps_dict[temp_ses]['prefix'], logs_prefix), bucket_config = derivatives_bucket_config,
+                                                                 backend_limits = backend_limits)
+                        os.remove(log_file_name)
+                        #Keep the fingerprint of the files selected for processing so that
+                        #later runs of descendant pipelines can check them quickly
+                        session_submitted_fingerprints[temp_ses][(temp_subject, pipeline_name)] = json_for_logging['selection_fingerprint']
+
+                if type(max_subject_sessions_to_proc) != type(None):
+                    subject_sessions_launched += 1
+
+
+        #Save the selection fingerprints with one update per session (see record_selection_fingerprints)
+        async def save_session_fingerprints(temp_ses):
+            await run_in_backend(backend_limits, 's3', record_selection_fingerprints, derivatives_bucket_config, session_dps_dict[temp_ses]['bucket'],
+                                 session_dps_dict[temp_ses]['prefix'], os.path.join(session_dps_dict[temp_ses]['prefix'], logs_prefix),
+                                 session_submitted_fingerprints[temp_ses], other_entries = session_new_fingerprint_entries[temp_ses])
+        await asyncio.gather(*[save_session_fingerprints(temp_ses) for temp_ses in session_dps_dict.keys()
+                               if len(session_submitted_fingerprints[temp_ses])])
             
        
-    #################################################################################################
-    #################################################################################################
-    #Iterate through all subjects who were deemed ready for processing,
-    # and submit task to process their data in CBRAIN.
-    
-    study_tracking_df = pd.DataFrame.from_dict(study_processing_details)
-    if type(logs_directory) != type(None):
-        log_csv_name = os.path.join(logs_directory, 'processing_details_{}.csv'.format(pipeline_name))
-        log_html_name = os.path.join(logs_directory, 'processing_details_{}.html'.format(pipeline_name))
-        study_tracking_df = html_tools.reformat_df_and_produce_proc_html(study_tracking_df, pipeline_name, log_html_name, file_selection_dict)
-        study_tracking_df.to_csv(log_csv_name, index = False)
+        #################################################################################################
+        #################################################################################################
+        #Iterate through all subjects who were deemed ready for processing,
+        # and submit task to process their data in CBRAIN.
+
+        study_tracking_df = pd.DataFrame.from_dict(study_processing_details)
+        if type(logs_directory) != type(None):
+            log_csv_name = os.path.join(logs_directory, 'processing_details_{}.csv'.format(pipeline_name))
+            log_html_name = os.path.join(logs_directory, 'processing_details_{}.html'.format(pipeline_name))
+            study_tracking_df = html_tools.reformat_df_and_produce_proc_html(study_tracking_df, pipeline_name, log_html_name, file_selection_dict)
+            study_tracking_df.to_csv(log_csv_name, index = False)
 
     
-    return study_tracking_df
\ No newline at end of file
+        return study_tracking_df
+    finally:
+        backend_limits.close()
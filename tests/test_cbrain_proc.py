@@ -0,0 +1,866 @@
+import datetime
+import json
+import sys
+import threading
+import time
+from io import BytesIO
+
+import pandas as pd
+import pytest
+
+import cbrain_proc
+
+
+class FakeS3Client:
+    '''Minimal stand-in for a boto3 S3 client backed by a dict of objects'''
+
+    def __init__(self, objects = None):
+        self.objects = {}
+        for temp_key, temp_body in (objects or {}).items():
+            self.put_object(Bucket = 'bucket', Key = temp_key, Body = temp_body)
+        self.list_calls = []
+
+    def put_object(self, Bucket, Key, Body, IfMatch = None, IfNoneMatch = None):
+        if ((IfNoneMatch == '*') and (Key in self.objects)) or \
+           ((IfMatch is not None) and ((Key not in self.objects) or (self.objects[Key]['ETag'] != IfMatch))):
+            raise cbrain_proc.ClientError({'Error' : {'Code' : 'PreconditionFailed'}}, 'PutObject')
+        if type(Body) == str:
+            Body = Body.encode()
+        self.objects[Key] = {'Key' : Key, 'Size' : len(Body), 'ETag' : '"{}"'.format(abs(hash(Body))),
+                             'LastModified' : datetime.datetime(2024, 1, 1, tzinfo = datetime.timezone.utc),
+                             'Body' : Body}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise cbrain_proc.ClientError({'Error' : {'Code' : 'NoSuchKey'}}, 'GetObject')
+        return {'Body' : BytesIO(self.objects[Key]['Body']), 'ETag' : self.objects[Key]['ETag']}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise cbrain_proc.ClientError({'Error' : {'Code' : '404'}}, 'HeadObject')
+        return {temp_field : self.objects[Key][temp_field] for temp_field in ('ETag', 'LastModified', 'ContentLength') if temp_field in self.objects[Key]}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter = None):
+        self.list_calls.append((Prefix, Delimiter))
+        page = {'Contents' : [], 'CommonPrefixes' : []}
+        folders = set()
+        for temp_key in sorted(self.objects.keys()):
+            if not temp_key.startswith(Prefix):
+                continue
+            remainder = temp_key[len(Prefix):]
+            if (Delimiter is not None) and (Delimiter in remainder):
+                folders.add(Prefix + remainder.split(Delimiter)[0] + Delimiter)
+                continue
+            page['Contents'].append({temp_field : self.objects[temp_key][temp_field] for temp_field in ('Key', 'Size', 'ETag', 'LastModified')})
+        page['CommonPrefixes'] = [{'Prefix' : temp_prefix} for temp_prefix in sorted(folders)]
+        return [page]
+
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    client = FakeS3Client()
+    monkeypatch.setattr(cbrain_proc, 'create_boto3_client', lambda s3_config = None: client)
+    return client
+
+
+def test_refresh_s3_listing_cache_detects_new_sessions(fake_s3, tmp_path):
+    cache_path = str(tmp_path / 'listing.sqlite')
+    fake_s3.put_object('bucket', 'bids/sub-1/sub-1_sessions.tsv', 'a')
+    fake_s3.put_object('bucket', 'bids/sub-1/ses-V01/anat/sub-1_ses-V01_T1w.nii.gz', 'aa')
+    fake_s3.put_object('bucket', 'bids/sub-2/ses-V01/anat/sub-2_ses-V01_T1w.nii.gz', 'aa')
+
+    summary = cbrain_proc.refresh_s3_listing_cache(cache_path, None, bucket = 'bucket', prefix = 'bids')
+    assert summary['new'] == 2
+
+    #Nothing changed, so nothing is listed again
+    summary = cbrain_proc.refresh_s3_listing_cache(cache_path, None, bucket = 'bucket', prefix = 'bids')
+    assert (summary['unchanged'], summary['refreshed']) == (2, 0)
+
+    #A new session is found even though the cached listing is recent
+    fake_s3.put_object('bucket', 'bids/sub-1/ses-V02/anat/sub-1_ses-V02_T1w.nii.gz', 'aa')
+    summary = cbrain_proc.refresh_s3_listing_cache(cache_path, None, bucket = 'bucket', prefix = 'bids')
+    assert (summary['changed'], summary['unchanged']) == (1, 1)
+    s3_inventory = cbrain_proc.load_s3_inventory_from_cache(cache_path, bucket = 'bucket', prefix = 'bids')
+    assert sorted(s3_inventory['sessions']['sub-1'].keys()) == ['ses-V01', 'ses-V02']
+
+    #So is an updated sessions.tsv
+    fake_s3.put_object('bucket', 'bids/sub-1/sub-1_sessions.tsv', 'ab')
+    summary = cbrain_proc.refresh_s3_listing_cache(cache_path, None, bucket = 'bucket', prefix = 'bids')
+    assert summary['changed'] == 1
+
+    #And a file added to an existing session along with a new scans.tsv
+    fake_s3.put_object('bucket', 'bids/sub-2/ses-V01/sub-2_ses-V01_scans.tsv', 'filename\n')
+    cbrain_proc.refresh_s3_listing_cache(cache_path, None, bucket = 'bucket', prefix = 'bids')
+    fake_s3.put_object('bucket', 'bids/sub-2/ses-V01/anat/sub-2_ses-V01_T2w.nii.gz', 'aa')
+    fake_s3.put_object('bucket', 'bids/sub-2/ses-V01/sub-2_ses-V01_scans.tsv', 'filename\nanat/sub-2_ses-V01_T2w.nii.gz\n')
+    summary = cbrain_proc.refresh_s3_listing_cache(cache_path, None, bucket = 'bucket', prefix = 'bids')
+    assert (summary['changed'], summary['unchanged']) == (1, 1)
+    s3_inventory = cbrain_proc.load_s3_inventory_from_cache(cache_path, bucket = 'bucket', prefix = 'bids')
+    assert 'bids/sub-2/ses-V01/anat/sub-2_ses-V01_T2w.nii.gz' in [temp_file['Key'] for temp_file in s3_inventory['sessions']['sub-2']['ses-V01']]
+
+
+class FakeResponse:
+
+    def __init__(self, entries, status_code = 200):
+        self.entries = entries
+        self.status_code = status_code
+
+    def json(self):
+        return self.entries
+
+
+def make_paged_client(num_entries, per_page, max_concurrent_pages = 4):
+    client = cbrain_proc.CbrainClient(base_url = 'https://cbrain.test', max_concurrent_pages = max_concurrent_pages)
+    client.requested_pages = []
+    def get(*path, data = None, **kwargs):
+        client.requested_pages.append(data['page'])
+        start = (data['page'] - 1)*per_page
+        return FakeResponse([{'id' : temp_id} for temp_id in range(start, min(start + per_page, num_entries))])
+    client.get = get
+    return client
+
+
+def test_get_all_pages_single_page_makes_one_request():
+    client = make_paged_client(3, per_page = 10)
+    entries = client.get_all_pages('groups', {}, per_page = 10)
+    assert [temp_entry['id'] for temp_entry in entries] == [0, 1, 2]
+    assert client.requested_pages == [1]
+
+
+def test_get_all_pages_fans_out_after_full_first_page():
+    client = make_paged_client(25, per_page = 10)
+    entries = client.get_all_pages('userfiles', {}, per_page = 10)
+    assert [temp_entry['id'] for temp_entry in entries] == list(range(25))
+    assert client.requested_pages[0] == 1
+    assert set(client.requested_pages) >= {1, 2, 3}
+
+
+@pytest.mark.parametrize('status_code, falls_back', [(422, True), (400, True), (401, False), (503, False)])
+def test_find_cbrain_entities_only_falls_back_on_rejected_filters(status_code, falls_back):
+    client = cbrain_proc.CbrainClient(base_url = 'https://cbrain.test')
+    entities = [{'id' : 1, 'data_provider_id' : 5}, {'id' : 2, 'data_provider_id' : 6}]
+    def get(*path, data = None, **kwargs):
+        if 'data_provider_id' in data:
+            return FakeResponse([], status_code = status_code)
+        return FakeResponse(entities)
+    client.get = get
+
+    if falls_back:
+        found = cbrain_proc.find_cbrain_entities('token', 'userfiles', cbrain_client = client, filters = {'data_provider_id' : 5})
+        assert found == [entities[0]]
+        assert ('userfiles', 'data_provider_id') in client.unsupported_filters
+    else:
+        with pytest.raises(cbrain_proc.requests.HTTPError):
+            cbrain_proc.find_cbrain_entities('token', 'userfiles', cbrain_client = client, filters = {'data_provider_id' : 5})
+        assert len(client.unsupported_filters) == 0
+
+
+def make_listing_client(entities):
+    client = cbrain_proc.CbrainClient(base_url = 'https://cbrain.test')
+    def get(*path, data = None, **kwargs):
+        start = (data['page'] - 1)*data['per_page']
+        return FakeResponse(entities[start:start + data['per_page']])
+    client.get = get
+    return client
+
+
+def make_updated_entities(num_entities, newest_first):
+    entities = [{'id' : temp_id, 'updated_at' : '2024-01-01T00:{:02d}:{:02d}'.format(temp_id//60, temp_id%60)} for temp_id in range(num_entities)]
+    if newest_first:
+        entities.reverse()
+    return entities
+
+
+def test_recently_updated_entities_need_confirmed_sort():
+    #The portal ignored the sort, so the oldest entity comes first
+    client = make_listing_client(make_updated_entities(1500, newest_first = False))
+    assert cbrain_proc.grab_recently_updated_cbrain_entities('token', 'tasks', '2024-01-01T00:20:00', cbrain_client = client) is None
+
+    #Sorted listings stop at the watermark
+    client = make_listing_client(make_updated_entities(1500, newest_first = True))
+    updated = cbrain_proc.grab_recently_updated_cbrain_entities('token', 'tasks', '2024-01-01T00:20:00', cbrain_client = client)
+    assert sorted(temp_entity['id'] for temp_entity in updated) == list(range(1200, 1500))
+
+
+def test_recently_updated_entities_single_page_ignores_order():
+    client = make_listing_client(make_updated_entities(10, newest_first = False))
+    updated = cbrain_proc.grab_recently_updated_cbrain_entities('token', 'tasks', '2024-01-01T00:00:05', cbrain_client = client)
+    assert sorted(temp_entity['id'] for temp_entity in updated) == [5, 6, 7, 8, 9]
+
+
+def test_snapshot_sync_catches_updates_made_during_the_last_sync(tmp_path):
+    snapshot_path = str(tmp_path / 'snapshot.sqlite')
+    now = datetime.datetime.now(datetime.timezone.utc)
+    def updated(seconds):
+        return (now + datetime.timedelta(seconds = seconds)).isoformat()
+
+    #Task 2 was listed before it was updated, but task 1 was listed after its update
+    client = make_listing_client([{'id' : 1, 'status' : 'Completed', 'updated_at' : updated(2)},
+                                  {'id' : 2, 'status' : 'New', 'updated_at' : updated(-3600)}])
+    cbrain_proc.sync_cbrain_snapshot('token', 'tasks', snapshot_path, cbrain_client = client)
+
+    #The next sync (right away, since the snapshot age defaults to 0) must still see task 2
+    client = make_listing_client([{'id' : 1, 'status' : 'Completed', 'updated_at' : updated(2)},
+                                  {'id' : 2, 'status' : 'Completed', 'updated_at' : updated(1)}])
+    tasks = cbrain_proc.sync_cbrain_snapshot('token', 'tasks', snapshot_path, cbrain_client = client)
+    assert [temp_task['status'] for temp_task in tasks] == ['Completed', 'Completed']
+
+    #A snapshot that is young enough is used without asking CBRAIN
+    client = make_listing_client([])
+    tasks = cbrain_proc.sync_cbrain_snapshot('token', 'tasks', snapshot_path, max_snapshot_age_minutes = 60,
+                                             cbrain_client = client)
+    assert len(tasks) == 2
+
+
+def test_task_index_accepts_scalar_userfile_ids():
+    cbrain_tasks = [{'id' : 1, 'status' : 'Completed', 'tool_config_id' : 7, 'results_data_provider_id' : 3,
+                     'params' : {'interface_userfile_ids' : '55'}},
+                    {'id' : 2, 'status' : 'Failed', 'tool_config_id' : 7, 'results_data_provider_id' : 3,
+                     'params' : {'interface_userfile_ids' : [55, '56']}}]
+    cbrain_task_index = cbrain_proc.build_cbrain_task_index(cbrain_tasks)
+    assert cbrain_task_index[(7, 3, '55')] == [(1, 'Completed'), (2, 'Failed')]
+    assert cbrain_task_index[(7, 3, '56')] == [(2, 'Failed')]
+
+
+def test_external_requirements_index_matches_file_scan():
+    cbrain_files = [{'id' : 1, 'name' : 'sub-1', 'type' : 'BidsSubject', 'data_provider_id' : 99},
+                    {'id' : 2, 'name' : 'sub-1', 'type' : 'BidsSubject', 'data_provider_id' : 710},
+                    {'id' : 3, 'name' : 'sub-1', 'type' : 'FmriprepOutput', 'data_provider_id' : 710},
+                    {'id' : 4, 'name' : 'sub-1', 'type' : 'FmriprepOutput', 'data_provider_id' : 800},
+                    {'id' : 5, 'name' : 'sub-2', 'type' : 'FmriprepOutput', 'data_provider_id' : 800}]
+    cbrain_file_index = cbrain_proc.build_cbrain_file_index(cbrain_files)
+    for requirements_dict in [{'bids' : 'BidsSubject', 'fmriprep' : 'FmriprepOutput', 'atlas' : '123'},
+                              {'mriqc' : 'MriqcOutput'}]:
+        for bids_data_provider_id in [None, 710, 99]:
+            scanned = cbrain_proc.grab_external_requirements('sub-1', cbrain_files, requirements_dict,
+                                                             bids_data_provider_id = bids_data_provider_id,
+                                                             derivatives_data_provider_id = 800)
+            indexed = cbrain_proc.grab_external_requirements('sub-1', None, requirements_dict,
+                                                             bids_data_provider_id = bids_data_provider_id,
+                                                             derivatives_data_provider_id = 800,
+                                                             cbrain_file_index = cbrain_file_index)
+            assert indexed == scanned
+
+    #The BIDS subject must come from the BIDS data provider, and derivatives from elsewhere
+    requirements, _ = cbrain_proc.grab_external_requirements('sub-1', None, {'bids' : 'BidsSubject', 'fmriprep' : 'FmriprepOutput'},
+                                                             bids_data_provider_id = 710, derivatives_data_provider_id = 800,
+                                                             cbrain_file_index = cbrain_file_index)
+    assert requirements == {'bids' : 2, 'fmriprep' : 4}
+
+
+def make_session_files(subject, session, file_names, prefix = 'bids'):
+    last_modified = datetime.datetime(2024, 1, 1, tzinfo = datetime.timezone.utc)
+    session_files = []
+    for temp_name in file_names:
+        if temp_name.endswith('sessions.tsv'):
+            temp_key = '{}/{}/{}'.format(prefix, subject, temp_name)
+        else:
+            temp_key = '{}/{}/{}/{}'.format(prefix, subject, session, temp_name)
+        session_files.append({'Key' : temp_key, 'Size' : len(temp_name), 'LastModified' : last_modified, 'ETag' : '"x"'})
+    return session_files
+
+
+def test_grab_required_files_leaves_session_files_untouched():
+    session_files = make_session_files('sub-1', 'ses-V02', ['anat/sub-1_ses-V02_T1w.nii.gz', 'anat/sub-1_ses-V02_T1w.json',
+                                                           'sub-1_sessions.tsv'])
+    requirements_dict = {'T1' : {'file_naming' : {'T1w.nii.gz' : True}},
+                         'sessions' : {'file_naming' : {'sessions.tsv' : True}}}
+    group_evaluations = {}
+    for _ in range(2):
+        files, metadata = cbrain_proc.grab_required_bids_files_v2('sub-1', session_files, requirements_dict, bucket = 'bucket',
+                                                                  prefix = 'bids', session = 'ses-V02',
+                                                                  associated_files_dict = {'.nii.gz' : ['.json']},
+                                                                  group_evaluations = group_evaluations)
+        assert files == ['ses-V02/anat/sub-1_ses-V02_T1w.json', 'ses-V02/anat/sub-1_ses-V02_T1w.nii.gz', 'sub-1_sessions.tsv']
+        assert metadata['sub-1_sessions.tsv']['LastModified'] == '2024-01-01T00:00:00+00:00'
+    assert all(isinstance(temp_file['LastModified'], datetime.datetime) for temp_file in session_files)
+
+
+def test_check_bids_requirements_only_uses_given_files(fake_s3):
+    session_files = make_session_files('sub-1', 'ses-V02', ['anat/sub-1_ses-V02_T1w.nii.gz', 'sub-1_sessions.tsv'])
+    qc_df = pd.DataFrame([['anat/sub-1_ses-V02_T1w.nii.gz', 40]], columns = ['filename', 'euler'])
+    requirements_dict = {'T1' : {'file_naming' : {'T1w.nii.gz' : True}, 'qc_criteria' : [[{'euler' : [100, 'less_than']}]]},
+                         'T2' : {'file_naming' : {'T2w.nii.gz' : True}},
+                         'sessions' : {'file_naming' : {'sessions.tsv' : True}}}
+    status, tracking = cbrain_proc.check_bids_requirements_v2('sub-1', session_files, requirements_dict, qc_df = qc_df,
+                                                              bucket = 'bucket', prefix = 'bids', session = 'ses-V02')
+    assert (status, tracking) == (False, {'T1' : 'Satisfied', 'T2' : 'No File', 'sessions' : 'Satisfied'})
+    assert fake_s3.list_calls == []
+
+
+@pytest.mark.parametrize('qc_operator, reference, expected', [('equals', 2, [False, True, False]),
+                                                              ('not_equals', 2, [True, False, True]),
+                                                              ('less_than', 2, [True, False, False]),
+                                                              ('less_than_or_equal', 2, [True, True, False]),
+                                                              ('greater_than', 2, [False, False, True]),
+                                                              ('greater_than_or_equal', 2, [False, True, True]),
+                                                              ('in', [1, 3], [True, False, True]),
+                                                              ('between', [2, 3], [False, True, True])])
+def test_make_comparison_operators(qc_operator, reference, expected):
+    assert list(cbrain_proc.make_comparison(pd.Series([1, 2, 3]), qc_operator, reference)) == expected
+    assert [bool(cbrain_proc.make_comparison(temp_value, qc_operator, reference)) for temp_value in [1, 2, 3]] == expected
+
+
+def test_make_comparison_unknown_operator():
+    with pytest.raises(NameError):
+        cbrain_proc.make_comparison(1, 'approximately', 1)
+
+
+def make_scans_tsv(rows):
+    return pd.DataFrame(rows, columns = ['filename', 'run_id', 'euler'])
+
+
+def test_scans_tsv_cache_drops_least_recently_used_files(fake_s3, monkeypatch):
+    monkeypatch.setattr(cbrain_proc, 'SCANS_TSV_CACHE_MAX_FILES', 2)
+    monkeypatch.setattr(cbrain_proc, '_scans_tsv_cache', cbrain_proc.collections.OrderedDict())
+    etags = {}
+    for temp_subject in ['sub-1', 'sub-2', 'sub-3']:
+        scans_tsv = make_scans_tsv([['anat/{}_ses-V02_T1w.nii.gz'.format(temp_subject), 1, 10]]).to_csv(sep = '\t', index = False)
+        fake_s3.put_object(Bucket = 'bucket', Key = 'bids/{}/ses-V02/{}_ses-V02_scans.tsv'.format(temp_subject, temp_subject), Body = scans_tsv)
+    for temp_subject in ['sub-1', 'sub-2', 'sub-1', 'sub-3']:
+        qc_df = cbrain_proc.fetch_scans_tsv_file(None, temp_subject, 'ses-V02', bids_prefix = 'bids', bucket = 'bucket',
+                                                 etag = etags.get(temp_subject))
+        etags[temp_subject] = qc_df.attrs['qc_version']
+
+    #sub-1 was used (from the cache) more recently than sub-2, so sub-2 is the one dropped
+    assert [temp_key[1] for temp_key in cbrain_proc._scans_tsv_cache.keys()] == ['bids/sub-1/ses-V02/sub-1_ses-V02_scans.tsv',
+                                                                                 'bids/sub-3/ses-V02/sub-3_ses-V02_scans.tsv']
+
+
+def test_fetch_scans_tsv_file_only_hides_missing_files(fake_s3):
+    assert cbrain_proc.fetch_scans_tsv_file(None, 'sub-1', 'ses-V02', bids_prefix = 'bids', bucket = 'bucket') is None
+
+    class DeniedClient:
+        def get_object(self, Bucket, Key):
+            raise cbrain_proc.ClientError({'Error' : {'Code' : 'AccessDenied'}}, 'GetObject')
+    with pytest.raises(cbrain_proc.ClientError):
+        cbrain_proc.fetch_scans_tsv_file(None, 'sub-1', 'ses-V02', bids_prefix = 'bids', bucket = 'bucket', client = DeniedClient())
+
+
+def test_build_qc_table_only_coerces_numeric_criteria():
+    scans_tsv_files = {('sub-1', 'ses-V02') : make_scans_tsv([['anat/sub-1_run-1_T1w.nii.gz', '001', '40'],
+                                                              ['anat/sub-1_run-2_T1w.nii.gz', '002', '120']])}
+    run_group = [{'run_id' : ['001', 'equals']}]
+    euler_group = [{'euler' : [100, 'less_than']}]
+    requirements_dict = {'T1' : {'file_naming' : {'T1w.nii.gz' : True}, 'qc_criteria' : [run_group, euler_group]}}
+    qc_table = cbrain_proc.build_qc_table(scans_tsv_files, [requirements_dict])
+
+    assert list(qc_table[cbrain_proc.qc_verdict_column(run_group)]) == ['pass', 'fail']
+    assert list(qc_table[cbrain_proc.qc_verdict_column(euler_group)]) == ['pass', 'fail']
+    assert list(qc_table['run_id']) == ['001', '002']
+    assert scans_tsv_files[('sub-1', 'ses-V02')]['euler'].tolist() == ['40', '120']
+
+
+def test_build_qc_table_falls_back_to_sessions_that_can_be_compared():
+    scans_tsv_files = {('sub-1', 'ses-V02') : make_scans_tsv([['anat/sub-1_T1w.nii.gz', '001', '40']]),
+                       ('sub-2', 'ses-V02') : make_scans_tsv([['anat/sub-2_T1w.nii.gz', '001', 'unknown']]),
+                       ('sub-3', 'ses-V02') : make_scans_tsv([['anat/sub-3_T1w.nii.gz', '001', None]])}
+    euler_group = [{'euler' : [100, 'less_than']}]
+    requirements_dict = {'T1' : {'file_naming' : {'T1w.nii.gz' : True}, 'qc_criteria' : [euler_group]}}
+    qc_table = cbrain_proc.build_qc_table(scans_tsv_files, [requirements_dict])
+
+    verdicts = qc_table[cbrain_proc.qc_verdict_column(euler_group)].droplevel(['qc_session', 'qc_filename'])
+    assert verdicts['sub-1'] == 'pass'
+    assert pd.isnull(verdicts['sub-2'])
+    assert verdicts['sub-3'] == 'missing'
+
+
+def test_split_qc_table_returns_sessions_with_verdicts():
+    sub_1 = cbrain_proc.index_qc_df(make_scans_tsv([['anat/sub-1_T1w.nii.gz', '001', 40]]))
+    sub_1.attrs['qc_version'] = '"etag-1"'
+    sub_2 = make_scans_tsv([['anat/sub-2_T1w.nii.gz', '001', 140]]).drop(columns = ['euler'])
+    scans_tsv_files = {('sub-1', 'ses-V02') : sub_1, ('sub-2', 'ses-V02') : sub_2, ('sub-3', 'ses-V02') : None}
+    euler_group = [{'euler' : [100, 'less_than']}]
+    requirements_dict = {'T1' : {'file_naming' : {'T1w.nii.gz' : True}, 'qc_criteria' : [euler_group]}}
+    split_files = cbrain_proc.split_qc_table(cbrain_proc.build_qc_table(scans_tsv_files, [requirements_dict]), scans_tsv_files)
+
+    verdict_column = cbrain_proc.qc_verdict_column(euler_group)
+    assert list(split_files[('sub-1', 'ses-V02')].index) == ['sub-1_T1w.nii.gz']
+    assert split_files[('sub-1', 'ses-V02')][verdict_column].tolist() == ['pass']
+    assert split_files[('sub-1', 'ses-V02')].attrs == {'qc_version' : '"etag-1"'}
+    assert split_files[('sub-2', 'ses-V02')][verdict_column].tolist() == ['missing']
+    assert split_files[('sub-3', 'ses-V02')] is None
+    assert verdict_column not in sub_1.columns
+
+
+def test_lookup_qc_row_matches_exact_file_names():
+    qc_df = cbrain_proc.index_qc_df(make_scans_tsv([['anat/sub-1_run-10_T1w.nii.gz', '010', 10],
+                                                    ['anat/sub-1_run-1_T1w.nii.gz', '001', 1],
+                                                    ['dwi/sub-1_run-1_T1w.nii.gz', '002', 2],
+                                                    ['anat/sub-1_acq-(x)_T1w.nii.gz', '003', 3]]))
+    #Folders are ignored, and the first row is kept when a file name repeats
+    assert cbrain_proc.lookup_qc_row(qc_df, 'bids/sub-1/ses-V02/anat/sub-1_run-1_T1w.nii.gz')['euler'].tolist() == [1]
+    assert cbrain_proc.lookup_qc_row(qc_df, 'sub-1_run-10_T1w.nii.gz')['euler'].tolist() == [10]
+    assert cbrain_proc.lookup_qc_row(qc_df, 'sub-1_acq-(x)_T1w.nii.gz')['euler'].tolist() == [3]
+    assert cbrain_proc.lookup_qc_row(qc_df, 'sub-1_run_T1w.nii.gz') is None
+    assert cbrain_proc.lookup_qc_row(qc_df, 'sub-1_run-1_T1w.nii') is None
+
+
+def test_qc_ranking_key_orders_best_first():
+    qc_criteria_group = [{'euler' : [100, 'less_than']}, {'snr' : [5, 'greater_than']},
+                         {'run_id' : ['001', 'equals']}, {'usable' : [True, 'equals']}]
+    assert cbrain_proc.qc_ranking_key([40, 9, '001', True], qc_criteria_group) == (40, -9)
+    files_qc_values = {'a' : [40, 6, '001', True], 'b' : [20, 6, '002', True], 'c' : [40, 8, '003', False]}
+    ranked = sorted(files_qc_values, key = lambda temp_file: cbrain_proc.qc_ranking_key(files_qc_values[temp_file], qc_criteria_group))
+    assert ranked == ['b', 'c', 'a']
+
+
+def test_select_files_to_keep_returns_best_files_in_session_order():
+    session_files = make_session_files('sub-1', 'ses-V02', ['anat/sub-1_run-4_T1w.nii.gz', 'anat/sub-1_run-3_T1w.nii.gz',
+                                                           'anat/sub-1_run-2_T1w.nii.gz', 'anat/sub-1_run-1_T1w.nii.gz'])
+    candidate_files = list(zip(session_files, [[50], [20], [50], [90]]))
+    requirement = {'file_naming' : {'T1w.nii.gz' : True}, 'qc_criteria' : [[{'euler' : [100, 'less_than']}]], 'num_to_keep' : 2}
+
+    #run-2 and run-4 tie, so the file name decides which one is kept
+    files, metadata = cbrain_proc.select_files_to_keep(candidate_files, requirement, qc_index = 0)
+    assert files == ['bids/sub-1/ses-V02/anat/sub-1_run-3_T1w.nii.gz', 'bids/sub-1/ses-V02/anat/sub-1_run-2_T1w.nii.gz']
+    assert metadata[files[0]] == session_files[1]
+    assert metadata[files[0]] is not session_files[1]
+
+    #All files are kept when there are no more than num_to_keep
+    files, _ = cbrain_proc.select_files_to_keep(candidate_files[:2], requirement, qc_index = 0)
+    assert files == [session_files[0]['Key'], session_files[1]['Key']]
+
+
+def test_evaluate_requirement_group_keeps_best_files():
+    session_files = make_session_files('sub-1', 'ses-V02', ['anat/sub-1_ses-V02_run-1_T1w.nii.gz',
+                                                           'anat/sub-1_ses-V02_run-2_T1w.nii.gz',
+                                                           'anat/sub-1_ses-V02_run-3_T1w.nii.gz'])
+    qc_df = make_scans_tsv([['anat/sub-1_ses-V02_run-1_T1w.nii.gz', '001', 60],
+                            ['anat/sub-1_ses-V02_run-2_T1w.nii.gz', '002', 30],
+                            ['anat/sub-1_ses-V02_run-3_T1w.nii.gz', '003', 150]])
+    requirement = {'file_naming' : {'T1w.nii.gz' : True}, 'qc_criteria' : [[{'euler' : [100, 'less_than']}]], 'num_to_keep' : 1}
+    group_evaluations = {}
+    group_evaluation = cbrain_proc.evaluate_requirement_group(session_files, requirement, qc_df = qc_df,
+                                                             group_evaluations = group_evaluations)
+    assert group_evaluation['status'] == True
+    assert group_evaluation['files'] == ['bids/sub-1/ses-V02/anat/sub-1_ses-V02_run-2_T1w.nii.gz']
+
+    #Evaluations are only stored when the version of the scans.tsv file is known
+    assert group_evaluations == {}
+    qc_df.attrs['qc_version'] = '"etag"'
+    group_evaluation = cbrain_proc.evaluate_requirement_group(session_files, requirement, qc_df = qc_df,
+                                                             group_evaluations = group_evaluations)
+    assert cbrain_proc.evaluate_requirement_group([], requirement, qc_df = qc_df,
+                                                  group_evaluations = group_evaluations) is group_evaluation
+
+    failing_qc_df = qc_df.assign(euler = [160, 130, 150])
+    failing_evaluation = cbrain_proc.evaluate_requirement_group(session_files, requirement, qc_df = failing_qc_df)
+    assert failing_evaluation['status'] == False
+    assert failing_evaluation['files'] == []
+
+
+def test_requirement_matchers_are_compiled_once_per_content():
+    requirement = {'file_naming' : {'T1w.nii.gz' : True, 'rec-undistorted' : False}, 'num_to_keep' : 1}
+    matcher = cbrain_proc.get_requirement_matcher(requirement)
+    assert cbrain_proc.get_requirement_matcher(dict(reversed(list(requirement.items())))) is matcher
+    assert cbrain_proc.get_requirement_matcher(dict(requirement, num_to_keep = 2)) is not matcher
+    assert [temp_file['Key'] for temp_file in matcher.classify([{'Key' : 'sub-1_T1w.nii.gz'}, {'Key' : 'sub-1_rec-undistorted_T1w.nii.gz'}])] == ['sub-1_T1w.nii.gz']
+
+    #Requirement groups loaded by load_requirements_infos keep their own matcher
+    requirement_group = cbrain_proc.RequirementGroup(requirement)
+    assert cbrain_proc.get_requirement_matcher(requirement_group) is requirement_group.matcher
+
+    with pytest.raises(ValueError):
+        cbrain_proc.get_requirement_matcher({'file_naming' : {'T1w.nii.gz' : True}, 'qc_criteria' : [[{'euler' : [1, 'around']}]]})
+
+
+def test_compute_selection_fingerprint_ignores_agnostic_files_and_skipped_sizes():
+    s3_metadata = {'ses-V02/anat/sub-1_T1w.nii.gz' : {'Size' : 100}, 'ses-V02/anat/sub-1_T1w.json' : {'Size' : 5},
+                   'sub-1_sessions.tsv' : {'Size' : 10}}
+    fingerprint = cbrain_proc.compute_selection_fingerprint(s3_metadata)
+    assert fingerprint.startswith('sha256:')
+    assert cbrain_proc.compute_selection_fingerprint(dict(reversed(list(s3_metadata.items())))) == fingerprint
+    assert cbrain_proc.compute_selection_fingerprint({**s3_metadata, 'ses-V02/anat/sub-1_T1w.json' : {'Size' : 6},
+                                                      'sub-1_sessions.tsv' : {'Size' : 11}}) == fingerprint
+    assert cbrain_proc.compute_selection_fingerprint({**s3_metadata, 'ses-V02/anat/sub-1_T1w.nii.gz' : {'Size' : 101}}) != fingerprint
+    assert cbrain_proc.compute_selection_fingerprint({'ses-V02/anat/sub-1_T1w.nii.gz' : {'Size' : 100}}) != fingerprint
+
+
+def put_submission_log(fake_s3, subject, pipeline, s3_metadata):
+    log_key = 'derivatives/ses-V02/cbrain_misc/{}_{}_UMNProcSubmission.json'.format(subject, pipeline)
+    fake_s3.put_object(Bucket = 'bucket', Key = log_key, Body = json.dumps({'s3_metadata' : s3_metadata}))
+    return cbrain_proc.submission_log_info(log_key, fake_s3.objects[log_key])
+
+
+def test_prefetch_submission_logs_lists_once_and_compares_in_memory(fake_s3, monkeypatch):
+    s3_metadata = {'ses-V02/anat/sub-1_T1w.nii.gz' : {'Size' : 100, 'LastModified' : '2024-01-01'}, 'sub-1_sessions.tsv' : {'Size' : 5}}
+    put_submission_log(fake_s3, 'sub-1', 'mriqc', s3_metadata)
+    put_submission_log(fake_s3, 'sub-1', 'bibsnet', s3_metadata)
+    put_submission_log(fake_s3, 'sub-2', 'mriqc', s3_metadata)
+    fake_s3.put_object(Bucket = 'bucket', Key = 'derivatives/ses-V02/cbrain_misc/sub-3_mriqc_UMNProcSubmission.json', Body = b'not json')
+    fake_s3.put_object(Bucket = 'bucket', Key = 'derivatives/ses-V02/cbrain_misc/sub-4_mriqc_other.json', Body = b'{}')
+
+    #Unreadable logs are skipped, and only the file sizes are kept
+    submission_logs = cbrain_proc.prefetch_submission_logs(None, 'bucket', 'derivatives/ses-V02', subjects = ['sub-1', 'sub-3', 'sub-4'],
+                                                           pipelines = ['mriqc'])
+    assert submission_logs == {('sub-1', 'mriqc') : {'ses-V02/anat/sub-1_T1w.nii.gz' : {'Size' : 100}, 'sub-1_sessions.tsv' : {'Size' : 5}}}
+    assert fake_s3.list_calls == [('derivatives/ses-V02/cbrain_misc/', '/')]
+    assert cbrain_proc.prefetch_submission_logs(None, 'bucket', 'derivatives/ses-V02', exclude = {('sub-1', 'mriqc'), ('sub-3', 'mriqc')}).keys() == \
+        {('sub-1', 'bibsnet'), ('sub-2', 'mriqc')}
+
+    #Prefetched logs are used without downloading anything
+    monkeypatch.setattr(cbrain_proc, 'download_cbrain_misc_file', None)
+    session_files = make_session_files('sub-1', 'ses-V02', ['anat/sub-1_T1w.nii.gz', 'sub-1_sessions.tsv'])
+    session_files[0]['Size'] = 100
+    requirements = {'T1' : {'file_naming' : {'T1w.nii.gz' : True}}, 'sessions' : {'file_naming' : {'sessions.tsv' : True}}}
+    def ancestor_check(session_files):
+        return cbrain_proc.check_if_ancestor_file_selection_is_same('sub-1', session_files, {'mriqc' : requirements}, bids_bucket = 'bucket',
+                                                                    bids_prefix = 'bids', session = 'ses-V02',
+                                                                    derivatives_bucket = 'bucket', derivatives_bucket_prefix = 'derivatives/ses-V02',
+                                                                    submission_logs = submission_logs)
+    assert ancestor_check(session_files) == True
+    session_files[0]['Size'] = 101
+    assert ancestor_check(session_files) == False
+
+
+def load_valid_fingerprints():
+    stored_fingerprints = cbrain_proc.load_selection_fingerprints(None, 'bucket', 'derivatives/ses-V02/cbrain_misc')
+    log_listing = cbrain_proc.list_submission_logs(None, 'bucket', 'derivatives/ses-V02')
+    return cbrain_proc.validate_selection_fingerprints(stored_fingerprints, log_listing), log_listing
+
+
+def test_selection_fingerprints_need_a_matching_log(fake_s3):
+    log_info = put_submission_log(fake_s3, 'sub-1', 'mriqc', {'ses-V02/anat/sub-1_T1w.nii.gz' : {'Size' : 100}})
+    cbrain_proc.save_selection_fingerprints(None, 'bucket', 'derivatives/ses-V02/cbrain_misc',
+                                            {('sub-1', 'mriqc') : cbrain_proc.selection_fingerprint_entry('sha256:a', log_info),
+                                             ('sub-2', 'mriqc') : cbrain_proc.selection_fingerprint_entry('sha256:b', log_info)})
+    valid_fingerprints, log_listing = load_valid_fingerprints()
+    assert valid_fingerprints == {('sub-1', 'mriqc') : 'sha256:a'}
+
+    #Replacing the log makes its stored fingerprint stale
+    put_submission_log(fake_s3, 'sub-1', 'mriqc', {'ses-V02/anat/sub-1_T1w.nii.gz' : {'Size' : 200}})
+    valid_fingerprints, log_listing = load_valid_fingerprints()
+    assert valid_fingerprints == {}
+    assert cbrain_proc.prefetch_submission_logs(None, 'bucket', 'derivatives/ses-V02', log_listing = log_listing) == \
+        {('sub-1', 'mriqc') : {'ses-V02/anat/sub-1_T1w.nii.gz' : {'Size' : 200}}}
+
+    cbrain_proc.record_selection_fingerprints(None, 'bucket', 'derivatives/ses-V02', 'derivatives/ses-V02/cbrain_misc',
+                                              {('sub-1', 'mriqc') : 'sha256:c', ('sub-2', 'mriqc') : 'sha256:d'})
+    valid_fingerprints, log_listing = load_valid_fingerprints()
+    assert valid_fingerprints == {('sub-1', 'mriqc') : 'sha256:c'}
+
+
+def test_save_selection_fingerprints_keeps_entries_saved_by_other_runs(fake_s3, monkeypatch):
+    log_info = put_submission_log(fake_s3, 'sub-1', 'mriqc', {})
+    misc_prefix = 'derivatives/ses-V02/cbrain_misc'
+    cbrain_proc.save_selection_fingerprints(None, 'bucket', misc_prefix, {('sub-1', 'mriqc') : cbrain_proc.selection_fingerprint_entry('sha256:a', log_info)})
+
+    #Another run saves its fingerprint after this one loaded the file but before it writes
+    put_object = fake_s3.put_object
+    put_calls = []
+    def racing_put_object(**kwargs):
+        if len(put_calls) == 0:
+            put_object(Bucket = 'bucket', Key = kwargs['Key'], Body = json.dumps({'sub-2/mriqc' : cbrain_proc.selection_fingerprint_entry('sha256:b', log_info)}))
+        put_calls.append(kwargs)
+        return put_object(**kwargs)
+    monkeypatch.setattr(fake_s3, 'put_object', racing_put_object)
+    assert cbrain_proc.save_selection_fingerprints(None, 'bucket', misc_prefix,
+                                                   {('sub-3', 'mriqc') : cbrain_proc.selection_fingerprint_entry('sha256:c', log_info)}) == True
+    assert len(put_calls) == 2
+    stored_fingerprints = cbrain_proc.load_selection_fingerprints(None, 'bucket', misc_prefix)
+    assert {temp_key : temp_entry['fingerprint'] for temp_key, temp_entry in stored_fingerprints.items()} == {('sub-2', 'mriqc') : 'sha256:b',
+                                                                                                              ('sub-3', 'mriqc') : 'sha256:c'}
+
+    #Other errors are raised
+    def denied_put_object(**kwargs):
+        raise cbrain_proc.ClientError({'Error' : {'Code' : 'AccessDenied'}}, 'PutObject')
+    monkeypatch.setattr(fake_s3, 'put_object', denied_put_object)
+    with pytest.raises(cbrain_proc.ClientError):
+        cbrain_proc.save_selection_fingerprints(None, 'bucket', misc_prefix, {('sub-4', 'mriqc') : cbrain_proc.selection_fingerprint_entry('sha256:d', log_info)})
+
+
+def test_ancestor_check_fails_for_sidecar_entry_without_log(fake_s3, monkeypatch):
+    s3_metadata = {'ses-V02/anat/sub-1_T1w.nii.gz' : {'Size' : 100}}
+    fingerprint = cbrain_proc.compute_selection_fingerprint(s3_metadata)
+    log_info = {'Key' : 'derivatives/ses-V02/cbrain_misc/sub-1_mriqc_UMNProcSubmission.json', 'ETag' : '"x"', 'LastModified' : '2024-01-01T00:00:00+00:00'}
+    cbrain_proc.save_selection_fingerprints(None, 'bucket', 'derivatives/ses-V02/cbrain_misc',
+                                            {('sub-1', 'mriqc') : cbrain_proc.selection_fingerprint_entry(fingerprint, log_info)})
+    monkeypatch.setattr(cbrain_proc, 'grab_required_bids_files_v2', lambda *args, **kwargs: (list(s3_metadata.keys()), s3_metadata))
+
+    valid_fingerprints, log_listing = load_valid_fingerprints()
+    submission_logs = cbrain_proc.prefetch_submission_logs(None, 'bucket', 'derivatives/ses-V02', log_listing = log_listing)
+    assert cbrain_proc.check_if_ancestor_file_selection_is_same('sub-1', [], {'mriqc' : {}}, derivatives_bucket_config = None,
+                                                                derivatives_bucket = 'bucket', derivatives_bucket_prefix = 'derivatives/ses-V02',
+                                                                submission_logs = submission_logs,
+                                                                selection_fingerprints = valid_fingerprints) == False
+
+
+def test_build_s3_inventory_ignores_sibling_prefixes(fake_s3):
+    for temp_key in ['assembly_bids/sub-1/ses-V02/anat/sub-1_ses-V02_T1w.nii.gz', 'assembly_bids/sub-1/sub-1_sessions.tsv',
+                     'assembly_bids_old/sub-1/ses-V02/anat/sub-1_ses-V02_T2w.nii.gz', 'other/assembly_bids/sub-2/ses-V02/anat/x.nii.gz']:
+        fake_s3.put_object(Bucket = 'bucket', Key = temp_key, Body = b'x')
+    for temp_prefix in ['assembly_bids', 'assembly_bids/']:
+        s3_inventory = cbrain_proc.build_s3_inventory(None, bucket = 'bucket', prefix = temp_prefix)
+        assert list(s3_inventory['subjects'].keys()) == ['sub-1']
+        assert [temp_file['Key'] for temp_file in s3_inventory['sessions']['sub-1']['ses-V02']] == ['assembly_bids/sub-1/ses-V02/anat/sub-1_ses-V02_T1w.nii.gz']
+        assert len(s3_inventory['subjects']['sub-1']) == 2
+
+
+def test_find_s3_subjects_discovery_modes(fake_s3):
+    for temp_key in ['bids/sub-1/ses-V02/anat/sub-1_ses-V02_T1w.nii.gz', 'bids/sub-2/sub-2_sessions.tsv', 'bids/sub-3_notes.txt',
+                     'bids/participants.tsv']:
+        fake_s3.put_object(Bucket = 'bucket', Key = temp_key, Body = b'x')
+    assert sorted(cbrain_proc.find_s3_subjects(None, bucket = 'bucket', prefix = 'bids')) == ['sub-1', 'sub-2', 'sub-3_notes.txt']
+    assert sorted(cbrain_proc.find_s3_subjects(None, bucket = 'bucket', prefix = 'bids', discovery_mode = 'delimiter')) == ['sub-1', 'sub-2']
+    assert fake_s3.list_calls[-1] == ('bids/', '/')
+    with pytest.raises(ValueError):
+        cbrain_proc.find_s3_subjects(None, bucket = 'bucket', prefix = 'bids', discovery_mode = 'folders')
+
+
+def test_potential_subjects_match_s3_and_cbrain_by_name(fake_s3):
+    for temp_subject in ['sub-1', 'sub-2', 'sub-3']:
+        fake_s3.put_object(Bucket = 'bucket', Key = 'bids/{}/{}_sessions.tsv'.format(temp_subject, temp_subject), Body = b'x')
+    cbrain_files = [{'id' : 30, 'name' : 'sub-3', 'type' : 'BidsSubject', 'data_provider_id' : 710, 'size' : 3},
+                    {'id' : 20, 'name' : 'sub-2', 'type' : 'BidsSubject', 'data_provider_id' : 710, 'size' : 2},
+                    {'id' : 21, 'name' : 'sub-2', 'type' : 'BidsSubject', 'data_provider_id' : 710, 'size' : 5},
+                    {'id' : 10, 'name' : 'sub-1', 'type' : 'SingleFile', 'data_provider_id' : 710, 'size' : 1},
+                    {'id' : 40, 'name' : 'sub-4', 'type' : 'BidsSubject', 'data_provider_id' : 710, 'size' : 4}]
+
+    #The first CBRAIN ID is kept for duplicated names, and subjects are returned in sorted order
+    names, ids = cbrain_proc.find_potential_subjects_for_processing_v2(cbrain_files, None, bids_bucket = 'bucket', bids_prefix = 'bids')
+    assert (names, ids) == (['sub-2', 'sub-3'], [20, 30])
+    names, ids, sizes = cbrain_proc.find_potential_subjects_for_processing('token', None, bids_bucket = 'bucket', bids_prefix = 'bids',
+                                                                           cbrain_client = make_listing_client(cbrain_files))
+    assert (names, ids, sizes) == (['sub-2', 'sub-3'], [20, 30], [2, 3])
+
+
+def test_find_subjects_with_derivatives_matches_exact_names(fake_s3):
+    for temp_key in ['derivatives/ses-V02/mriqc/sub-10/anat/sub-10_T1w.json', 'derivatives/ses-V02/mriqc/sub-2_report.html',
+                     'derivatives/ses-V02/mriqc/sub-3.html', 'derivatives/ses-V02/mriqcplus/sub-1/anat/sub-1_T1w.json',
+                     'derivatives/ses-V03/mriqc/sub-1/anat/sub-1_T1w.json']:
+        fake_s3.put_object(Bucket = 'bucket', Key = temp_key, Body = b'x')
+    subjects = cbrain_proc.find_subjects_with_derivatives('bucket', 'derivatives/ses-V02/mriqc', None)
+    assert subjects == {'sub-10', 'sub-2', 'sub-3'}
+    assert fake_s3.list_calls == [('derivatives/ses-V02/mriqc/', '/')]
+
+
+def write_s3_config(path, access_key = 'AKIA', host_base = 's3.example.org'):
+    path.write_text('[default]\naccess_key = {}\nsecret_key = secret\nhost_base = {}\n'.format(access_key, host_base))
+    return str(path)
+
+
+def test_create_boto3_client_shares_one_client_per_config(tmp_path, monkeypatch):
+    created = []
+    def fake_client(service_name, **kwargs):
+        created.append(kwargs)
+        return object()
+    monkeypatch.setattr(cbrain_proc.boto3, 'client', fake_client)
+    cbrain_proc.clear_boto3_clients()
+    first_config = write_s3_config(tmp_path / 'first.cfg')
+    second_config = write_s3_config(tmp_path / 'second.cfg', host_base = 'https://other.example.org')
+    try:
+        with cbrain_proc.concurrent.futures.ThreadPoolExecutor(max_workers = 8) as executor:
+            clients = list(executor.map(lambda _: cbrain_proc.create_boto3_client(s3_config = first_config), range(32)))
+        assert all(temp_client is clients[0] for temp_client in clients)
+        assert cbrain_proc.create_boto3_client(s3_config = second_config) is not clients[0]
+        assert [temp_kwargs['endpoint_url'] for temp_kwargs in created] == ['https://s3.example.org', 'https://other.example.org']
+        assert all(temp_kwargs['config'] is cbrain_proc.BOTO3_CLIENT_CONFIG for temp_kwargs in created)
+
+        #Clearing the registry makes the next request build a new client
+        cbrain_proc.clear_boto3_clients()
+        assert cbrain_proc.create_boto3_client(s3_config = first_config) is not clients[0]
+        assert len(created) == 3
+    finally:
+        cbrain_proc.clear_boto3_clients()
+
+
+def test_boto3_client_config_pools_and_retries():
+    assert cbrain_proc.BOTO3_CLIENT_CONFIG.max_pool_connections >= 50
+    assert cbrain_proc.BOTO3_CLIENT_CONFIG.tcp_keepalive == True
+    assert cbrain_proc.BOTO3_CLIENT_CONFIG.retries == {'max_attempts' : 10, 'mode' : 'adaptive'}
+
+
+@pytest.fixture
+def flaky_portal():
+    '''Local HTTP server that answers 503 to the first request of each method, then 200'''
+
+    import http.server
+    import threading
+
+    requests_seen = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def respond(self):
+            length = int(self.headers.get('Content-Length', 0))
+            if length:
+                self.rfile.read(length)
+            requests_seen.append((self.command, self.path))
+            status_code = 503 if [temp_request[0] for temp_request in requests_seen].count(self.command) == 1 else 200
+            body = json.dumps({'path' : self.path}).encode()
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = respond
+        do_POST = respond
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/'.format(server.server_address[1]), requests_seen
+    server.shutdown()
+    server.server_close()
+
+
+def test_cbrain_client_retries_gets_but_not_posts(flaky_portal):
+    base_url, requests_seen = flaky_portal
+    client = cbrain_proc.CbrainClient(base_url = base_url, backoff_factor = 0, timeout = (5, 5))
+    assert client.url('userfiles', 12, 'sync_multiple') == base_url.rstrip('/') + '/userfiles/12/sync_multiple'
+
+    response = client.get('tasks', data = {'cbrain_api_token' : 'token'})
+    assert response.status_code == 200
+    assert requests_seen == [('GET', '/tasks'), ('GET', '/tasks')]
+
+    #A POST could submit a task twice, so a 503 is returned as is
+    response = client.post('tasks', data = {'cbrain_api_token' : 'token'})
+    assert response.status_code == 503
+    assert requests_seen[2:] == [('POST', '/tasks')]
+
+
+def test_get_cbrain_client_returns_shared_default(monkeypatch):
+    monkeypatch.setattr(cbrain_proc, '_default_cbrain_client', None)
+    default_client = cbrain_proc.get_cbrain_client()
+    assert cbrain_proc.get_cbrain_client() is default_client
+    other_client = cbrain_proc.CbrainClient(base_url = 'http://localhost:3000/')
+    assert cbrain_proc.get_cbrain_client(other_client) is other_client
+    cbrain_proc.set_cbrain_client(other_client)
+    assert cbrain_proc.get_cbrain_client() is other_client
+    assert other_client.base_url == 'http://localhost:3000'
+
+
+def test_find_cbrain_entities_failure_message_names_entity_type(capsys):
+    client = cbrain_proc.CbrainClient(base_url = 'https://cbrain.test')
+    client.get = lambda *path, data = None, **kwargs: FakeResponse([], status_code = 500)
+    assert cbrain_proc.find_cbrain_entities('token', 'groups', cbrain_client = client) == []
+    assert 'User groups request failed.' in capsys.readouterr().out
+
+
+def test_run_with_output_buffer_returns_text_and_errors():
+    def evaluate(name, output = None):
+        print('evaluating {}'.format(name), file = output)
+        if name == 'bad':
+            raise ValueError(name)
+        return name.upper()
+
+    assert cbrain_proc.run_with_output_buffer(evaluate, 'good') == ('GOOD', 'evaluating good\n', None)
+    result, printed_text, error = cbrain_proc.run_with_output_buffer(evaluate, 'bad')
+    assert (result, printed_text, type(error)) == (None, 'evaluating bad\n', ValueError)
+
+
+@pytest.fixture
+def mock_processing_run(monkeypatch):
+    '''Replace the CBRAIN and S3 calls made by update_processing, recording
+    the subject/sessions that are evaluated and launched'''
+
+    session_dps = {'dp-V02' : {'id' : 10, 'bucket' : 'deriv', 'prefix' : 'derivatives/ses-V02'},
+                   'dp-V03' : {'id' : 11, 'bucket' : 'deriv', 'prefix' : 'derivatives/ses-V03'}}
+    subjects = ['sub-{:02d}'.format(i) for i in range(10)]
+    run = {'subjects' : subjects, 'evaluated' : [], 'launched' : [], 'stdout' : [], 'max_concurrent_pages' : set()}
+
+    def evaluate_subject_session(subject_name, subject_id, session_dp_name, run_info, output = None):
+        run['evaluated'].append((subject_name, session_dp_name))
+        run['stdout'].append(sys.stdout)
+        print('Evaluated {} {}'.format(subject_name, session_dp_name), file = output)
+        return {'tracking' : {'subject' : subject_name, 'session' : session_dp_name}, 'ready' : True,
+                'external_requirements' : {'bids_dir' : subject_id}, 'files_to_keep' : [], 's3_metadata' : {}}
+
+    def launch_task_concise_dict(pipeline_name, external_requirements, cbrain_api_token, task_description = None, **kwargs):
+        run['launched'].append(task_description)
+        return True, {'returned_by_cbrain' : {'id' : len(run['launched'])}}
+
+    monkeypatch.setattr(cbrain_proc, 'grab_cbrain_initialization_details', lambda *args, **kwargs: (7, 'bids', 1, session_dps))
+    def find_cbrain_entities(*args, cbrain_client = None, **kwargs):
+        run['max_concurrent_pages'].add(cbrain_client.max_concurrent_pages)
+        return []
+
+    monkeypatch.setattr(cbrain_proc, 'find_current_cbrain_tasks', find_cbrain_entities)
+    monkeypatch.setattr(cbrain_proc, 'find_cbrain_entities', find_cbrain_entities)
+    monkeypatch.setattr(cbrain_proc, 'build_s3_inventory', lambda *args, **kwargs: None)
+    monkeypatch.setattr(cbrain_proc, 'find_potential_subjects_for_processing_v2',
+                        lambda *args, **kwargs: (subjects, [str(100 + i) for i in range(len(subjects))]))
+    monkeypatch.setattr(cbrain_proc, 'find_subjects_with_derivatives', lambda *args, **kwargs: set())
+    monkeypatch.setattr(cbrain_proc, 'create_boto3_client', lambda *args, **kwargs: None)
+    monkeypatch.setattr(cbrain_proc, 'fetch_scans_tsv_file', lambda *args, **kwargs: None)
+    monkeypatch.setattr(cbrain_proc, 'evaluate_subject_session', evaluate_subject_session)
+    monkeypatch.setattr(cbrain_proc, 'cbrain_mark_as_newer', lambda *args, **kwargs: None)
+    monkeypatch.setattr(cbrain_proc, 'launch_task_concise_dict', launch_task_concise_dict)
+    return run
+
+
+def run_mock_processing(**kwargs):
+    kwargs.setdefault('check_ancestor_pipelines', False)
+    return cbrain_proc.update_processing(pipeline_name = 'bibsnet', cbrain_api_token = 'token',
+                                         session_data_provider_names = ['dp-V02', 'dp-V03'], group_name = 'group',
+                                         user_id = 'user', bids_bucket_config = 'config', bids_data_provider_name = 'bids',
+                                         derivatives_bucket_config = 'config', **kwargs)
+
+
+def test_update_processing_evaluates_no_more_than_the_launch_budget(mock_processing_run):
+    run_mock_processing(max_subject_sessions_to_proc = 3, max_evaluation_workers = 2)
+    assert mock_processing_run['launched'] == ['sub-00 via API', 'sub-00 via API', 'sub-01 via API']
+    assert mock_processing_run['evaluated'] == [('sub-00', 'dp-V02'), ('sub-00', 'dp-V03'), ('sub-01', 'dp-V02')]
+
+
+def test_update_processing_prints_evaluations_in_order_without_swapping_stdout(mock_processing_run, capsys):
+    stdout = sys.stdout
+    tracking_df = run_mock_processing(max_evaluation_workers = 4)
+    assert len(tracking_df) == 20
+    assert set(mock_processing_run['stdout']) == {stdout}
+    printed = [line for line in capsys.readouterr().out.splitlines() if line.startswith('Evaluated ')]
+    assert printed == ['Evaluated sub-{:02d} {}'.format(i, temp_ses) for i in range(10) for temp_ses in ('dp-V02', 'dp-V03')]
+
+
+def test_map_with_workers_runs_in_calling_thread_with_one_worker():
+    assert cbrain_proc.map_with_workers(lambda item: (item, threading.get_ident()), [1, 2], max_workers = 1) == \
+           [(1, threading.get_ident()), (2, threading.get_ident())]
+    assert cbrain_proc.map_with_workers(lambda item: item * 2, [1, 2, 3], max_workers = 2) == [2, 4, 6]
+
+
+def test_with_max_concurrent_pages_shares_connections_and_filters():
+    client = cbrain_proc.CbrainClient(base_url = 'https://cbrain.test')
+    limited_client = client.with_max_concurrent_pages(1)
+    assert (limited_client.max_concurrent_pages, client.max_concurrent_pages) == (1, 8)
+    assert limited_client.session is client.session
+    limited_client.unsupported_filters.add(('userfiles', 'type'))
+    assert ('userfiles', 'type') in client.unsupported_filters
+
+
+def test_update_processing_limits_requests_in_flight(mock_processing_run, monkeypatch, tmp_path):
+    lock = threading.Lock()
+    requests_in_flight = {'current' : 0, 'max' : 0, 'scans_tsv' : 0, 'logs' : 0}
+
+    def tracked_request(request_type, result):
+        def request(*args, **kwargs):
+            with lock:
+                requests_in_flight['current'] += 1
+                requests_in_flight['max'] = max(requests_in_flight['max'], requests_in_flight['current'])
+                requests_in_flight[request_type] += 1
+            time.sleep(0.01)
+            with lock:
+                requests_in_flight['current'] -= 1
+            return result
+        return request
+
+    log_listing = {(temp_subject, 'bibsnet_work') : {'Key' : 'derivatives/cbrain_misc/{}'.format(temp_subject), 'ETag' : '"e"',
+                                                     'LastModified' : '2024-01-01T00:00:00+00:00'}
+                   for temp_subject in mock_processing_run['subjects']}
+    monkeypatch.setattr(cbrain_proc, 'fetch_scans_tsv_file', tracked_request('scans_tsv', None))
+    monkeypatch.setattr(cbrain_proc, 'load_submission_log_metadata', tracked_request('logs', {'anat/T1w.nii.gz' : {'Size' : 1}}))
+    monkeypatch.setattr(cbrain_proc, 'load_selection_fingerprints', lambda *args, **kwargs: {})
+    monkeypatch.setattr(cbrain_proc, 'list_submission_logs', lambda *args, **kwargs: dict(log_listing))
+    monkeypatch.setattr(cbrain_proc.html_tools, 'reformat_df_and_produce_proc_html', lambda tracking_df, *args: tracking_df)
+
+    run_mock_processing(logs_directory = str(tmp_path), check_ancestor_pipelines = True, max_subject_sessions_to_proc = 0,
+                        s3_concurrency = 2)
+    assert (requests_in_flight['scans_tsv'], requests_in_flight['logs']) == (20, 20)
+    assert requests_in_flight['max'] <= 2
+    assert mock_processing_run['max_concurrent_pages'] == {1}